@@ -42,6 +42,10 @@ This module has following features
         'views/export_partner.xml',
         'views/account_views.xml',
         'views/product_views.xml',
+        'views/qbo_sync_run_views.xml',
+        'views/qbo_import_plan_views.xml',
+        'views/qbo_entity_mirror_views.xml',
+        'views/qbo_sync_failure_views.xml',
     ],
     'images': ['static/description/odooquickbook_v11.jpg'],
     'qweb': [],
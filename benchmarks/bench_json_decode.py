@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of QBO response decoding.
+
+Compares the former ``json.loads(str(response.text))`` decoding, charset
+detection and text decoding of ``requests.Response`` included, with the
+central decoder of ``tools/qbo_json.py`` on a synthetic Customer
+QueryResponse and reports the decode time per MB.
+
+Usage::
+
+    python benchmarks/bench_json_decode.py [--records 1000] [--repeat 20]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+import requests
+from requests.utils import get_encoding_from_headers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_qbo_json():
+    # load the module by path so that the benchmark runs without odoo
+    spec = importlib.util.spec_from_file_location('qbo_json', os.path.join(ROOT, 'tools', 'qbo_json.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_customer(index):
+    address = {
+        'Id': str(index * 2),
+        'Line1': '%s Main Street' % index,
+        'City': 'Mountain View',
+        'Country': 'USA',
+        'CountrySubDivisionCode': 'CA',
+        'PostalCode': '94042',
+    }
+    return {
+        'Id': str(index),
+        'SyncToken': '0',
+        'DisplayName': 'Customer %s' % index,
+        'GivenName': 'Given %s' % index,
+        'FamilyName': 'Family %s' % index,
+        'CompanyName': 'Company %s' % index,
+        'Active': True,
+        'Job': False,
+        'Taxable': True,
+        'Balance': 1250.75,
+        'PrimaryEmailAddr': {'Address': 'customer%s@example.com' % index},
+        'PrimaryPhone': {'FreeFormNumber': '(555) 555-%04d' % (index % 10000)},
+        'BillAddr': address,
+        'ShipAddr': address,
+        'Notes': 'Synthetic customer used to benchmark response decoding ' * 2,
+        'MetaData': {'CreateTime': '2018-01-01T10:00:00-08:00', 'LastUpdatedTime': '2018-01-02T10:00:00-08:00'},
+    }
+
+
+def make_payload(records):
+    document = {
+        'QueryResponse': {'Customer': [make_customer(i) for i in range(1, records + 1)], 'startPosition': 1, 'maxResults': records},
+        'time': '2018-01-02T10:00:00.000-08:00',
+    }
+    return json.dumps(document).encode('utf-8')
+
+
+def make_response(content, content_type):
+    """Return a requests.Response of a QBO body, its encoding is set from the headers like requests.adapters does"""
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    if content_type:
+        response.headers['Content-Type'] = content_type
+    response.encoding = get_encoding_from_headers(response.headers)
+    return response
+
+
+def former_loads(content_type):
+    """Return the former decoding of a body served with content_type, the response is built in the timed call
+    Without content type the encoding is unknown, Response.text detects the charset of the body.
+    """
+    return lambda content: json.loads(str(make_response(content, content_type).text))
+
+
+def bench(label, func, payload, repeat):
+    size_mb = len(payload) / (1024.0 * 1024.0)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-32s %8.2f ms/MB  (%.2f MB in %.2f ms)' % (label, best * 1000 / size_mb, size_mb, best * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000, help='customers in the synthetic QueryResponse')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per decoder, the best run is reported')
+    args = parser.parse_args()
+
+    qbo_json = load_qbo_json()
+    payload = make_payload(args.records)
+
+    # former decoding: the body is decoded to text by requests first, its charset is detected when the headers lack it
+    bench('json.loads(str(text)) [charset]', former_loads('application/json;charset=UTF-8'), payload, args.repeat)
+    bench('json.loads(str(text)) [detected]', former_loads(None), payload, args.repeat)
+    bench('json.loads(bytes)', lambda content: json.loads(content.decode('utf-8')), payload, args.repeat)
+    bench('qbo_json.loads [%s]' % qbo_json.BACKEND, qbo_json.loads, payload, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
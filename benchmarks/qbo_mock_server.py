@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the QuickBooks Online accounting API.
+
+Serves enough of the v3 API for the connector to run against it without
+network access or API quota:
+
+* ``GET  /v3/company/<realm>/query?query=...``   select with projection, where, order by, startposition, maxresults
+* ``GET  /v3/company/<realm>/<entity>/<id>``     read
+* ``POST /v3/company/<realm>/<entity>``          create, ``?operation=update`` for (sparse) updates
+* ``POST /v3/company/<realm>/batch``             BatchItemRequest with create/update/delete/query operations
+* ``GET  /v3/company/<realm>/cdc``               change data capture (``entities``, ``changedSince``)
+* ``GET  /v3/company/<realm>/taxrate/<id>``      tax rates of the seeded tax codes
+* ``POST /v3/company/<realm>/taxservice/taxcode`` composite tax creation
+* ``POST /oauth2/v1/tokens/bearer``              token endpoint (authorization code and refresh token grants)
+
+Latency and throttling are configurable: every call sleeps ``latency`` ms
+(plus ``jitter``), a realm is limited to ``rate`` calls per minute and to
+``max_concurrent`` calls in flight, exceeding calls get the 429 fault QBO
+returns. ``requestid`` query parameters are honoured, a replayed request id
+returns the first response unchanged.
+
+``GET /_stats`` returns request counters, ``POST /_reset`` clears them and
+``POST /_seed?customers=1000&items=1000...`` (re)generates the realm data.
+
+Usage::
+
+    python benchmarks/qbo_mock_server.py --port 8099 --latency 50 --rate 500 --max-concurrent 10 --customers 1000
+"""
+import argparse
+import copy
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ENTITIES = ['Account', 'Bill', 'BillPayment', 'Customer', 'Invoice', 'Item', 'Payment', 'PaymentMethod', 'TaxAgency', 'TaxCode',
+            'TaxRate', 'Term', 'Vendor']
+ENTITY_NAMES = dict((name.lower(), name) for name in ENTITIES)
+
+QUERY_RE = re.compile(r"^\s*select\s+(?P<fields>.+?)\s+from\s+(?P<entity>\w+)"
+                      r"(?:\s+where\s+(?P<where>.+?))?"
+                      r"(?:\s+order\s+by\s+(?P<order>\w+)(?:\s+(?P<direction>asc|desc))?)?"
+                      r"(?:\s+startposition\s+(?P<start>\d+))?"
+                      r"(?:\s+maxresults\s+(?P<max>\d+))?\s*$", re.I | re.S)
+CONDITION_RE = re.compile(r"^\s*(?P<field>[\w.]+)\s*(?P<op>>=|<=|!=|=|>|<|\blike\b|\bin\b)\s*(?P<value>.+?)\s*$", re.I | re.S)
+
+
+def _now():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S-00:00')
+
+
+def _fault(message, code='400', detail=None, fault_type='ValidationFault'):
+    return {'Fault': {'Error': [{'Message': message, 'Detail': detail or message, 'code': code}], 'type': fault_type}, 'time': _now()}
+
+
+def _sort_key(value):
+    value = '' if value is None else value
+    if isinstance(value, str) and value.isdigit():
+        return (0, int(value), '')
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, str(value).lower())
+
+
+def _get_path(record, path):
+    # QBO field names are case insensitive in queries
+    for part in path.split('.'):
+        if not isinstance(record, dict):
+            return None
+        if part in record:
+            record = record[part]
+        else:
+            record = next((value for key, value in record.items() if key.lower() == part.lower()), None)
+    return record
+
+
+def _parse_value(value):
+    value = value.strip()
+    if value.startswith('(') and value.endswith(')'):
+        return [_parse_value(v) for v in re.findall(r"'(?:[^'\\]|\\.)*'|[^,\s]+", value[1:-1])]
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1].replace("\\'", "'")
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return value
+
+
+def _match(record, condition):
+    found = CONDITION_RE.match(condition)
+    if not found:
+        raise ValueError('Unsupported condition: %s' % condition)
+    field, op, value = found.group('field'), found.group('op').lower(), _parse_value(found.group('value'))
+    current = _get_path(record, field)
+    if op == 'in':
+        return _sort_key(current) in [_sort_key(v) for v in value]
+    if op == 'like':
+        pattern = '^%s$' % re.escape(str(value)).replace('%', '.*')
+        return bool(re.match(pattern, str(current or ''), re.I))
+    left, right = _sort_key(current), _sort_key(value)
+    if isinstance(value, bool):
+        left, right = bool(current), value
+    return {
+        '=': left == right,
+        '!=': left != right,
+        '>': left > right,
+        '<': left < right,
+        '>=': left >= right,
+        '<=': left <= right,
+    }[op]
+
+
+class QboRealm(object):
+    """In-memory QBO company"""
+
+    def __init__(self, realm_id):
+        self.realm_id = realm_id
+        self.lock = threading.RLock()
+        self.records = defaultdict(OrderedDict)
+        self.sequence = defaultdict(int)
+        self.request_ids = {}
+        self.names = defaultdict(set)
+        self.calls = []
+        self.in_flight = 0
+
+    # records
+
+    def add(self, entity, record):
+        with self.lock:
+            self.sequence[entity] += 1
+            record = dict(record)
+            record.setdefault('Id', str(self.sequence[entity]))
+            record.setdefault('SyncToken', '0')
+            record.setdefault('sparse', False)
+            record.setdefault('domain', 'QBO')
+            stamp = _now()
+            record['MetaData'] = {'CreateTime': stamp, 'LastUpdatedTime': stamp}
+            self.records[entity][record['Id']] = record
+            if record.get('DisplayName'):
+                self.names[entity].add(record['DisplayName'])
+            return record
+
+    def update(self, entity, values):
+        with self.lock:
+            record = self.records[entity].get(str(values.get('Id')))
+            if record is None:
+                return _fault('Object Not Found', code='610', detail='Object Not Found : Something you\'re trying to use has been made inactive.')
+            if str(values.get('SyncToken')) != record['SyncToken']:
+                return _fault('Stale Object Error', code='5010',
+                              detail='Stale Object Error : You and %s were working on this at the same time.' % 'another user')
+            sync_token = int(record['SyncToken'])
+            if not values.get('sparse') or str(values.get('sparse')).lower() == 'false':
+                keep = dict((key, record[key]) for key in ('Id', 'MetaData', 'domain') if key in record)
+                record.clear()
+                record.update(keep)
+            record.update(dict((key, value) for key, value in values.items() if key not in ('SyncToken', 'MetaData')))
+            record['SyncToken'] = str(sync_token + 1)
+            record['MetaData']['LastUpdatedTime'] = _now()
+            return {entity: record, 'time': _now()}
+
+    def create(self, entity, values):
+        if entity in ('Customer', 'Vendor') and values.get('DisplayName') in self.names[entity]:
+            return _fault('Duplicate Name Exists Error', code='6240',
+                          detail='The name supplied already exists. : %s' % values.get('DisplayName'))
+        record = self.add(entity, values)
+        return {entity: record, 'time': _now()}
+
+    def read(self, entity, record_id):
+        record = self.records[entity].get(str(record_id))
+        if record is None:
+            return _fault('Object Not Found', code='610')
+        return {entity: record, 'time': _now()}
+
+    def query(self, query):
+        found = QUERY_RE.match(query)
+        if not found:
+            return _fault('QueryParserError: Encountered an unsupported query', code='4000', detail=query)
+        entity = ENTITY_NAMES.get(found.group('entity').lower())
+        if not entity:
+            return _fault('QueryValidationError: Invalid entity', code='4001', detail=found.group('entity'))
+        with self.lock:
+            records = list(self.records[entity].values())
+        where = found.group('where')
+        if where:
+            conditions = re.split(r'\s+and\s+', where, flags=re.I)
+            try:
+                records = [r for r in records if all(_match(r, c) for c in conditions)]
+            except ValueError as e:
+                return _fault('QueryParserError', code='4000', detail=str(e))
+        if found.group('fields').strip().lower() == 'count(*)':
+            return {'QueryResponse': {'totalCount': len(records)}, 'time': _now()}
+        if found.group('order'):
+            records.sort(key=lambda r: _sort_key(_get_path(r, found.group('order'))),
+                         reverse=(found.group('direction') or '').lower() == 'desc')
+        start = int(found.group('start') or 1)
+        max_results = min(int(found.group('max') or 100), 1000)
+        records = records[start - 1:start - 1 + max_results]
+        projection = [f.strip() for f in found.group('fields').split(',')]
+        if projection != ['*']:
+            keep = set(f.lower() for f in projection) | set(['id', 'synctoken', 'domain', 'sparse'])
+            records = [dict((key, value) for key, value in r.items() if key.lower() in keep) for r in records]
+        response = {'startPosition': start, 'maxResults': len(records)}
+        if records:
+            response[entity] = records
+        return {'QueryResponse': response, 'time': _now()}
+
+    def cdc(self, entities, changed_since):
+        since = changed_since[:19]
+        responses = []
+        for name in entities.split(','):
+            entity = ENTITY_NAMES.get(name.strip().lower())
+            if not entity:
+                continue
+            with self.lock:
+                records = [r for r in self.records[entity].values() if r['MetaData']['LastUpdatedTime'][:19] >= since]
+            responses.append({entity: records, 'startPosition': 1, 'maxResults': len(records)})
+        return {'CDCResponse': [{'QueryResponse': responses}], 'time': _now()}
+
+    def batch(self, items):
+        if len(items) > 30:
+            return _fault('Batch request exceeds maximum of 30 items', code='4002')
+        responses = []
+        for item in items:
+            response = {'bId': item.get('bId')}
+            if 'Query' in item:
+                result = self.query(item['Query'])
+            else:
+                operation = item.get('operation', 'create')
+                entity = next((key for key in item if key in ENTITIES), None)
+                if not entity:
+                    result = _fault('Unsupported batch item', code='4003')
+                elif operation == 'create':
+                    result = self.create(entity, item[entity])
+                elif operation == 'update':
+                    result = self.update(entity, item[entity])
+                elif operation == 'delete':
+                    with self.lock:
+                        record = self.records[entity].pop(str(item[entity].get('Id')), None)
+                    result = {entity: {'Id': item[entity].get('Id'), 'status': 'Deleted'}} if record else _fault('Object Not Found', code='610')
+                else:
+                    result = _fault('Unsupported operation %s' % operation, code='4003')
+            result.pop('time', None)
+            response.update(result)
+            responses.append(response)
+        return {'BatchItemResponse': responses, 'time': _now()}
+
+    def create_tax_code(self, values):
+        rate_details = []
+        for detail in values.get('TaxRateDetails', []):
+            if detail.get('TaxRateId'):
+                rate = self.records['TaxRate'].get(str(detail['TaxRateId']))
+            else:
+                rate = self.add('TaxRate', {'Name': detail.get('TaxRateName'), 'RateValue': detail.get('RateValue'),
+                                            'AgencyRef': {'value': detail.get('TaxAgencyId')}, 'Active': True})
+            if rate:
+                rate_details.append({'TaxRateId': rate['Id'], 'TaxRateName': rate.get('Name'), 'RateValue': rate.get('RateValue'),
+                                     'TaxAgencyId': _get_path(rate, 'AgencyRef.value'),
+                                     'TaxApplicableOn': detail.get('TaxApplicableOn', 'Sales')})
+        code = self.add('TaxCode', {'Name': values.get('TaxCode'), 'Taxable': True, 'TaxGroup': True, 'Active': True,
+                                    'SalesTaxRateList': {'TaxRateDetail': [{'TaxRateRef': {'value': d['TaxRateId']}} for d in rate_details]},
+                                    'PurchaseTaxRateList': {'TaxRateDetail': []}})
+        return {'TaxCode': code['Name'], 'TaxCodeId': code['Id'], 'TaxRateDetails': rate_details}
+
+    # data generation
+
+    def seed(self, customers=0, vendors=0, items=0, accounts=0, payments=0, terms=0, payment_methods=0, tax_codes=0, sub_customer_ratio=0.1):
+        """Generate a realm of the given size, payments link to invoices 1..payments"""
+        with self.lock:
+            self.records.clear()
+            self.sequence.clear()
+            self.request_ids.clear()
+            self.names.clear()
+        types = [('Bank', 'Checking'), ('Accounts Receivable', 'AccountsReceivable'), ('Income', 'SalesOfProductIncome'),
+                 ('Cost Of Goods Sold', 'SuppliesMaterialsCogs'), ('Other Current Asset', 'Inventory'), ('Expense', 'OfficeGeneralAdministrativeExpenses'),
+                 ('Accounts Payable', 'AccountsPayable'), ('Other Current Liability', 'SalesTaxPayable')]
+        for index in range(max(accounts, len(types))):
+            acc_type, sub_type = types[index % len(types)]
+            name = 'Inventory Asset' if index == 4 else '%s %s' % (acc_type, index + 1)
+            self.add('Account', {'Name': name, 'AcctNum': 'Q%05d' % (index + 1), 'AccountType': acc_type, 'AccountSubType': sub_type,
+                                 'Classification': 'Asset', 'Active': True, 'CurrentBalance': 0})
+        for index in range(max(tax_codes and 1, tax_codes)):
+            agency = self.add('TaxAgency', {'DisplayName': 'Agency %s' % (index + 1), 'TaxTrackedOnSales': True, 'TaxTrackedOnPurchases': False})
+            rate = self.add('TaxRate', {'Name': 'Rate %s' % (index + 1), 'Description': 'Rate %s' % (index + 1), 'RateValue': 5 + index % 10,
+                                        'AgencyRef': {'value': agency['Id']}, 'TaxReturnLineRef': {'value': '8'}, 'Active': True})
+            self.add('TaxCode', {'Name': 'Code %s' % (index + 1), 'Description': 'Code %s' % (index + 1), 'Taxable': True, 'TaxGroup': True,
+                                 'Active': True, 'SalesTaxRateList': {'TaxRateDetail': [{'TaxRateRef': {'value': rate['Id']}}]},
+                                 'PurchaseTaxRateList': {'TaxRateDetail': []}})
+        for index in range(max(payment_methods and 1, payment_methods)):
+            self.add('PaymentMethod', {'Name': 'Method %s' % (index + 1), 'Type': 'NON_CREDIT_CARD', 'Active': True})
+        for index in range(terms):
+            self.add('Term', {'Name': 'Net %s' % ((index + 1) * 5), 'DueDays': (index + 1) * 5, 'Active': True, 'Type': 'STANDARD'})
+        for index in range(customers):
+            record = self._party(index, 'Customer')
+            if index and random.random() < sub_customer_ratio:
+                record.update({'Job': True, 'ParentRef': {'value': str(random.randint(1, index))}})
+            self.add('Customer', record)
+        for index in range(vendors):
+            self.add('Vendor', self._party(index, 'Vendor'))
+        for index in range(items):
+            item_type = ('Service', 'NonInventory', 'Inventory')[index % 3]
+            record = {'Name': 'Item %s' % (index + 1), 'Sku': 'SKU-%06d' % (index + 1), 'Type': item_type, 'Active': True,
+                      'Description': 'Item %s sold by the benchmark' % (index + 1), 'UnitPrice': 10 + index % 90, 'PurchaseCost': 5 + index % 40,
+                      'IncomeAccountRef': {'value': '3'}, 'ExpenseAccountRef': {'value': '4'}}
+            if item_type == 'Inventory':
+                record.update({'TrackQtyOnHand': True, 'QtyOnHand': index % 50, 'AssetAccountRef': {'value': '5'}})
+            self.add('Item', record)
+        for index in range(payments):
+            self.add('Payment', {'TotalAmt': 100.0, 'TxnDate': '2018-01-%02d' % (index % 28 + 1), 'PaymentRefNum': 'REF%s' % (index + 1),
+                                 'CustomerRef': {'value': str(index % max(customers, 1) + 1)}, 'DepositToAccountRef': {'value': '1'},
+                                 'PaymentMethodRef': {'value': '1'},
+                                 'Line': [{'Amount': 100.0, 'LinkedTxn': [{'TxnId': str(index + 1), 'TxnType': 'Invoice'}]}]})
+
+    def _party(self, index, entity):
+        address = {'Line1': '%s Main Street' % (index + 1), 'City': 'Mountain View', 'Country': ('USA', 'Canada', 'India')[index % 3],
+                   'CountrySubDivisionCode': ('CA', 'ON', 'MH')[index % 3], 'PostalCode': '94%03d' % (index % 1000)}
+        record = {'DisplayName': '%s %s' % (entity, index + 1), 'CompanyName': '%s Company %s' % (entity, index + 1), 'Active': True,
+                  'PrimaryEmailAddr': {'Address': '%s%s@example.com' % (entity.lower(), index + 1)},
+                  'PrimaryPhone': {'FreeFormNumber': '(555) 555-%04d' % (index % 10000)},
+                  'WebAddr': {'URI': 'http://example.com/%s' % (index + 1)}, 'BillAddr': dict(address, Id=str(index * 2 + 1))}
+        if entity == 'Customer':
+            record.update({'Job': False, 'Notes': 'Benchmark customer', 'ShipAddr': dict(address, Id=str(index * 2 + 2))})
+        return record
+
+
+class QboMockServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Threaded http server holding the mocked realms and call statistics"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 8099), latency=0, jitter=0, rate=0, max_concurrent=0):
+        HTTPServer.__init__(self, address, QboRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.max_concurrent = max_concurrent
+        self.realms = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://%s:%s/v3/company/' % self.server_address[:2]
+
+    @property
+    def token_url(self):
+        return 'http://%s:%s/oauth2/v1/tokens/bearer' % self.server_address[:2]
+
+    def realm(self, realm_id='1234567890'):
+        with self.lock:
+            if realm_id not in self.realms:
+                self.realms[realm_id] = QboRealm(realm_id)
+            return self.realms[realm_id]
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'throttled': 0, 'by_endpoint': defaultdict(int), 'by_status': defaultdict(int), 'max_in_flight': 0}
+
+    def get_stats(self):
+        with self.lock:
+            stats = copy.deepcopy(self.stats)
+        stats['by_endpoint'] = dict(stats['by_endpoint'])
+        stats['by_status'] = dict(stats['by_status'])
+        return stats
+
+    def record(self, endpoint, status):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['by_endpoint'][endpoint] += 1
+            self.stats['by_status'][str(status)] += 1
+            if status == 429:
+                self.stats['throttled'] += 1
+
+    def admit(self, realm):
+        """Return False when the realm exceeds its rate or concurrency limit"""
+        with self.lock:
+            now = time.time()
+            if self.rate:
+                realm.calls = [stamp for stamp in realm.calls if now - stamp < 60]
+                if len(realm.calls) >= self.rate:
+                    return False
+            if self.max_concurrent and realm.in_flight >= self.max_concurrent:
+                return False
+            realm.calls.append(now)
+            realm.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], realm.in_flight)
+            return True
+
+    def release(self, realm):
+        with self.lock:
+            realm.in_flight -= 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='qbo-mock-server')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class QboRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, endpoint):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('intuit_tid', str(random.getrandbits(64)))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.record(endpoint, status)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        content_type = self.headers.get('Content-Type', '')
+        if 'json' in content_type or raw[:1] in (b'{', b'['):
+            return json.loads(raw.decode('utf-8'))
+        return dict((key, values[0]) for key, values in parse_qs(raw.decode('utf-8')).items())
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        params = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        parts = [part for part in url.path.split('/') if part]
+        server = self.server
+        if parts[:1] == ['_stats']:
+            return self._send(200, server.get_stats(), '_stats')
+        if parts[:1] == ['_reset']:
+            server.reset_stats()
+            return self._send(200, {'status': 'ok'}, '_reset')
+        if parts[:1] == ['_seed']:
+            realm = server.realm(params.pop('realm', '1234567890'))
+            realm.seed(**dict((key, int(value)) for key, value in params.items()))
+            return self._send(200, {'status': 'ok'}, '_seed')
+        if parts[:3] == ['oauth2', 'v1', 'tokens']:
+            body = self._body()
+            if body.get('grant_type') not in ('authorization_code', 'refresh_token'):
+                return self._send(400, {'error': 'unsupported_grant_type'}, 'token')
+            token = 'mock-%s' % random.getrandbits(64)
+            return self._send(200, {'access_token': token, 'refresh_token': 'refresh-%s' % token, 'token_type': 'bearer',
+                                    'expires_in': 3600, 'x_refresh_token_expires_in': 8726400}, 'token')
+        if parts[:2] != ['v3', 'company'] or len(parts) < 4:
+            return self._send(404, _fault('Not found', code='404'), 'unknown')
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send(401, _fault('AuthenticationFailed', code='100', fault_type='AUTHENTICATION'), 'unauthorized')
+
+        realm = server.realm(parts[2])
+        resource = parts[3].lower()
+        endpoint = '%s %s' % (method, resource if resource != 'query' else 'query')
+        if not server.admit(realm):
+            return self._send(429, _fault('message=ThrottleExceeded; errorCode=003001; statusCode=429', code='003001',
+                                          fault_type='SERVICE'), endpoint)
+        try:
+            if server.latency or server.jitter:
+                time.sleep((server.latency + random.uniform(0, server.jitter)) / 1000.0)
+            request_id = params.get('requestid')
+            if method == 'POST' and request_id:
+                with realm.lock:
+                    cached = realm.request_ids.get(request_id)
+                if cached is not None:
+                    return self._send(cached[0], cached[1], endpoint)
+            status, body = self._handle(method, realm, parts[3:], params)
+            if method == 'POST' and request_id:
+                with realm.lock:
+                    realm.request_ids[request_id] = (status, body)
+            return self._send(status, body, endpoint)
+        finally:
+            server.release(realm)
+
+    def _handle(self, method, realm, parts, params):
+        resource = parts[0].lower()
+        if resource == 'query':
+            query = params.get('query') or self._body().get('query', '')
+            response = realm.query(query)
+        elif resource == 'cdc':
+            response = realm.cdc(params.get('entities', ''), params.get('changedSince', (datetime.utcnow() - timedelta(days=30)).isoformat()))
+        elif resource == 'batch':
+            response = realm.batch(self._body().get('BatchItemRequest', []))
+        elif resource == 'taxservice':
+            response = realm.create_tax_code(self._body())
+        else:
+            entity = ENTITY_NAMES.get(resource)
+            if not entity:
+                return 400, _fault('Unsupported resource %s' % resource, code='4004')
+            if method == 'GET':
+                if len(parts) < 2:
+                    return 400, _fault('Id required', code='2020')
+                response = realm.read(entity, parts[1])
+            elif params.get('operation') == 'update':
+                response = realm.update(entity, self._body())
+            else:
+                response = realm.create(entity, self._body())
+        status = 400 if 'Fault' in response else 200
+        return status, response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--realm', default='1234567890')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0, help='random milliseconds added on top of latency')
+    parser.add_argument('--rate', type=int, default=0, help='calls per minute allowed per realm, 0 for unlimited')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='calls in flight allowed per realm, 0 for unlimited')
+    for entity in ('customers', 'vendors', 'items', 'accounts', 'payments', 'terms', 'payment-methods', 'tax-codes'):
+        parser.add_argument('--%s' % entity, type=int, default=0, help='%s to generate' % entity.replace('-', ' '))
+    args = parser.parse_args()
+
+    server = QboMockServer((args.host, args.port), latency=args.latency, jitter=args.jitter, rate=args.rate,
+                           max_concurrent=args.max_concurrent)
+    server.realm(args.realm).seed(customers=args.customers, vendors=args.vendors, items=args.items, accounts=args.accounts,
+                                  payments=args.payments, terms=args.terms, payment_methods=args.payment_methods, tax_codes=args.tax_codes)
+    print('QBO mock server listening on %s (realm %s), token endpoint %s' % (server.url, args.realm, server.token_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
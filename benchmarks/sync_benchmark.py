@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""End-to-end sync benchmark against the local QBO mock server.
+
+Drives ``import_chart_of_accounts``, ``import_customers``, ``import_product``,
+``import_tax``, ``AccountInvoice.export_to_qbo`` and ``import_payment`` of the
+user company against ``qbo_mock_server.py`` at several realm sizes and reports
+records/sec, QBO requests/record, SQL queries/record and peak RSS per stage.
+
+The importers commit their work, run the benchmark on a throwaway database
+with the connector installed::
+
+    python benchmarks/sync_benchmark.py -c odoo.conf -d qbo_bench --scales 1000,10000,100000 --latency 20
+
+Use ``--output results.json`` to keep the measures for comparison between runs.
+Every scale is served by its own realm whose Ids restart at 1, so scales after
+the first one measure the update path of records imported before; use one
+database per scale for create-only figures.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import psutil
+
+import odoo
+from odoo import SUPERUSER_ID, api
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from qbo_mock_server import QboMockServer  # noqa: E402
+
+
+class PeakRss(object):
+    """Sample the process RSS in a background thread and keep the peak"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def run_until_exhausted(company, method, watermark):
+    """Call an import stage page after page until its watermark stops moving"""
+    while True:
+        before = company[watermark]
+        getattr(company, method)()
+        company.invalidate_cache()
+        if company[watermark] == before:
+            break
+
+
+def measure(env, server, scale, stage, records, func):
+    server.reset_stats()
+    queries = env.cr.sql_log_count
+    with PeakRss() as rss:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+    stats = server.get_stats()
+    records = records() if callable(records) else records
+    result = {
+        'scale': scale,
+        'stage': stage,
+        'records': records,
+        'seconds': round(elapsed, 3),
+        'records_per_sec': round(records / elapsed, 2) if elapsed else 0,
+        'requests_per_record': round(stats['requests'] / float(records), 3) if records else 0,
+        'sql_per_record': round((env.cr.sql_log_count - queries) / float(records), 2) if records else 0,
+        'peak_rss_mb': round(rss.peak / (1024.0 * 1024.0), 1),
+        'throttled': stats['throttled'],
+        'requests_by_endpoint': stats['by_endpoint'],
+    }
+    print('%(scale)8s %(stage)-22s %(records)8s rec %(seconds)9.2fs %(records_per_sec)9.1f rec/s '
+          '%(requests_per_record)7.3f req/rec %(sql_per_record)8.2f sql/rec %(peak_rss_mb)8.1f MB' % result)
+    return result
+
+
+def prepare_company(env, server, realm_id):
+    company = env.user.company_id
+    company.write({
+        'url': server.url,
+        'access_token_url': server.token_url,
+        'realm_id': realm_id,
+        'access_token': 'benchmark',
+        'client_id': 'benchmark',
+        'client_secret': 'benchmark',
+        'last_acc_imported_id': '0',
+        'last_imported_customer_id': '0',
+        'last_imported_product_id': '0',
+        'last_imported_tax_id': '0',
+        'last_imported_payment_id': '0',
+    })
+    return company
+
+
+def prepare_payment_journal(env):
+    # seeded payments are deposited to QBO account 1, a bank journal must use it
+    account = env['account.account'].search([('qbo_id', '=', '1')], limit=1)
+    journal = env['account.journal'].search([('type', '=', 'bank')], limit=1)
+    if account and journal:
+        journal.write({'default_debit_account_id': account.id, 'default_credit_account_id': account.id})
+
+
+def create_open_invoices(env, scale):
+    """Create and validate one customer invoice per imported customer, in QBO customer Id order"""
+    partners = env['res.partner'].search([('qbo_customer_id', '!=', False), ('parent_id', '=', False)], limit=scale)
+    partners = partners.sorted(key=lambda p: int(p.qbo_customer_id))
+    product = env['product.product'].search([('qbo_product_id', '!=', False), ('type', '=', 'service')], limit=1)
+    invoices = env['account.invoice']
+    for partner in partners:
+        invoice = invoices.create({
+            'partner_id': partner.id,
+            'type': 'out_invoice',
+            'invoice_line_ids': [(0, 0, {
+                'product_id': product.id,
+                'name': product.name,
+                'quantity': 1,
+                'price_unit': 100.0,
+                'account_id': product.property_account_income_id.id or product.categ_id.property_account_income_categ_id.id,
+            })],
+        })
+        invoices |= invoice
+    invoices.action_invoice_open()
+    env.cr.commit()
+    return invoices
+
+
+def run_scale(registry, server, scale):
+    realm_id = 'bench%s' % scale
+    server.realm(realm_id).seed(customers=scale, items=scale, payments=scale, accounts=20, payment_methods=1,
+                                tax_codes=max(1, scale // 100))
+    results = []
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        company = prepare_company(env, server, realm_id)
+        cr.commit()
+
+        results.append(measure(env, server, scale, 'import_chart_of_accounts', lambda: len(server.realm(realm_id).records['Account']),
+                               lambda: run_until_exhausted(company, 'import_chart_of_accounts', 'last_acc_imported_id')))
+        results.append(measure(env, server, scale, 'import_customers', scale,
+                               lambda: run_until_exhausted(company, 'import_customers', 'last_imported_customer_id')))
+        results.append(measure(env, server, scale, 'import_product', scale,
+                               lambda: run_until_exhausted(company, 'import_product', 'last_imported_product_id')))
+        results.append(measure(env, server, scale, 'import_tax', lambda: len(server.realm(realm_id).records['TaxCode']),
+                               lambda: run_until_exhausted(company, 'import_tax', 'last_imported_tax_id')))
+        cr.commit()
+
+        invoices = create_open_invoices(env, scale)
+        results.append(measure(env, server, scale, 'export_invoice', len(invoices), lambda: invoices.export_to_qbo()))
+        cr.commit()
+
+        prepare_payment_journal(env)
+        results.append(measure(env, server, scale, 'import_payment', scale,
+                               lambda: run_until_exhausted(company, 'import_payment', 'last_imported_payment_id')))
+        cr.commit()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--config', help='odoo configuration file')
+    parser.add_argument('-d', '--database', required=True, help='throwaway database with the connector installed')
+    parser.add_argument('--scales', default='1000,10000,100000', help='comma separated realm sizes')
+    parser.add_argument('--port', type=int, default=8099, help='port of the mock server')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every QBO call')
+    parser.add_argument('--rate', type=int, default=0, help='QBO calls per minute allowed per realm, 0 for unlimited')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='QBO calls in flight allowed per realm, 0 for unlimited')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config] if args.config else [])
+    server = QboMockServer(('127.0.0.1', args.port), latency=args.latency, rate=args.rate, max_concurrent=args.max_concurrent)
+    server.start()
+    registry = odoo.registry(args.database)
+
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(',') if scale]:
+        results.extend(run_scale(registry, server, scale))
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
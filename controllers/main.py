@@ -2,10 +2,12 @@ from odoo import http, _
 from odoo.http import request
 import requests
 import base64
-import json
+import hmac
 import logging
 from datetime import datetime, timedelta
 
+from werkzeug.exceptions import Forbidden
+
 _logger = logging.getLogger(__name__)
 
 class Custom_Quickbook_controller(http.Controller):
@@ -39,7 +41,7 @@ class Custom_Quickbook_controller(http.Controller):
                 
                 access_token = requests.post(quickbook_id.access_token_url,data=payload,headers=headers)
                 if access_token:
-                    parsed_token_response = json.loads(access_token.text)
+                    parsed_token_response = quickbook_id.decode_qbo_response(access_token)
                     if parsed_token_response:
                         quickbook_id.write({
                             'access_token': parsed_token_response.get('access_token'),
@@ -49,4 +51,13 @@ class Custom_Quickbook_controller(http.Controller):
                         })
                         _logger.info(_("Authorized successfully!"))
         return "You can close this window now"
-                    
\ No newline at end of file
+
+    @http.route('/qbo/metrics', type="http", auth="public", csrf=False)
+    def qbo_metrics(self, token=None, **kwarg):
+        '''Export QBO sync runs in the Prometheus text format, enabled by the qbo.metrics_token system parameter'''
+        expected = request.env['ir.config_parameter'].sudo().get_param('qbo.metrics_token')
+        token = token or request.httprequest.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not expected or not hmac.compare_digest(str(token), str(expected)):
+            raise Forbidden()
+        body = request.env['qbo.sync.run'].sudo()._prometheus_text()
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4')])
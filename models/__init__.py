@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
+from . import qbo_sync_mixin
+
 from . import account
 from . import account_payment_term
 from . import account_tax
 from . import product
+from . import qbo_entity_mirror
+from . import qbo_import_plan
+from . import qbo_sync_failure
+from . import qbo_sync_run
 from . import res_company
 from . import res_partner
 
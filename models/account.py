@@ -2,13 +2,41 @@
 import json
 import logging
 
-import requests
-
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import qbo_metrics
 
 _logger = logging.getLogger(__name__)
 
+# default Odoo account type of QBO account types, used when qbo.account.type has no account type
+QBO_ACCOUNT_TYPE_XMLIDS = {
+    'Bank': 'account.data_account_type_liquidity',
+    'Other Current Asset': 'account.data_account_type_non_current_assets',
+    'Fixed Asset': 'account.data_account_type_fixed_assets',
+    'Other Asset': 'account.data_account_type_non_current_assets',
+    'Accounts Receivable': 'account.data_account_type_receivable',
+    'Equity': 'account.data_account_type_equity',
+    'Expense': 'account.data_account_type_expenses',
+    'Other Expense': 'account.data_account_type_expenses',
+    'Cost Of Goods Sold': 'account.data_account_type_direct_costs',
+    'Accounts Payable': 'account.data_account_type_payable',
+    'Credit Card': 'account.data_account_type_credit_card',
+    'Long Term Liability': 'account.data_account_type_non_current_liabilities',
+    'Other Current Liability': 'account.data_account_type_current_liabilities',
+    'Income': 'account.data_account_type_revenue',
+    'Other Income': 'account.data_account_type_other_income',
+}
+# AccountType sent to QBO for QBO account type names
+QBO_ACCOUNT_TYPE_ENUMS = {
+    'Other Expense': 'OtherExpense',
+    'Cost Of Goods Sold': 'CostOfGoodsSold',
+    'CreditCard': 'CreditCard',
+    'Long Term Liability': 'LongTermLiability',
+    'Other Current Liability': 'OtherCurrentLiability',
+    'Other Income': 'OtherIncome',
+}
+
 
 class AccountAccount(models.Model):
     _inherit = "account.account"
@@ -17,6 +45,11 @@ class AccountAccount(models.Model):
     qbo_acc_type = fields.Many2one('qbo.account.type', string="QBO Type", help="QuickBooks account type")
     qbo_acc_subtype = fields.Many2one('qbo.account.subtype', string="QBO Subtype", help="QuickBooks account subtype")
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the account import"""
+        return ['Id', 'Name', 'AcctNum', 'AccountType', 'AccountSubType']
+
     @api.onchange('qbo_acc_type')
     def onchange_qbo_acc_type(self):
         self.qbo_acc_subtype = False
@@ -24,171 +57,180 @@ class AccountAccount(models.Model):
 
     @api.model
     def get_account_ref(self, qbo_account_id):
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-        account = self.search([('qbo_id', '=', qbo_account_id)], limit=1)
+        company = self.env['res.company']._qbo_company()
+        account = self.search([('qbo_id', '=', qbo_account_id)] + company._qbo_company_domain(), limit=1)
         # If account is not created in odoo then import from QBO and create.
         if not account:
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/account/' + qbo_account_id
-            data = requests.request('GET', url, headers=url_str.get('headers'))
+            data = self.env['res.company']._qbo_read_entity('Account', qbo_account_id)
             if data:
                 account = self.create_account_account(data)
         return account.id
 
     @api.model
+    @qbo_metrics.instrument('create_account')
     def create_account_account(self, data):
         """Create account object in odoo
         :param data: account object response return by QBO
         :return int: last import QBO account Id
         """
-        res = json.loads(str(data.text))
-        acc_type = self.env['account.account.type']
-        qbo_acc_type = self.env['qbo.account.type']
-        qbo_acc_subtype = self.env['qbo.account.subtype']
+        type_map = self.env['qbo.account.type'].get_account_type_map()
+        subtype_map = dict((subtype['internal_name'], subtype['id']) for subtype in
+                           self.env['qbo.account.subtype'].search_read([('internal_name', '!=', False)], ['internal_name']))
         acc = False
-        if 'QueryResponse' in res:
-            Account = res.get('QueryResponse').get('Account', [])
-        else:
-            Account = [res.get('Account')] or []
-        for account in Account:
-            # Check for account number in QBO account sync data because it is mapped with code in odoo and which is mandatory field.
-            if not 'AcctNum' in account:
-                raise ValidationError(_("""
-                Enable accounts numbers/assign your account numbers to your Chart of Accounts in QBO.
-                Follow below steps:
+        reconcile_type_ids = self.env['qbo.account.type'].get_reconcile_type_ids()
+        # existing accounts of each chunk of the page are matched by QBO id, then by code, with one read
+        for Account in self.env['res.company'].iter_qbo_entity_chunks(data, 'Account'):
+            existing = self.search(['|', ('code', 'in', [account.get('AcctNum') for account in Account if account.get('AcctNum')]),
+                                    ('qbo_id', 'in', [str(int(account.get('Id'))) for account in Account])] +
+                                   self.env['res.company']._qbo_company_domain())
+            compared_fields = ['qbo_id', 'name', 'code', 'user_type_id', 'qbo_acc_type', 'qbo_acc_subtype', 'reconcile']
+            existing_by_qbo_id = {}
+            existing_by_code = {}
+            for record in existing.read(compared_fields):
+                for field_name in ('user_type_id', 'qbo_acc_type', 'qbo_acc_subtype'):
+                    record[field_name] = record[field_name] and record[field_name][0]
+                if record['qbo_id']:
+                    existing_by_qbo_id[record['qbo_id']] = record
+                existing_by_code.setdefault(record['code'], record)
+
+            for account in Account:
+                # Check for account number in QBO account sync data because it is mapped with code in odoo and which is mandatory field.
+                if not 'AcctNum' in account:
+                    raise ValidationError(_("""
+                    Enable accounts numbers/assign your account numbers to your Chart of Accounts in QBO.
+                    Follow below steps:
                 
-                First, turn on the Setting for using account numbers.
+                    First, turn on the Setting for using account numbers.
 
-                    1. Choose  the Gear icon > Company Settings
-                    2. Choose Advanced from the menu on the left.
-                    3. In the Chart of Accounts section, click on the Edit icon.
-                    4. Place a check mark in the box Enable accounts numbers, and Use account numbers.
-                        Click Save and Done.
+                        1. Choose  the Gear icon > Company Settings
+                        2. Choose Advanced from the menu on the left.
+                        3. In the Chart of Accounts section, click on the Edit icon.
+                        4. Place a check mark in the box Enable accounts numbers, and Use account numbers.
+                            Click Save and Done.
                 
-                Next, assign your account numbers.
+                    Next, assign your account numbers.
                 
-                    1. Choose the Gear icon > Chart of Accounts.
-                    2. Click on the Edit icon on the uppser right hand side.
-                    3. Enter your Account Numbers in blank box (Account numbers can be up to 7-digits long).
-                    4. Click the Save button (Upper right) when you're done with entering your account numbers.
-                """))
-
-            if account.get('AccountType') == 'Bank':
-                brw_acc_type = acc_type.search([('name', '=', 'Bank and Cash')], limit=1)
-            elif account.get('AccountType') == 'Other Current Asset':
-                brw_acc_type = acc_type.search([('name', '=', 'Non-current Assets')], limit=1)
-            elif account.get('AccountType') == 'Fixed Asset':
-                brw_acc_type = acc_type.search([('name', '=', 'Fixed Assets')], limit=1)
-            elif account.get('AccountType') == 'Other Asset':
-                brw_acc_type = acc_type.search([('name', '=', 'Non-current Assets')], limit=1)
-            elif account.get('AccountType') == 'Accounts Receivable':
-                brw_acc_type = acc_type.search([('name', '=', 'Receivable')], limit=1)
-            elif account.get('AccountType') == 'Equity':
-                brw_acc_type = acc_type.search([('name', '=', 'Equity')], limit=1)
-            elif account.get('AccountType') == 'Expense':
-                brw_acc_type = acc_type.search([('name', '=', 'Expenses')], limit=1)
-            elif account.get('AccountType') == 'Other Expense':
-                brw_acc_type = acc_type.search([('name', '=', 'Expenses')], limit=1)
-            elif account.get('AccountType') == 'Cost Of Goods Sold':
-                brw_acc_type = acc_type.search([('name', '=', 'Cost of Revenue')], limit=1)
-            elif account.get('AccountType') == 'Accounts Payable':
-                brw_acc_type = acc_type.search([('name', '=', 'Payable')], limit=1)
-            elif account.get('AccountType') == 'Credit Card':
-                brw_acc_type = acc_type.search([('name', '=', 'Credit Card')], limit=1)
-            elif account.get('AccountType') == 'Long Term Liability':
-                brw_acc_type = acc_type.search([('name', '=', 'Non-current Liabilities')], limit=1)
-            elif account.get('AccountType') == 'Other Current Liability':
-                brw_acc_type = acc_type.search([('name', '=', 'Current Liabilities')], limit=1)
-            elif account.get('AccountType') == 'Income':
-                brw_acc_type = acc_type.search([('name', '=', 'Income')], limit=1)
-            elif account.get('AccountType') == 'Other Income':
-                brw_acc_type = acc_type.search([('name', '=', 'Other Income')], limit=1)
-
-            brw_qbo_acc_type = qbo_acc_type.search([('name', '=', account.get('AccountType'))], limit=1)
-            brw_qbo_acc_subtype = qbo_acc_subtype.search([('internal_name', '=', account.get('AccountSubType'))], limit=1)
-
-            vals = {
-                'qbo_id': int(account.get('Id')),
-                'name': account.get('Name', ''),
-                'code': account.get('AcctNum', ''),
-                'user_type_id': brw_acc_type.id if brw_acc_type else False,
-                'qbo_acc_type': brw_qbo_acc_type.id if brw_qbo_acc_type else False,
-                'qbo_acc_subtype': brw_qbo_acc_subtype.id if brw_qbo_acc_subtype else False,
-                'reconcile': True if brw_acc_type.name == 'Receivable' or brw_acc_type.name == 'Payable' else False,
-            }
-            acc = self.env['account.account'].search(['|', ('code', '=', account.get('AcctNum', '')), ('qbo_id', '=', int(account.get('Id')))],
-                                                     limit=1)
-            #             acc = self.env['account.account'].search([('qbo_id','=',int(account.get('Id')))],limit=1)
-            if not acc:
-                acc = self.env['account.account'].create(vals)
-            else:
-                acc.qbo_acc_subtype = False
-                acc.write(vals)
-
-            _logger.info(_("Account created sucessfully! Account Id: %s" % (acc.id)))
+                        1. Choose the Gear icon > Chart of Accounts.
+                        2. Click on the Edit icon on the uppser right hand side.
+                        3. Enter your Account Numbers in blank box (Account numbers can be up to 7-digits long).
+                        4. Click the Save button (Upper right) when you're done with entering your account numbers.
+                    """))
+
+                acc_type_id, qbo_acc_type_id = type_map.get(account.get('AccountType'), (False, False))
+                vals = {
+                    'qbo_id': int(account.get('Id')),
+                    'name': account.get('Name', ''),
+                    'code': account.get('AcctNum', ''),
+                    'user_type_id': acc_type_id,
+                    'qbo_acc_type': qbo_acc_type_id,
+                    'qbo_acc_subtype': subtype_map.get(account.get('AccountSubType'), False),
+                    'reconcile': acc_type_id in reconcile_type_ids,
+                }
+                record = existing_by_qbo_id.get(str(vals['qbo_id'])) or existing_by_code.get(vals['code'])
+                if not record:
+                    acc = self.create(vals)
+                    existing_by_qbo_id[str(vals['qbo_id'])] = existing_by_code[vals['code']] = dict(vals, id=acc.id, qbo_id=str(vals['qbo_id']))
+                else:
+                    acc = self.browse(record['id'])
+                    changed = dict((key, value) for key, value in vals.items()
+                                   if (str(value) if key == 'qbo_id' else value) != record[key])
+                    if changed:
+                        acc.write(changed)
+                        record.update(changed)
+
+                _logger.info(_("Account created sucessfully! Account Id: %s" % (acc.id)))
         return acc
 
     @api.model
+    @qbo_metrics.instrument('export_account')
     def export_to_qbo(self):
-        """export account to QBO"""
+        """export account to QBO, the selection is validated first then sent through batch requests"""
         if self._context.get('active_ids'):
             accounts = self.env['account.account'].browse(self._context.get('active_ids'))
         else:
             accounts = self
 
-        for account in accounts:
-            vals = {
-                'Name': account.name,
-                'AcctNum': account.code,
-            }
-            if account.qbo_acc_type:
-                if account.qbo_acc_type.name == 'Other Expense':
-                    acc_type = 'OtherExpense'
-                elif account.qbo_acc_type.name == 'Cost Of Goods Sold':
-                    acc_type = 'CostOfGoodsSold'
-                elif account.qbo_acc_type.name == 'CreditCard':
-                    acc_type = 'CreditCard'
-                elif account.qbo_acc_type.name == 'Long Term Liability':
-                    acc_type = 'LongTermLiability'
-                elif account.qbo_acc_type.name == 'Other Current Liability':
-                    acc_type = 'OtherCurrentLiability'
-                elif account.qbo_acc_type.name == 'Other Income':
-                    acc_type = 'OtherIncome'
-                else:
-                    acc_type = account.qbo_acc_type.name
+        quickbook_config = self.env['res.company']._qbo_company()
+        payloads = dict((account.id, account._prepare_qbo_account()) for account in accounts)
 
-                vals.update({'AccountType': acc_type})
-            elif not account.qbo_acc_subtype:
-                raise ValidationError(_("QBO type is required"))
-            if account.qbo_acc_subtype:
-                vals.update({'AccountSubType': account.qbo_acc_subtype.internal_name})
-            elif not account.qbo_acc_type:
-                raise ValidationError(_("QBO subtype is required"))
-            account.send_account_to_qbo(vals)
+        exported = accounts.filtered('qbo_id')
+        qbo_accounts = quickbook_config._qbo_query_by_ids('Account', exported.mapped('qbo_id')) if exported else {}
+        failure = self.env['qbo.sync.failure']
+        batch_items = []
+        for account in accounts:
+            vals = payloads[account.id]
+            if account.qbo_id:
+                qbo_account = qbo_accounts.get(account.qbo_id)
+                if not qbo_account:
+                    error = UserError(_("Account %s not found in QBO with Id %s") % (account.name, account.qbo_id))
+                    failure._record('export_account', account, payload=vals, error=error)
+                    continue
+                vals.update({'Id': account.qbo_id, 'SyncToken': qbo_account.get('SyncToken'), 'sparse': True})
+                operation = 'update'
+            else:
+                operation = 'create'
+            batch_items.append({'bId': str(account.id), 'operation': operation, 'Account': vals})
+
+        request_ids = dict((str(account_id), request_id) for account_id, request_id in
+                           quickbook_config._qbo_request_ids('export_account', accounts).items())
+        responses = quickbook_config._qbo_batch(batch_items, request_ids=request_ids)
+        exported = self.browse()
+        for bid, response in responses.items():
+            account = self.browse(int(bid))
+            qbo_id = response.get('Account', {}).get('Id')
+            if qbo_id:
+                if account.qbo_id != qbo_id:
+                    account.qbo_id = qbo_id
+                exported |= account
+                _logger.info(_("%s exported successfully to QBO" % (account.name)))
+            else:
+                _logger.error(_("%s export failed: %s" % (account.name, quickbook_config._qbo_fault_message(response))))
+                failure._record('export_account', account, payload=payloads[account.id], response=response)
+        failure._resolve('export_account', exported)
+
+    @api.multi
+    def _prepare_qbo_account(self):
+        """Return QBO Account payload of the account"""
+        self.ensure_one()
+        vals = {
+            'Name': self.name,
+            'AcctNum': self.code,
+        }
+        if self.qbo_acc_type:
+            vals.update({'AccountType': QBO_ACCOUNT_TYPE_ENUMS.get(self.qbo_acc_type.name, self.qbo_acc_type.name)})
+        elif not self.qbo_acc_subtype:
+            raise ValidationError(_("QBO type is required"))
+        if self.qbo_acc_subtype:
+            vals.update({'AccountSubType': self.qbo_acc_subtype.internal_name})
+        elif not self.qbo_acc_type:
+            raise ValidationError(_("QBO subtype is required"))
+        return vals
 
     def send_account_to_qbo(self, vals):
         parsed_dict = json.dumps(vals)
-        quickbook_config = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+        quickbook_config = self.env['res.company']._qbo_company()
         if quickbook_config.access_token:
             access_token = quickbook_config.access_token
         if quickbook_config.realm_id:
             realmId = quickbook_config.realm_id
 
         if access_token:
-            headers = {}
-            headers['Authorization'] = 'Bearer ' + str(access_token)
-            headers['Content-Type'] = 'application/json'
+            headers = quickbook_config.get_qbo_headers()
 
-            result = requests.request('POST', quickbook_config.url + str(realmId) + "/account", headers=headers, data=parsed_dict)
+            # only a create is deduplicated by the requestid of the record, an update would get the cached response
+            request_id = not vals.get('Id') and quickbook_config._qbo_request_ids('export_account', self)[self.id]
+            result = self.env['res.company']._qbo_request('POST', quickbook_config.url + str(realmId) + "/account", headers=headers, data=parsed_dict,
+                                                          request_id=request_id or None)
             if result.status_code == 200:
-                response = quickbook_config.convert_xmltodict(result.text)
+                response = quickbook_config.decode_qbo_response(result)
                 # update agency id and last sync id
-                self.qbo_id = response.get('IntuitResponse').get('Account').get('Id')
-                quickbook_config.last_acc_imported_id = response.get('IntuitResponse').get('Account').get('Id')
+                self.qbo_id = response.get('Account').get('Id')
+                self.env['qbo.sync.failure']._resolve('export_account', self)
                 _logger.info(_("%s exported successfully to QBO" % (self.name)))
                 return True
             else:
                 _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
+                self.env['qbo.sync.failure']._record('export_account', self, payload=vals, response=result)
                 raise ValidationError(_("[%s] %s" % (result.status_code, result.reason)))
                 return False
 
@@ -201,6 +243,26 @@ class QBOAccountType(models.Model):
     _desctiption = 'QBO account type'
 
     name = fields.Char('Name', required=True, help='')
+    account_type_id = fields.Many2one('account.account.type', string='Odoo Account Type',
+                                      help="Type of the Odoo accounts imported from QBO accounts of this type")
+
+    @api.model
+    def get_account_type_map(self):
+        """Return (odoo account type id, QBO account type id) by QBO account type name
+        QBO types without configured account type fall back to QBO_ACCOUNT_TYPE_XMLIDS.
+        """
+        type_map = {}
+        for qbo_type in self.search([]):
+            account_type = qbo_type.account_type_id
+            if not account_type and qbo_type.name in QBO_ACCOUNT_TYPE_XMLIDS:
+                account_type = self.env.ref(QBO_ACCOUNT_TYPE_XMLIDS[qbo_type.name], raise_if_not_found=False)
+            type_map[qbo_type.name] = (account_type and account_type.id or False, qbo_type.id)
+        return type_map
+
+    @api.model
+    def get_reconcile_type_ids(self):
+        """Return ids of the Odoo account types whose imported accounts allow reconciliation"""
+        return self.env['account.account.type'].search([('type', 'in', ('receivable', 'payable'))]).ids
 
 
 QBOAccountType()
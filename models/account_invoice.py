@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-import re
-
-import requests
 
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import qbo_metrics
 
 _logger = logging.getLogger(__name__)
 
@@ -19,7 +18,7 @@ class AccountInvoice(models.Model):
     @api.model
     def _prepare_invoice_export_line_dict(self, line):
         #         line = self
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+        company = self.env['res.company']._qbo_company()
         vals = {
             'Description': line.name,
             'Amount': line.price_subtotal,
@@ -29,8 +28,11 @@ class AccountInvoice(models.Model):
                 taxCodeRefValue = 'TAX'
             else:
                 taxCodeRefValue = 'NON'
-        else:
+        elif line.invoice_line_tax_ids:
             taxCodeRefValue = self.env['account.tax'].get_qbo_tax_code(line.invoice_line_tax_ids)
+        else:
+            # untaxed line, default non taxable tax code of the QBO company
+            taxCodeRefValue = company.get_qbo_reference('tax_code')
 
         if self.partner_id.customer:
             vals.update({
@@ -76,52 +78,74 @@ class AccountInvoice(models.Model):
         return vals
 
     @api.model
+    @qbo_metrics.instrument('export_invoice')
     def export_to_qbo(self):
         """export account invoice to QBO"""
-        quickbook_config = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+        quickbook_config = self.env['res.company']._qbo_company()
         if self._context.get('active_ids'):
             invoices = self.browse(self._context.get('active_ids'))
         else:
             invoices = self
 
+        failure = self.env['qbo.sync.failure']
+        exported = self.browse()
+        failed = 0
         for invoice in invoices:
-            if invoice.qbo_invoice_id:
-                raise ValidationError(_("%s invoice is already exported to QBO. Please, export a different invoice."))
-            if invoice.state == 'open':
-                vals = invoice._prepare_invoice_export_dict()
-                parsed_dict = json.dumps(vals)
-                if quickbook_config.access_token:
-                    access_token = quickbook_config.access_token
-                if quickbook_config.realm_id:
-                    realmId = quickbook_config.realm_id
-
-                if access_token:
-                    headers = {}
-                    headers['Authorization'] = 'Bearer ' + str(access_token)
-                    headers['Content-Type'] = 'application/json'
-
-                    if invoice.partner_id.customer:
-                        result = requests.request('POST', quickbook_config.url + str(realmId) + "/invoice", headers=headers, data=parsed_dict)
-                    elif invoice.partner_id.supplier:
-                        result = requests.request('POST', quickbook_config.url + str(realmId) + "/bill", headers=headers, data=parsed_dict)
-
-                    if result.status_code == 200:
-                        response = quickbook_config.convert_xmltodict(result.text)
-                        # update QBO invoice id
-                        if invoice.partner_id.customer:
-                            invoice.qbo_invoice_id = response.get('IntuitResponse').get('Invoice').get('Id')
-                        elif invoice.partner_id.supplier:
-                            invoice.qbo_invoice_id = response.get('IntuitResponse').get('Bill').get('Id')
-                            #                     quickbook_config.last_acc_imported_id = response.get('IntuitResponse').get('Account').get('Id')
-                        _logger.info(_("%s exported successfully to QBO" % (invoice.number)))
-                    #                         return True
-                    else:
-                        _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
-                        raise ValidationError(_("[%s] %s %s" % (result.status_code, result.reason, result.text)))
-                    #                         return False
-            else:
-                raise ValidationError(_("Only open state invoice is exported to QBO."))
+            # a failed invoice is stored as sync failure and rolled back alone, the other invoices are exported
+            try:
+                with self.env.cr.savepoint():
+                    if invoice._export_invoice_to_qbo(quickbook_config):
+                        exported |= invoice
+            except Exception as e:
+                failed += 1
+                failure._record('export_invoice', invoice, payload=getattr(e, 'qbo_payload', None),
+                                response=getattr(e, 'qbo_response', None), error=e)
+        failure._resolve('export_invoice', exported)
+        if failed and not exported:
+            raise UserError(_("%s invoice(s) failed to export to QBO, see QBO Sync Failures for details.") % failed)
+
+    @api.multi
+    def _export_invoice_to_qbo(self, quickbook_config):
+        """Send the invoice or bill to QBO
+        :param quickbook_config: res.company of the QBO realm
+        :return bool: True when the invoice is exported
+        """
+        self.ensure_one()
+        invoice = self
+        if invoice.qbo_invoice_id:
+            raise ValidationError(_("%s invoice is already exported to QBO. Please, export a different invoice.") % invoice.number)
+        if invoice.state != 'open':
+            raise ValidationError(_("Only open state invoice is exported to QBO."))
+        if not quickbook_config.access_token:
+            return False
+        vals = invoice._prepare_invoice_export_dict()
+        parsed_dict = json.dumps(vals)
+        headers = quickbook_config.get_qbo_headers()
+        realmId = quickbook_config.realm_id
+        # a call sent again after a timeout returns the invoice created by the first call
+        request_id = quickbook_config._qbo_request_ids('export_invoice', invoice)[invoice.id]
+        if invoice.partner_id.customer:
+            result = self.env['res.company']._qbo_request('POST', quickbook_config.url + str(realmId) + "/invoice", headers=headers, data=parsed_dict,
+                                                          request_id=request_id)
+        elif invoice.partner_id.supplier:
+            result = self.env['res.company']._qbo_request('POST', quickbook_config.url + str(realmId) + "/bill", headers=headers, data=parsed_dict,
+                                                          request_id=request_id)
+        else:
+            return False
 
+        if result.status_code == 200:
+            response = quickbook_config.decode_qbo_response(result)
+            # update QBO invoice id
+            if invoice.partner_id.customer:
+                invoice.qbo_invoice_id = response.get('Invoice').get('Id')
+            elif invoice.partner_id.supplier:
+                invoice.qbo_invoice_id = response.get('Bill').get('Id')
+            _logger.info(_("%s exported successfully to QBO" % (invoice.number)))
+            return True
+        _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
+        error = ValidationError(_("[%s] %s %s" % (result.status_code, result.reason, result.text)))
+        error.qbo_payload, error.qbo_response = vals, result
+        raise error
 
 AccountInvoice()
 
@@ -136,30 +160,30 @@ class QBOPaymentMethod(models.Model):
                             help="Defines the type of payment. Valid values include CREDIT_CARD or NON_CREDIT_CARD.")
     active = fields.Boolean("Active", default=True)
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the payment method import"""
+        return ['Id', 'Name', 'Type', 'Active']
+
     @api.model
     def get_payment_method_ref(self, qbo_method_id):
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
         method = self.search([('qbo_method_id', '=', qbo_method_id)], limit=1)
         # If account is not created in odoo then import from QBO and create.
         if not method:
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/paymentmethod/' + qbo_method_id
-            data = requests.request('GET', url, headers=url_str.get('headers'))
+            data = self.env['res.company']._qbo_read_entity('PaymentMethod', qbo_method_id)
             if data:
                 method = self.create_payment_method(data)
         return method.id
 
     @api.model
+    @qbo_metrics.instrument('create_payment_method')
     def create_payment_method(self, data):
         """Import payment method from QBO
         :param data: payment method object response return by QBO
         :return qbo.payment.method: qbo payment method object 
         """
-        res = json.loads(str(data.text))
-        if 'QueryResponse' in res:
-            PaymentMethod = res.get('QueryResponse').get('PaymentMethod', [])
-        else:
-            PaymentMethod = [res.get('PaymentMethod')] or []
+        method_obj = False
+        PaymentMethod = self.env['res.company'].iter_qbo_entities(data, 'PaymentMethod')
         for method in PaymentMethod:
             vals = {
                 'name': method.get("Name", ''),
@@ -172,6 +196,7 @@ class QBOPaymentMethod(models.Model):
         return method_obj
 
     @api.model
+    @qbo_metrics.instrument('export_payment_method')
     def export_to_qbo(self):
         """Export payment method to QBO"""
         if self._context.get('method_id'):
@@ -186,35 +211,33 @@ class QBOPaymentMethod(models.Model):
             if method.type:
                 vals.update({'Type': method.type})
             parsed_dict = json.dumps(vals)
-            quickbook_config = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+            quickbook_config = self.env['res.company']._qbo_company()
             if quickbook_config.access_token:
                 access_token = quickbook_config.access_token
             if quickbook_config.realm_id:
                 realmId = quickbook_config.realm_id
 
             if access_token:
-                headers = {}
-                headers['Authorization'] = 'Bearer ' + str(access_token)
-                headers['Content-Type'] = 'application/json'
+                headers = quickbook_config.get_qbo_headers()
 
-                result = requests.request('POST', quickbook_config.url + str(realmId) + "/paymentmethod", headers=headers, data=parsed_dict)
+                # a call sent again after a timeout returns the payment method created by the first call
+                request_id = quickbook_config._qbo_request_ids('export_payment_method', method)[method.id]
+                result = self.env['res.company']._qbo_request('POST', quickbook_config.url + str(realmId) + "/paymentmethod", headers=headers,
+                                                              data=parsed_dict, request_id=request_id)
 
                 if result.status_code == 200:
-                    # response text is either xml string or json string
-                    data = re.sub(r'\s+', '', result.text)
-                    if (re.match(r'^<.+>$', data)):
-                        response = quickbook_config.convert_xmltodict(result.text)
-                        response = response.get('IntuitResponse')
-                    if (re.match(r'^({|[).+(}|])$', data)):
-                        response = json.loads(result.text, encoding='utf-8')
+                    response = quickbook_config.decode_qbo_response(result)
                     if response:
                         # update agency id and last sync id
                         method.qbo_method_id = response.get('PaymentMethod').get('Id')
                         quickbook_config.last_imported_tax_agency_id = response.get('PaymentMethod').get('Id')
 
+                    self.env['qbo.sync.failure']._resolve('export_payment_method', method)
                     _logger.info(_("%s exported successfully to QBO" % (method.name)))
                 else:
                     _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
+                    # a rejected method is sent with the next requestid once it is corrected
+                    self.env['qbo.sync.failure']._record('export_payment_method', method, payload=parsed_dict, response=result)
                     raise ValidationError(_("[%s] %s %s" % (result.status_code, result.reason, result.text)))
 
 
@@ -229,6 +252,16 @@ class AccountPayment(models.Model):
     qbo_payment_ref = fields.Char("QBO Payment Ref", help="QBO payment reference")
     qbo_payment_method_id = fields.Many2one('qbo.payment.method', string="QBO Payment Method", help="QBO Payment Method Reference")
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the payment import
+        :param entity: QBO entity name, Payment or BillPayment
+        :return list: QBO field names, empty list to import all fields
+        """
+        if entity == 'BillPayment':
+            return ['Id', 'TotalAmt', 'TxnDate', 'VendorRef', 'APAccountRef', 'CheckPayment', 'CreditCardPayment', 'Line']
+        return ['Id', 'TotalAmt', 'TxnDate', 'PaymentRefNum', 'CustomerRef', 'PaymentMethodRef', 'DepositToAccountRef', 'Line']
+
     @api.model
     def _prepare_payment_dict(self, payment):
         vals = {
@@ -274,66 +307,83 @@ class AccountPayment(models.Model):
         return vals
 
     @api.model
+    @qbo_metrics.instrument('create_payment')
     def create_payment(self, data, is_customer=False, is_vendor=False):
         """Import payment from QBO
         :param data: payment object response return by QBO
         :return account.payment: account payment object 
         """
-        res = json.loads(str(data.text))
         if is_customer:
-            if 'QueryResponse' in res:
-                Payments = res.get('QueryResponse').get('Payment', [])
-            else:
-                Payments = [res.get('Payment')] or []
+            Payments = self.env['res.company'].iter_qbo_entities(data, 'Payment')
         elif is_vendor:
-            if 'QueryResponse' in res:
-                Payments = res.get('QueryResponse').get('BillPayment', [])
-            else:
-                Payments = [res.get('BillPayment')] or []
+            Payments = self.env['res.company'].iter_qbo_entities(data, 'BillPayment')
+        else:
+            Payments = []
 
         payment_obj = False
+        failure = self.env['qbo.sync.failure']
+        qbo_entity = 'Payment' if is_customer else 'BillPayment'
+        created_ids = []
         for payment in Payments:
-            invoice = False
-            if payment is None:
-                payment = False
-            if payment and 'LinkedTxn' in payment.get('Line')[0]:
-                txn = payment.get('Line')[0].get('LinkedTxn')
-                if txn and (txn[0].get('TxnType') == 'Invoice' or txn[0].get('TxnType') == 'Bill'):
-                    qbo_inv_ref = txn[0].get('TxnId')
-                    invoice = self.env['account.invoice'].search([('qbo_invoice_id', '=', qbo_inv_ref)], limit=1)
-            if not invoice:
+            if not payment:
                 continue
-            vals = self._prepare_payment_dict(payment)
-            vals.update({'communication': invoice.number})
-            if invoice.partner_id.customer:
-                vals.update({'payment_type': 'inbound'})
-                payment_obj = self.search([('qbo_payment_id', '=', payment.get("Id"))], limit=1)
-            elif invoice.partner_id.supplier:
-                vals.update({'payment_type': 'outbound'})
-                payment_obj = self.search([('qbo_bill_payment_id', '=', payment.get("Id"))], limit=1)
-
-            if not payment_obj:
-                if 'journal_id' not in vals:
-                    raise ValidationError(_('Payment Journal required'))
-                    # create payment
-                payment_obj = self.create(vals)
-                payment_obj.post()
-                # get account move line
-            #                 move_ids = self.env['account.move.line'].search([('payment_id','=',payment_obj.id)]).mapped('id')
-            #                 #call assign_outstanding_credit() method by passing account move line ids to link invoice with payment
-            #                 invoice = self.env['account.invoice'].search([('number','=',vals.get('communication'))],limit=1)
-            #                 for move_line_id in move_ids:
-            #                     invoice.assign_outstanding_credit(move_line_id)
-
-
-            #                 invoice.post()
-            #                 invoice._get_outstanding_info_JSON()
-            #                 payment_obj.post()
-
-            #             else:
-            #                 payment_obj.write(vals)
-
-            _logger.info(_("Payment created sucessfully! Payment Id: %s" % (payment_obj.id)))
+            # a failed payment is stored as sync failure and rolled back alone, the import goes on with the next one
+            try:
+                with self.env.cr.savepoint():
+                    payment_obj = self._create_payment_from_qbo(payment) or payment_obj
+                    created_ids.append(payment.get('Id'))
+            except Exception as e:
+                failure._record('create_payment', payload=payment, error=e, qbo_entity=qbo_entity, qbo_id=payment.get('Id'))
+        failure._resolve('create_payment', qbo_entity=qbo_entity, qbo_ids=created_ids)
+        return payment_obj
+
+    @api.model
+    def _create_payment_from_qbo(self, payment):
+        """Create and post the payment of a QBO Payment or BillPayment linked to an exported invoice
+        :param payment: QBO payment dictionary
+        :return account.payment: payment, False when the payment is not linked to an exported invoice
+        """
+        payment_obj = False
+        invoice = False
+        company_domain = self.env['res.company']._qbo_company_domain()
+        if 'LinkedTxn' in payment.get('Line')[0]:
+            txn = payment.get('Line')[0].get('LinkedTxn')
+            if txn and (txn[0].get('TxnType') == 'Invoice' or txn[0].get('TxnType') == 'Bill'):
+                qbo_inv_ref = txn[0].get('TxnId')
+                invoice = self.env['account.invoice'].search([('qbo_invoice_id', '=', qbo_inv_ref)] + company_domain, limit=1)
+        if not invoice:
+            return False
+        vals = self._prepare_payment_dict(payment)
+        vals.update({'communication': invoice.number})
+        if invoice.partner_id.customer:
+            vals.update({'payment_type': 'inbound'})
+            payment_obj = self.search([('qbo_payment_id', '=', payment.get("Id"))] + company_domain, limit=1)
+        elif invoice.partner_id.supplier:
+            vals.update({'payment_type': 'outbound'})
+            payment_obj = self.search([('qbo_bill_payment_id', '=', payment.get("Id"))] + company_domain, limit=1)
+
+        if not payment_obj:
+            if 'journal_id' not in vals:
+                raise ValidationError(_('Payment Journal required'))
+                # create payment
+            payment_obj = self.create(vals)
+            payment_obj.post()
+            # get account move line
+        #                 move_ids = self.env['account.move.line'].search([('payment_id','=',payment_obj.id)]).mapped('id')
+        #                 #call assign_outstanding_credit() method by passing account move line ids to link invoice with payment
+        #                 invoice = self.env['account.invoice'].search([('number','=',vals.get('communication'))],limit=1)
+        #                 for move_line_id in move_ids:
+        #                     invoice.assign_outstanding_credit(move_line_id)
+
+
+        #                 invoice.post()
+        #                 invoice._get_outstanding_info_JSON()
+        #                 payment_obj.post()
+
+        #             else:
+        #                 payment_obj.write(vals)
+
+        _logger.info(_("Payment created sucessfully! Payment Id: %s" % (payment_obj.id)))
         return payment_obj
 
 
@@ -1,9 +1,12 @@
-import json
+import logging
 
-import requests
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 
-from odoo import api, fields, models
+from odoo import api, fields, models, _
+
+from ..tools import qbo_metrics
+
+_logger = logging.getLogger(__name__)
 
 
 class PaymentTermCustomization(models.Model):
@@ -16,78 +19,87 @@ class PaymentTermCustomization(models.Model):
     line_ids = fields.One2many('account.payment.term.line', 'payment_id', string='Terms', copy=True)
 
     @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the payment term import"""
+        return ['Id', 'Name', 'Active', 'DueDays']
+
+    @api.multi
+    def write(self, vals):
+        # terms changed locally are pushed again by the next term sync
+        if 'x_quickbooks_updated' not in vals and set(vals) & set(['name', 'active', 'line_ids']):
+            vals = dict(vals, x_quickbooks_updated=False)
+        return super(PaymentTermCustomization, self).write(vals)
+
+    @api.multi
+    def _get_qbo_due_days(self):
+        """Return days of the balance line, QBO terms have a single due date"""
+        self.ensure_one()
+        balance = self.line_ids.filtered(lambda line: line.value == 'balance')
+        return balance and balance[0].days or 0
+
+    @api.multi
+    def _prepare_qbo_term(self):
+        """Return QBO Term payload of the payment term"""
+        self.ensure_one()
+        vals = {
+            'Name': self.name,
+            'Active': bool(self.active),
+        }
+        due_days = self._get_qbo_due_days()
+        if due_days:
+            vals['DueDays'] = due_days
+        return vals
+
+    @api.multi
+    def _export_terms_to_qbo(self, company):
+        """Create and update payment terms in QBO with batch requests
+        :param company: company connected to QBO
+        """
+        exported = self.filtered(lambda term: term.x_quickbooks_id)
+        qbo_terms = company._qbo_query_by_ids('Term', [str(term.x_quickbooks_id) for term in exported]) if exported else {}
+
+        failure = self.env['qbo.sync.failure']
+        payloads = {}
+        batch_items = []
+        for term in self:
+            vals = payloads[term.id] = term._prepare_qbo_term()
+            if term.x_quickbooks_id:
+                qbo_term = qbo_terms.get(str(term.x_quickbooks_id))
+                if not qbo_term:
+                    error = UserError(_("Payment term %s not found in QBO with Id %s") % (term.name, term.x_quickbooks_id))
+                    failure._record('export_payment_term', term, payload=vals, error=error)
+                    continue
+                vals.update({'Id': str(term.x_quickbooks_id), 'SyncToken': qbo_term.get('SyncToken'), 'sparse': True})
+                operation = 'update'
+            else:
+                operation = 'create'
+            batch_items.append({'bId': str(term.id), 'operation': operation, 'Term': vals})
+
+        request_ids = dict((str(term_id), request_id) for term_id, request_id in
+                           company._qbo_request_ids('export_payment_term', self).items())
+        responses = company._qbo_batch(batch_items, request_ids=request_ids)
+        exported = self.browse()
+        for bid, response in responses.items():
+            term = self.browse(int(bid))
+            if response.get('Term', {}).get('Id'):
+                term.write({
+                    'x_quickbooks_id': int(response.get('Term').get('Id')),
+                    'x_quickbooks_exported': True,
+                    'x_quickbooks_updated': True,
+                })
+                exported |= term
+                _logger.info(_("Payment term exported sucessfully! Payment term Id: %s" % (term.id)))
+            else:
+                _logger.error(_("Payment term %s export failed: %s" % (term.name, company._qbo_fault_message(response))))
+                failure._record('export_payment_term', term, payload=payloads[term.id], response=response)
+        failure._resolve('export_payment_term', exported)
+
+    @api.multi
+    @qbo_metrics.instrument('export_payment_term')
     def export_payment_term_to_quickbooks(self):
-        try:
-            if len(self) > 1:
-                raise ValidationError('Please Select 1 Record to export')
-                return
-            ''' Check self.name if there in quickbooks name field or not '''
-            quickbook_config = self.env['quickbook.config'].search([], limit=1)
-
-            ''' GET ACCESS TOKEN '''
-            access_token = None
-            realmId = None
-            if quickbook_config.access_token:
-                access_token = quickbook_config.access_token
-            if quickbook_config.company_id:
-                realmId = quickbook_config.company_id
-
-            if access_token:
-                headers = {}
-                headers['Authorization'] = 'Bearer ' + str(access_token)
-                headers['Content-Type'] = 'application/json'
-                headers['Accept'] = 'application/json'
-
-                sql_query = "select Id,SyncToken from term Where Id = '{}'".format(self.x_quickbooks_id)
-
-                result = requests.request('GET', quickbook_config.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
-                if result.status_code == 200:
-                    parsed_result = result.json()
-                    if parsed_result.get('QueryResponse'):
-                        if parsed_result.get('QueryResponse').get('Term') and parsed_result.get('QueryResponse').get('Term')[0]:
-                            dict = {}
-                            ''' Record is not present in Quickbooks, Hence we can insert it '''
-                            dict['Name'] = str(self.name)
-
-                            if self.active:
-                                dict['Active'] = "true"
-                            else:
-                                dict['Active'] = "false"
-
-                            payment_term_line = self.env['account.payment.term.line'].search([('payment_id', '=', self.id), ('days', '!=', 0)])
-                            if payment_term_line and payment_term_line.days:
-                                dict['DueDays'] = payment_term_line.days
-
-                            if self.x_quickbooks_id:
-                                dict['Id'] = self.x_quickbooks_id
-                                dict['sparse'] = 'true'
-                                dict['SyncToken'] = parsed_result.get('QueryResponse').get('Term')[0].get('SyncToken')
-                                dict = json.dumps(dict)
-                                result = requests.request('POST', quickbook_config.url + str(realmId) + "/term?operation=update", headers=headers,
-                                                          data=dict)
-                                if result.status_code == 200:
-                                    self.x_quickbooks_updated = True
-
-                        else:
-                            dict = {}
-                            ''' Record is not present in Quickbooks, Hence we can insert it '''
-                            dict['Name'] = str(self.name)
-                            if self.active:
-                                dict['Active'] = "true"
-                            else:
-                                dict['Active'] = "false"
-                            payment_term_line = self.env['account.payment.term.line'].search([('payment_id', '=', self.id), ('days', '!=', 0)])
-                            if payment_term_line and payment_term_line.days:
-                                dict['DueDays'] = payment_term_line.days
-                            dict = json.dumps(dict)
-                            result = requests.request('POST', quickbook_config.url + str(realmId) + "/term", headers=headers, data=dict)
-
-                            if result.status_code == 200:
-                                parsed_result = result.json()
-                                if parsed_result.get('Term').get('Id'):
-                                    self.x_quickbooks_exported = True
-                                    self.x_quickbooks_id = parsed_result.get('Term').get('Id')
-                else:
-                    pass
-        except:
-            raise ValidationError("Exception Occured")
+        """Export selected payment terms to QBO"""
+        company = self.env['res.company']._qbo_company()
+        if not company.access_token:
+            raise ValidationError(_('Invalid access token'))
+        terms = self.browse(self._context.get('active_ids')) if self._context.get('active_ids') else self
+        terms._export_terms_to_qbo(company)
@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import qbo_metrics
 
 _logger = logging.getLogger(__name__)
 
 
 class AccountTax(models.Model):
-    _inherit = "account.tax"
+    _name = "account.tax"
+    _inherit = ["account.tax", "qbo.sync.mixin"]
+    _qbo_sync_fields = ('name', 'description', 'qbo_tax_id', 'qbo_tax_rate_id', 'amount', 'amount_type', 'type_tax_use',
+                        'children_tax_ids', 'tax_agency_id', 'account_id', 'refund_account_id')
 
     qbo_tax_id = fields.Char("QBO Tax Id", copy=False, help="QuickBooks database recordset id")
     qbo_tax_rate_id = fields.Char("QBO Tax Rate Id", copy=False, help="QuickBooks database recordset id")
@@ -29,15 +33,21 @@ class AccountTax(models.Model):
             res['name'].update({'help': help_str})
         return res
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the tax code import"""
+        return ['Id', 'Name', 'Description', 'Taxable', 'TaxGroup', 'SalesTaxRateList', 'PurchaseTaxRateList', 'MetaData']
+
     @api.model
     def get_account_tax_ref(self, qbo_tax_id, name, type_tax_use="none"):
+        company_domain = self.env['res.company']._qbo_company_domain()
         tax = self.search(['&', '|', ('name', '=', name),
                            ('description', '=', name),
-                           ('qbo_tax_id', '=', qbo_tax_id)], limit=1, order="id Desc")
+                           ('qbo_tax_id', '=', qbo_tax_id)] + company_domain, limit=1, order="id Desc")
         if not tax:
             tax = self.search(['&', '|', ('name', '=', name),
                                ('description', '=', name),
-                               ('qbo_tax_rate_id', '=', qbo_tax_id)], limit=1, order="id Desc")
+                               ('qbo_tax_rate_id', '=', qbo_tax_id)] + company_domain, limit=1, order="id Desc")
         if tax:
             return tax.id
         else:
@@ -57,19 +67,28 @@ class AccountTax(models.Model):
                 raise ValidationError(_("Tax not exported to QBO."))
 
     @api.model
+    @qbo_metrics.instrument('create_tax')
     def create_account_tax(self, data):
         """Create account tax object in odoo
         :param data: account tax object response return by QBO
         :return int: last import QBO account tax Id
         """
-        res = json.loads(str(data.text))
         tax_obj = False
-        if 'QueryResponse' in res:
-            taxes = res.get('QueryResponse').get('TaxCode', [])
-        else:
-            taxes = [res.get('TaxCode')] or []
+        company = self.env['res.company']._qbo_company()
+        taxes = self.env['res.company'].iter_qbo_entities(data, 'TaxCode')
+        company_domain = self.env['res.company']._qbo_company_domain()
         for tax in taxes:
             if tax.get('Taxable'):
+                # the rates of a tax code are read with one query, a rate change does not always update the tax code
+                rate_ids = [tax_rate.get('TaxRateRef').get('value')
+                            for rate_list in ('SalesTaxRateList', 'PurchaseTaxRateList')
+                            for tax_rate in (tax.get(rate_list) or {}).get('TaxRateDetail', [])]
+                rates = company._qbo_query_by_ids('TaxRate', rate_ids, qbo_fields=('*',)) if rate_ids else {}
+                tax_objs = self.search([('qbo_tax_id', '=', tax.get('Id')), ('type_tax_use', 'in', ('purchase', 'sale'))] + company_domain)
+                if tax_objs._qbo_is_synced(tax) and tax_objs._qbo_rates_synced(rates):
+                    tax_obj = tax_objs.filtered(lambda t: t.type_tax_use == 'sale')[:1] or tax_objs[:1]
+                    _logger.info(_("Account tax unchanged, skipped! Tax Id: %s" % (tax_obj.id)))
+                    continue
                 vals = {
                     'name': tax.get('Name', ''),
                     'description': tax.get('Description', ''),
@@ -83,67 +102,81 @@ class AccountTax(models.Model):
                     # Make two different taxes for purchase and sale tax scope
                     if tax.get('PurchaseTaxRateList').get('TaxRateDetail', []):
                         for tax_rate in tax.get('PurchaseTaxRateList').get('TaxRateDetail', []):
-                            purchase_tax_rate_ids.append(self.create_tax_rate(tax_rate, type_tax_use='purchase').id)
+                            purchase_tax_rate_ids.append(self.create_tax_rate(tax_rate, type_tax_use='purchase', rates=rates).id)
                             #                             self._cr.commit()
                         vals.update({
                             'type_tax_use': 'purchase',
                             'children_tax_ids': [(6, 0, purchase_tax_rate_ids)],
                         })
-                        tax_obj = self.search([('qbo_tax_id', '=', tax.get('Id')), ('type_tax_use', '=', 'purchase')], limit=1)
+                        sync_vals = self._qbo_sync_vals(tax, vals)
+                        tax_obj = self.search([('qbo_tax_id', '=', tax.get('Id')), ('type_tax_use', '=', 'purchase')] + company_domain, limit=1)
                         if not tax_obj:
-                            tax_obj = self.create(vals)
-                        else:
-                            tax_obj.write(vals)
+                            tax_obj = self.with_context(qbo_import=True).create(sync_vals)
+                        elif not tax_obj._qbo_is_synced(tax, sync_vals):
+                            tax_obj.write(sync_vals)
                         self._cr.commit()
                         _logger.info(_("Account tax created sucessfully! Tax Id: %s" % (tax_obj.id)))
 
                     if tax.get('SalesTaxRateList').get('TaxRateDetail', []):
                         for tax_rate in tax.get('SalesTaxRateList').get('TaxRateDetail', []):
-                            sale_tax_rate_ids.append(self.create_tax_rate(tax_rate, type_tax_use='sale').id)
+                            sale_tax_rate_ids.append(self.create_tax_rate(tax_rate, type_tax_use='sale', rates=rates).id)
                             #                             self._cr.commit()
                         vals.update({
                             'type_tax_use': 'sale',
                             'children_tax_ids': [(6, 0, sale_tax_rate_ids)],
                         })
-                        tax_obj = self.search([('qbo_tax_id', '=', tax.get('Id')), ('type_tax_use', '=', 'sale')], limit=1)
+                        sync_vals = self._qbo_sync_vals(tax, vals)
+                        tax_obj = self.search([('qbo_tax_id', '=', tax.get('Id')), ('type_tax_use', '=', 'sale')] + company_domain, limit=1)
                         if not tax_obj:
-                            tax_obj = self.create(vals)
-                        else:
-                            tax_obj.write(vals)
+                            tax_obj = self.with_context(qbo_import=True).create(sync_vals)
+                        elif not tax_obj._qbo_is_synced(tax, sync_vals):
+                            tax_obj.write(sync_vals)
                         self._cr.commit()
                         _logger.info(_("Account tax created sucessfully! Tax Id: %s" % (tax_obj.id)))
 
         return tax_obj
 
+    @api.multi
+    def _qbo_rates_synced(self, rates):
+        """Return True when the child taxes of tax codes hold the current QBO tax rates
+        :param rates: QBO TaxRate dictionaries by Id
+        """
+        children = self.mapped('children_tax_ids')
+        if set(children.mapped('qbo_tax_rate_id')) != set(rates):
+            return False
+        return all(child._qbo_is_synced(rates[child.qbo_tax_rate_id]) for child in children)
+
     @api.model
-    def create_tax_rate(self, tax_rate, type_tax_use='none'):
-        """Create tax rate in Odoo"""
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
-        url_str = company.get_import_query_url()
-        #         .browse(self._context.get('qbo_config_id')).get_import_query_url()
-        url = url_str.get('url') + '/taxrate/%s' % tax_rate.get('TaxRateRef').get('value')
-        data = requests.request('GET', url, headers=url_str.get('headers'))
-        if data:
-            res = json.loads(str(data.text))
+    def create_tax_rate(self, tax_rate, type_tax_use='none', rates=None):
+        """Create tax rate in Odoo
+        :param tax_rate: TaxRateDetail of a QBO tax code
+        :param rates: QBO TaxRate dictionaries by Id already read, the tax rate is read from QBO when missing
+        """
+        company = self.env['res.company']._qbo_company()
+        rate_id = tax_rate.get('TaxRateRef').get('value')
+        if rates and rate_id in rates:
+            res = {'TaxRate': rates[rate_id]}
+        else:
+            data = self.env['res.company']._qbo_read_entity('TaxRate', rate_id)
+            entities = list(self.env['res.company'].iter_qbo_entities(data, 'TaxRate')) if data else []
+            res = entities and {'TaxRate': entities[0]}
+        if res:
             agency = False
             if 'AgencyRef' in res.get('TaxRate'):
                 agency = self.env['account.tax.agency'].search([('qbo_agency_id', '=', res.get('TaxRate').get('AgencyRef').get('value'))], limit=1)
                 # If tax agency is not created in odoo then import from QBO and create.
                 if not agency:
-                    url_str = company.get_import_query_url()
-                    url = url_str.get('url') + '/taxagency/' + res.get('TaxRate').get('AgencyRef').get('value')
-                    data = requests.request('GET', url, headers=url_str.get('headers'))
+                    data = self.env['res.company']._qbo_read_entity('TaxAgency', res.get('TaxRate').get('AgencyRef').get('value'))
                     if data:
                         agency = self.env['account.tax.agency'].create_account_tax_agency(data)
 
             account = False
             if 'TaxReturnLineRef' in res.get('TaxRate'):
-                account = self.env['account.account'].search([('qbo_id', '=', res.get('TaxRate').get('TaxReturnLineRef').get('value'))], limit=1)
+                account = self.env['account.account'].search([('qbo_id', '=', res.get('TaxRate').get('TaxReturnLineRef').get('value'))] +
+                                                             company._qbo_company_domain(), limit=1)
                 # If account is not created in odoo then import from QBO and create.
                 if not account:
-                    url_str = company.get_import_query_url()
-                    url = url_str.get('url') + '/account/' + res.get('TaxRate').get('TaxReturnLineRef').get('value')
-                    data = requests.request('GET', url, headers=url_str.get('headers'))
+                    data = self.env['res.company']._qbo_read_entity('Account', res.get('TaxRate').get('TaxReturnLineRef').get('value'))
                     if data:
                         account = self.env['account.account'].create_account_account(data)
 
@@ -158,9 +191,12 @@ class AccountTax(models.Model):
                 'account_id': account.id if account else False,
                 'refund_account_id': account.id if account else False,
             }
-            tax_obj = self.search([('qbo_tax_rate_id', '=', res.get('TaxRate').get('Id'))], limit=1)
+            vals = self._qbo_sync_vals(res.get('TaxRate'), vals)
+            tax_obj = self.search([('qbo_tax_rate_id', '=', res.get('TaxRate').get('Id'))] + company._qbo_company_domain(), limit=1)
             if not tax_obj:
-                tax_obj = self.create(vals)
+                tax_obj = self.with_context(qbo_import=True).create(vals)
+            elif tax_obj._qbo_is_synced(res.get('TaxRate'), vals):
+                return tax_obj
             else:
                 tax_obj.write(vals)
 
@@ -170,72 +206,98 @@ class AccountTax(models.Model):
         else:
             _logger.warning(_('Empty data'))
 
-    @api.one
+    @api.multi
+    @qbo_metrics.instrument('export_tax_code')
     def export_tax_code_to_qbo(self):
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
-        tax = self
-        tax_rate_details = []
-        vals = {
-            'TaxCode': tax.name,
-        }
-        if tax.children_tax_ids:
+        """Create composite taxes in QBO as tax codes with their tax rates
+        Payloads of the whole selection are prepared first, then the taxcode calls are sent concurrently.
+        """
+        company = self.env['res.company']._qbo_company()
+        headers = company.get_qbo_headers()
+        url = company.url + str(company.realm_id) + "/taxservice/taxcode"
+
+        # prefetch children taxes and agencies of the whole selection, export missing agencies first
+        children = self.mapped('children_tax_ids').filtered(lambda child: not child.qbo_tax_rate_id)
+        for child_tax in children:
+            if not child_tax.tax_agency_id:
+                raise ValidationError(_("Please select tax agency for %s" % (child_tax.name)))
+        agencies = children.mapped('tax_agency_id').filtered(lambda agency: not agency.qbo_agency_id)
+        if agencies:
+            agencies.with_context(agency_id=True).export_to_qbo()
+
+        payloads = []
+        for tax in self:
+            tax_rate_details = []
             for child_tax in tax.children_tax_ids:
-                # If child tax is not exported in QBO then export first and append return qbo id in tax_rate_ids
+                # If child tax is not exported in QBO then export it with the tax code and map the returned qbo id
                 if child_tax.qbo_tax_rate_id:
                     tax_rate_details.append({'TaxRateId': child_tax.qbo_tax_rate_id})
                 else:
-                    #                     child_tax.get_tax_rate_values(parent_tax = tax)
-                    if not child_tax.tax_agency_id:
-                        raise ValidationError(_("Please select tax agency for %s" % (child_tax.name)))
-                    elif not child_tax.tax_agency_id.qbo_agency_id:
-                        child_tax.tax_agency_id.with_context(agency_id=child_tax.tax_agency_id.id).export_to_qbo()
-
-                    rate_vals = {
+                    tax_rate_details.append({
                         'TaxRateName': child_tax.name,
                         'RateValue': str(child_tax.amount),
                         'TaxAgencyId': child_tax.tax_agency_id.qbo_agency_id,
                         'TaxApplicableOn': 'Sales' if child_tax.type_tax_use == 'sale' else 'Purchase',
-                    }
-                    tax_rate_details.append(rate_vals)
-
-        vals.update({'TaxRateDetails': tax_rate_details})
-        parsed_dict = json.dumps(vals)
-        if company.access_token:
-            access_token = company.access_token
-        if company.realm_id:
-            realmId = company.realm_id
-
-        if access_token:
-            headers = {}
-            headers['Authorization'] = 'Bearer ' + str(access_token)
-            headers['Content-Type'] = 'application/json'
-
-            result = requests.request('POST', company.url + str(realmId) + "/taxservice/taxcode", headers=headers, data=parsed_dict)
-            if result.status_code == 200:
-                if isinstance(result.text, str):
-                    response = company.convert_xmltodict(result.text)
-                    response = response.get('IntuitResponse')
+                    })
+            payloads.append((tax, json.dumps({'TaxCode': tax.name, 'TaxRateDetails': tax_rate_details})))
+
+        # threads only do HTTP, responses are applied with the ORM in this thread, the company fields read by
+        # _qbo_request are loaded first so that the threads only read the cache
+        metrics = qbo_metrics.current()
+        company.read(['realm_id', 'qbo_realm_concurrency'])
+        request_ids = company._qbo_request_ids('export_tax_code', self)
+
+        def send(tax, data):
+            with qbo_metrics.activate(metrics):
+                return company._qbo_request('POST', url, headers=headers, data=data, request_id=request_ids[tax.id])
+
+        failure = self.env['qbo.sync.failure']
+        failed = self.browse()
+        responses = []
+        with ThreadPoolExecutor(max_workers=max(company.qbo_max_concurrency, 1)) as executor:
+            futures = [(tax, data, executor.submit(send, tax, data)) for tax, data in payloads]
+            # a failed call does not drop the responses of the tax codes already created in QBO
+            for tax, data, future in futures:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    _logger.error(_("%s export failed: %s" % (tax.name, e)))
+                    failure._record('export_tax_code', tax, payload=data, error=e)
+                    failed |= tax
+                    continue
+                if result.status_code == 200:
+                    responses.append((tax, company.decode_qbo_response(result)))
                 else:
-                    response = json.loads(result.text, encoding='utf-8')
-                # update agency id and last sync id
-                TaxRateDetails = response.get('TaxRateDetails', [])
-                # iterating over response to map tax rate id to qbo tax rate
-                for taxRate in TaxRateDetails:
-                    tax_rate = self.search(['&', '|', ('name', '=', taxRate.get('TaxRateName')),
-                                            ('description', '=', taxRate.get('TaxRateName')),
-                                            ('qbo_tax_rate_id', '=', False)], limit=1, order="id Desc")
-                    if tax_rate:
-                        tax_rate.ensure_one()
-                        tax_rate.qbo_tax_rate_id = taxRate.get('TaxRateId')
-
-                tax.qbo_tax_id = response.get('TaxCodeId')
-                if company.last_imported_tax_id < response.get('TaxCodeId'):
-                    company.last_imported_tax_id = response.get('TaxCodeId')
-                _logger.info(_("%s exported successfully to QBO" % (tax.name)))
-            else:
-                _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
-                raise ValidationError(_("[%s] %s %s" % (result.status_code, result.reason, result.text)))
-            return result
+                    _logger.error(_("[%s] %s: %s %s" % (result.status_code, tax.name, result.reason, result.text)))
+                    failure._record('export_tax_code', tax, payload=data, response=result)
+                    failed |= tax
+
+        # map returned tax rate ids to the children taxes with one search, latest tax first as before
+        rate_names = [rate.get('TaxRateName') for tax, response in responses for rate in response.get('TaxRateDetails', [])]
+        rate_taxes = {}
+        if rate_names:
+            for rate_tax in self.search([('qbo_tax_rate_id', '=', False), '|', ('name', 'in', rate_names), ('description', 'in', rate_names)] +
+                                        company._qbo_company_domain(),
+                                        order="id desc"):
+                rate_taxes.setdefault(rate_tax.name, rate_tax)
+                if rate_tax.description:
+                    rate_taxes.setdefault(rate_tax.description, rate_tax)
+
+        last_tax_id = int(company.last_imported_tax_id or 0)
+        for tax, response in responses:
+            for taxRate in response.get('TaxRateDetails', []):
+                tax_rate = rate_taxes.pop(taxRate.get('TaxRateName'), False)
+                if tax_rate and not tax_rate.qbo_tax_rate_id:
+                    tax_rate.qbo_tax_rate_id = taxRate.get('TaxRateId')
+            tax.qbo_tax_id = response.get('TaxCodeId')
+            last_tax_id = max(last_tax_id, int(response.get('TaxCodeId')))
+            _logger.info(_("%s exported successfully to QBO" % (tax.name)))
+        if last_tax_id > int(company.last_imported_tax_id or 0):
+            company.last_imported_tax_id = last_tax_id
+        failure._resolve('export_tax_code', self - failed)
+        if failed and not responses:
+            raise UserError(_("%s tax code(s) failed to export to QBO, see QBO Sync Failures for details.") % len(failed))
+        return responses
 
         #     @api.one
         #     def export_tax_rate_to_qbo(self, parent_tax=None):
@@ -294,16 +356,16 @@ class AccountTax(models.Model):
         #             return result
 
     @api.model
+    @qbo_metrics.instrument('export_tax')
     def export_to_qbo(self):
         """Create account tax and tax rate in QBO"""
         #         company = self.env['res.users'].search([('id','=',self._uid)],limit=1).company_id
         acc_taxes = self.env['account.tax'].browse(self._context.get('active_ids'))
         for tax in acc_taxes:
-            if tax.amount_type == 'group':
-                tax.export_tax_code_to_qbo()
-            else:
+            if tax.amount_type != 'group':
                 raise ValidationError(_('''Tax Computation - Group of Taxes exported to QBO with their multiple tax rate.
                 Individual tax rate export API's is not available.'''))
+        acc_taxes.export_tax_code_to_qbo()
 
 
 AccountTax()
@@ -319,16 +381,19 @@ class AccountTaxAgency(models.Model):
     tax_track_on_purchase = fields.Boolean("Tax tracked on purchase", help="Denotes whether this tax agency is used to track tax on purchases.")
 
     @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the tax agency import"""
+        return ['Id', 'DisplayName', 'TaxTrackedOnSales', 'TaxTrackedOnPurchases']
+
+    @api.model
+    @qbo_metrics.instrument('create_tax_agency')
     def create_account_tax_agency(self, data):
         """Create account tax object in odoo
         :param data: account tax object response return by QBO
         :return account.tax.agency: account tax agency object 
         """
-        res = json.loads(str(data.text))
-        if 'QueryResponse' in res:
-            TaxAgency = res.get('QueryResponse').get('TaxAgency', [])
-        else:
-            TaxAgency = [res.get('TaxAgency')] or []
+        agency_obj = False
+        TaxAgency = self.env['res.company'].iter_qbo_entities(data, 'TaxAgency')
         for agency in TaxAgency:
             vals = {
                 'name': agency.get("DisplayName", ''),
@@ -341,6 +406,7 @@ class AccountTaxAgency(models.Model):
         return agency_obj
 
     @api.model
+    @qbo_metrics.instrument('export_tax_agency')
     def export_to_qbo(self):
         """Create account tax agency in QBO"""
         if self._context.get('agency_id'):
@@ -355,34 +421,30 @@ class AccountTaxAgency(models.Model):
                 'TaxTrackedOnPurchases': agency.tax_track_on_purchase,
             }
             parsed_dict = json.dumps(vals)
-            quickbook_config = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+            quickbook_config = self.env['res.company']._qbo_company()
             if quickbook_config.access_token:
                 access_token = quickbook_config.access_token
             if quickbook_config.realm_id:
                 realmId = quickbook_config.realm_id
 
             if access_token:
-                headers = {}
-                headers['Authorization'] = 'Bearer ' + str(access_token)
-                headers['Content-Type'] = 'application/json'
+                headers = quickbook_config.get_qbo_headers()
 
-                result = requests.request('POST', quickbook_config.url + str(realmId) + "/taxagency", headers=headers, data=parsed_dict)
+                result = self.env['res.company']._qbo_request('POST', quickbook_config.url + str(realmId) + "/taxagency", headers=headers, data=parsed_dict,
+                                                              request_id=quickbook_config._qbo_request_ids('export_tax_agency', agency)[agency.id])
 
                 if result.status_code == 200:
-                    # response text is either xml string or json string
-                    if isinstance(result.text, str):
-                        response = quickbook_config.convert_xmltodict(result.text)
-                        response = response.get('IntuitResponse')
-                    else:
-                        response = json.loads(result.text, encoding='utf-8')
+                    response = quickbook_config.decode_qbo_response(result)
 
                     # update agency id and last sync id
                     agency.qbo_agency_id = response.get('TaxAgency').get('Id')
                     quickbook_config.last_imported_tax_agency_id = response.get('TaxAgency').get('Id')
+                    self.env['qbo.sync.failure']._resolve('export_tax_agency', agency)
 
                     _logger.info(_("%s exported successfully to QBO" % (agency.name)))
                 else:
                     _logger.error(_("[%s] %s" % (result.status_code, result.reason)))
+                    self.env['qbo.sync.failure']._record('export_tax_agency', agency, payload=vals, response=result)
                     raise ValidationError(_("[%s] %s %s" % (result.status_code, result.reason, result.text)))
 
 
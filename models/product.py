@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
-import json
 import logging
-from datetime import datetime, date
-
-import requests
+from datetime import date
 
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import qbo_metrics
 
 _logger = logging.getLogger(__name__)
 
@@ -16,15 +15,17 @@ class ProductCategory(models.Model):
 
     qbo_product_category_id = fields.Char("QBO Category Id", copy=False, help="QuickBooks database recordset id")
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the product category import"""
+        return ['Id', 'Name', 'ParentRef', 'IncomeAccountRef', 'ExpenseAccountRef']
+
     @api.model
     def get_category_ref(self, qbo_categ_id):
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
         categ = self.search([('qbo_product_category_id', '=', qbo_categ_id)], limit=1)
         # If account is not created in odoo then import from QBO and create.
         if not categ:
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/item/' + qbo_categ_id + '?minorversion=' + url_str.get('minorversion')
-            data = requests.request('GET', url, headers=url_str.get('headers'))
+            data = self.env['res.company']._qbo_read_entity('Item', qbo_categ_id, minorversion=True)
             if data:
                 categ = self.create_product_category(data)
         if categ.id:
@@ -33,18 +34,15 @@ class ProductCategory(models.Model):
             return False
 
     @api.model
+    @qbo_metrics.instrument('create_product_category')
     def create_product_category(self, data, parent=False):
         """Create product category object in odoo
         :param data: product category object response return by QBO
         :return product.category: product category object
         """
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-        res = json.loads(str(data.text))
+        company = self.env['res.company']._qbo_company()
         categ_obj = False
-        if 'QueryResponse' in res:
-            categories = res.get('QueryResponse').get('Item', [])
-        else:
-            categories = [res.get('Item')] or []
+        categories = self.env['res.company'].iter_qbo_entities(data, 'Item')
         for category in categories:
             if 'ParentRef' in category:
                 categ_id = self.create_category_recursively(category)
@@ -101,11 +99,9 @@ class ProductCategory(models.Model):
             return categ_obj.id
         else:
             # read category object from QBO
-            company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/item/%s' % category.get('ParentRef').get('value')
-            data = requests.request('GET', url, headers=url_str.get('headers'))
-            parent_category = json.loads(str(data.text))
+            data = self.env['res.company']._qbo_read_entity('Item', category.get('ParentRef').get('value'))
+            parent_items = list(self.env['res.company'].iter_qbo_entities(data, 'Item'))
+            parent_category = {'Item': parent_items[0] if parent_items else None}
             self.env.cr.commit()
             # Create sub category
             # check if not category present then create otherwise use the same
@@ -134,39 +130,27 @@ ProductCategory()
 
 
 class Product(models.Model):
-    _inherit = "product.template"
+    _name = "product.template"
+    _inherit = ["product.template", "qbo.sync.mixin"]
+    _qbo_sync_fields = ('name', 'description_sale', 'description_purchase', 'list_price', 'standard_price', 'default_code', 'type',
+                        'active', 'property_account_income_id', 'property_account_expense_id', 'qbo_product_id', 'categ_id',
+                        'taxes_id', 'supplier_taxes_id')
 
     # related to display product product information if is_product_variant
     qbo_product_id = fields.Char('QBO Product Id', related='product_variant_ids.qbo_product_id', help="")
 
     x_is_exported = fields.Boolean('is_exported', default=False)
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the product import"""
+        return ['Id', 'Name', 'Description', 'PurchaseDesc', 'UnitPrice', 'PurchaseCost', 'Sku', 'Type', 'Active',
+                'IncomeAccountRef', 'ExpenseAccountRef', 'ParentRef', 'SalesTaxCodeRef', 'PurchaseTaxCodeRef', 'MetaData']
+
     def get_asset_account_ref(self):
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
-        if company.access_token:
-            access_token = company.access_token
-        if company.realm_id:
-            realmId = company.realm_id
-        if access_token:
-            headers = {}
-            headers['Authorization'] = 'Bearer ' + str(access_token)
-            headers['Content-Type'] = 'application/json'
-            headers['accept'] = 'application/json'
-            result = requests.request('GET',
-                                      company.url + str(realmId) + "/query?query=select name,acctnum from account where Name like 'Inventory Asset'",
-                                      headers=headers)
-            if result.status_code == 200:
-                resp = json.loads(result.text)
-                if resp.get('QueryResponse').get('Account')[0]:
-                    data_dict = {
-                        'name': resp.get('QueryResponse').get('Account')[0].get('Name'),
-                        'value': resp.get('QueryResponse').get('Account')[0].get('Id')
-                    }
-                    return data_dict
-                else:
-                    return False
-            else:
-                return False
+        """Return the Inventory Asset account of the QBO company as {'name', 'value'} dictionary, False when missing"""
+        company = self.env['res.company']._qbo_company()
+        return company.get_qbo_references().get('inventory_asset') or False
 
     @api.model
     def get_qbo_product_ref(self, product):
@@ -176,7 +160,7 @@ class Product(models.Model):
             raise ValidationError(_("Product not exported to QBO."))
 
     def getSyncToken(self, item_id):
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+        company = self.env['res.company']._qbo_company()
 
         # Get SyncToken and of Id
         sql_query = "select Id,SyncToken from item Where Id = '{}'".format(str(item_id))
@@ -193,9 +177,9 @@ class Product(models.Model):
             headers['Content-Type'] = 'application/json'
             headers['accept'] = 'application/json'
 
-        result = requests.request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
+        result = self.env['res.company']._qbo_request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
         if result.status_code == 200:
-            parsed_result = result.json()
+            parsed_result = self.env['res.company'].decode_qbo_response(result)
             if parsed_result.get('QueryResponse') and parsed_result.get('QueryResponse').get('Item'):
                 ''' GET SYNC TOKEN'''
                 syncToken = parsed_result.get('QueryResponse').get('Item')[0].get('SyncToken')
@@ -206,124 +190,116 @@ class Product(models.Model):
             return False
 
     @api.multi
+    def _prepare_qbo_item(self, references):
+        """Return QBO Item payload of the product
+        :param references: well-known QBO references of the company, see res.company.get_qbo_references
+        """
+        self.ensure_one()
+        income_ref = self.property_account_income_id.qbo_id or self.categ_id.property_account_income_categ_id.qbo_id or \
+            (references.get('income_account') or {}).get('value')
+        expense_ref = self.property_account_expense_id.qbo_id or self.categ_id.property_account_expense_categ_id.qbo_id or \
+            (references.get('expense_account') or {}).get('value')
+        if not income_ref:
+            raise ValidationError('Please Set Income Account for {}'.format(self.name))
+        if not expense_ref:
+            raise ValidationError('Please Set Expense Account for {}'.format(self.name))
+        vals = {
+            "Name": self.name,
+            "IncomeAccountRef": {
+                "value": income_ref
+            },
+            "ExpenseAccountRef": {
+                "value": expense_ref
+            },
+            "UnitPrice": self.list_price,
+            "InvStartDate": str(date.today())
+        }
+
+        if self.standard_price:
+            vals.update({'PurchaseCost': self.standard_price})
+
+        if self.description_sale:
+            vals.update({'Description': self.description_sale})
+
+        if self.default_code:
+            vals.update({'Sku': self.default_code})
+
+        if self.description_purchase:
+            vals.update({'PurchaseDesc': self.description_purchase})
+
+        if self.type == "consu":
+            vals.update({'Type': 'NonInventory'})
+
+        if self.type == "service":
+            vals.update({'Type': 'Service'})
+
+        if self.type == "product":
+            vals.update({
+                "QtyOnHand": self.qty_available,
+                'Type': 'Inventory',
+                'TrackQtyOnHand': True
+            })
+            if references.get('inventory_asset'):
+                vals.update({'AssetAccountRef': {'value': references['inventory_asset'].get('value')}})
+
+        if self.categ_id.qbo_product_category_id:
+            vals.update({
+                'SubItem': True,
+                'ParentRef': {
+                    'value': self.categ_id.qbo_product_category_id
+                }
+            })
+        return vals
+
+    @api.multi
+    @qbo_metrics.instrument('export_product')
     def export_product_to_qbo(self):
+        """Export products to QBO, creates and updates are sent through batch requests"""
+        company = self.env['res.company']._qbo_company()
+        # inventory asset and default income/expense accounts of the QBO company
+        references = company.get_qbo_references()
+        # payloads are prepared first so that a product without accounts stops the export before any QBO call
+        payloads = dict((product_id.id, product_id._prepare_qbo_item(references)) for product_id in self)
+
+        exported = self.filtered(lambda product: product.qbo_product_id and product.x_is_exported)
+        items = company._qbo_query_by_ids('Item', exported.mapped('qbo_product_id')) if exported else {}
+
+        failure = self.env['qbo.sync.failure']
+        batch_items = []
         for product_id in self:
-
-            ''' Check If expense and income account is set or not '''
-            if not product_id.property_account_income_id:
-                raise ValidationError('Please Set Income Account for {}'.format(product_id.name))
-                return False
-            if not product_id.property_account_expense_id:
-                raise ValidationError('Please Set Expense Account for {}'.format(product_id.name))
-                return False
-
-            company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
-            d = datetime.strptime(str(date.today()), '%Y-%m-%d')
-            as_of_today = date.strftime(d, "%d/%m/%y")
-            #         Product details to be exported to Quickbooks
-            vals = {
-                "Name": product_id.name,
-                "IncomeAccountRef": {
-                    "value": product_id.property_account_income_id.qbo_id
-
-                },
-                "ExpenseAccountRef": {
-                    "value": product_id.property_account_expense_id.qbo_id
-                },
-
-                "UnitPrice": product_id.list_price,
-
-                "InvStartDate": str(date.today())
-            }
-
-            if product_id.standard_price:
-                vals.update({'PurchaseCost': product_id.standard_price})
-
-            if product_id.description_sale:
-                vals.update({
-                    'Description': product_id.description_sale
-                })
-
-            if product_id.default_code:
-                vals.update({'Sku': product_id.default_code})
-
-            if product_id.description_purchase:
-                vals.update({'PurchaseDesc': product_id.description_purchase})
-
-            if product_id.type == "consu":
-                vals.update({
-                    'Type': 'NonInventory'
-                })
-
-            if product_id.type == "service":
-                vals.update({
-                    'Type': 'Service'
-                })
-
-            if product_id.type == "product":
-
-                # Get quickbooks id of inventory asset COA from odoo
-                inv_asset = self.env['account.account'].search([('name', 'like', 'Inventory Asset')], limit=1)
-                vals.update({
-                    "QtyOnHand": product_id.qty_available,
-                    'Type': 'Inventory',
-                    'TrackQtyOnHand': True
-                })
-                if inv_asset and inv_asset.qbo_id:
-                    vals.update({
-                        'AssetAccountRef': {
-                            'value': inv_asset.qbo_id
-                        }
-                    })
-
-            if product_id.categ_id.qbo_product_category_id:
-                vals.update({
-                    'SubItem': True,
-                    'ParentRef': {
-                        'value': product_id.categ_id.qbo_product_category_id
-                    }
-                })
-
-            if company.access_token:
-                access_token = company.access_token
-            if company.realm_id:
-                realmId = company.realm_id
-            if access_token:
-                print('im innnnnnnnnnnnnnnn:::::::::::::::::::;')
-                headers = {}
-                headers['Authorization'] = 'Bearer ' + str(access_token)
-                headers['Content-Type'] = 'application/json'
-                headers['accept'] = 'application/json'
-
-                if product_id.qbo_product_id and product_id.x_is_exported:
-                    vals.update({'sparse': True})
-                    synctoken = self.getSyncToken(product_id.qbo_product_id)
-
-                    if synctoken:
-                        print('im sync:::::::::::::::::::;')
-                        vals.update({'Id': product_id.qbo_product_id})
-                        vals.update({'SyncToken': synctoken})
-
-                        del vals['QtyOnHand']
-                        parsed_dict = json.dumps(vals)
-                        result = requests.request('POST', company.url + str(realmId) + "/item/?operation=update&minorversion=12", headers=headers,
-                                                  data=parsed_dict)
-
-                else:
-                    print('In Else part')
-                    parsed_dict = json.dumps(vals)
-                    result = requests.request('POST', company.url + str(realmId) + "/item?minorversion=12", headers=headers, data=parsed_dict)
-                    print('\n\n', parsed_dict, result.text, result.status_code)
-
-                if result.status_code == 200:
-                    print('\n\n\n successfully exported')
-                    resp_parsed = json.loads(result.text)
-                    if resp_parsed.get('Item').get('Id'):
-                        ''' Set is_exported to true and add reference of newely created procut in quickbooks'''
-                        product_id.x_is_exported = True
-                        product_id.qbo_product_id = resp_parsed.get('Item').get('Id')
+            vals = payloads[product_id.id]
+            if product_id in exported:
+                item = items.get(product_id.qbo_product_id)
+                if not item:
+                    error = UserError(_("Product %s not found in QBO with Id %s") % (product_id.name, product_id.qbo_product_id))
+                    failure._record('export_product', product_id, payload=vals, error=error)
+                    continue
+                vals.pop('QtyOnHand', None)
+                vals.update({'sparse': True, 'Id': product_id.qbo_product_id, 'SyncToken': item.get('SyncToken')})
+                operation = 'update'
+            else:
+                operation = 'create'
+            batch_items.append({'bId': str(product_id.id), 'operation': operation, 'Item': vals})
+
+        request_ids = dict((str(product_id), request_id) for product_id, request_id in
+                           company._qbo_request_ids('export_product', self).items())
+        responses = company._qbo_batch(batch_items, minorversion=12, request_ids=request_ids)
+        exported = self.browse()
+        for bid, response in responses.items():
+            product_id = self.browse(int(bid))
+            if response.get('Item', {}).get('Id'):
+                ''' Set is_exported to true and add reference of newely created procut in quickbooks'''
+                if not product_id.x_is_exported or product_id.qbo_product_id != response.get('Item').get('Id'):
+                    product_id.write({'x_is_exported': True, 'qbo_product_id': response.get('Item').get('Id')})
+                exported |= product_id
+                _logger.info(_("Product exported sucessfully! Product Id: %s" % (product_id.id)))
+            else:
+                _logger.error(_("Product %s export failed: %s" % (product_id.name, company._qbo_fault_message(response))))
+                failure._record('export_product', product_id, payload=payloads[product_id.id], response=response)
+        failure._resolve('export_product', exported)
 
     @api.model
+    @qbo_metrics.instrument('create_product')
     def create_product(self, data, parent=False):
         """Create product object in odoo
         :param data: product object response return by QBO
@@ -333,13 +309,12 @@ class Product(models.Model):
         tax = self.env['account.tax']
         category = self.env['product.category']
         prod_obj = False
-        res = json.loads(str(data.text))
-        if 'QueryResponse' in res:
-            products = res.get('QueryResponse').get('Item', [])
-        else:
-            products = [res.get('Item')] or []
+        products = self.env['res.company'].iter_qbo_entities(data, 'Item')
+        company_domain = self.env['res.company']._qbo_company_domain(shared=True)
 
         for product in products:
+            # releases the caches filled by the previous products
+            qbo_metrics.checkpoint()
             if product.get('Type') == 'Service' or product.get('Type') == 'Inventory' or product.get('Type') == 'NonInventory':
                 product_type = 'consu'
                 if product.get('Type') == 'NonInventory':
@@ -387,15 +362,20 @@ class Product(models.Model):
                         vals.update({'supplier_taxes_id': [6, 0, [tax_id]]})
 
                 if product.get('Sku'):
-                    prod_obj = self.search(['|', ('default_code', '=', product.get('Sku')), ('qbo_product_id', '=', product.get("Id"))])
+                    prod_obj = self.search(['|', ('default_code', '=', product.get('Sku')), ('qbo_product_id', '=', product.get("Id"))] +
+                                           company_domain)
                 else:
-                    prod_obj = self.search([('qbo_product_id', '=', product.get("Id"))])
+                    prod_obj = self.search([('qbo_product_id', '=', product.get("Id"))] + company_domain)
 
                 if len(prod_obj) > 1:
                     raise ValidationError(_("Found multiple with internal reference %s, expected singleton" % (str([p.name for p in prod_obj]))))
 
+                vals = self._qbo_sync_vals(product, vals)
                 if not prod_obj:
-                    prod_obj = self.create(vals)
+                    prod_obj = self.with_context(qbo_import=True).create(vals)
+                elif prod_obj._qbo_is_synced(product, vals):
+                    _logger.info(_("Product unchanged, skipped! product template Id: %s" % (prod_obj.id)))
+                    continue
                 else:
                     prod_obj.write(vals)
 
@@ -414,6 +394,11 @@ class ProductProduct(models.Model):
 
     qbo_product_id = fields.Char('QBO Product ID', help="Refer to QBO Item Id")
 
+    @api.model
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the inventory import"""
+        return ['Id', 'Type', 'QtyOnHand']
+
 
 ProductProduct()
 
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import logging
+import zlib
+
+import psycopg2
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from ..tools import qbo_metrics
+
+_logger = logging.getLogger(__name__)
+
+# entities written to the mirror table per insert
+QBO_MIRROR_FLUSH_SIZE = 100
+# import method replaying mirrored entities: (odoo model, method, keyword arguments) by QBO entity name
+QBO_MIRROR_REPLAY = {
+    'Customer': ('res.partner', 'create_partner', {'is_customer': True}),
+    'Vendor': ('res.partner', 'create_partner', {'is_vendor': True}),
+    'Item': ('product.template', 'create_product', {}),
+    'Payment': ('account.payment', 'create_payment', {'is_customer': True}),
+    'BillPayment': ('account.payment', 'create_payment', {'is_vendor': True}),
+}
+
+
+class QBOEntityMirror(models.Model):
+    _name = "qbo.entity.mirror"
+    _description = "QBO entity mirror"
+    _order = "id desc"
+
+    company_id = fields.Many2one('res.company', string="Company", required=True, readonly=True, ondelete='cascade')
+    realm_id = fields.Char("Realm Id", readonly=True)
+    entity = fields.Char("Entity", required=True, readonly=True, index=True)
+    qbo_id = fields.Char("QBO Id", required=True, readonly=True, index=True)
+    sync_token = fields.Char("Sync Token", readonly=True)
+    last_updated_time = fields.Char("QBO Last Updated", readonly=True)
+    data = fields.Binary("Data", attachment=False, readonly=True, help="zlib compressed JSON of the QBO entity")
+    content = fields.Text("JSON", compute='_compute_content')
+
+    _sql_constraints = [
+        ('entity_version_uniq', 'unique(company_id, entity, qbo_id, sync_token)', 'A version of a QBO entity is mirrored once.'),
+    ]
+
+    @api.multi
+    def _compute_content(self):
+        for mirror in self:
+            mirror.content = json.dumps(self._decode(mirror.data), indent=2, sort_keys=True) if mirror.data else False
+
+    @api.model
+    def _encode(self, entity):
+        return base64.b64encode(zlib.compress(json.dumps(entity, default=str).encode('utf-8')))
+
+    @api.model
+    def _decode(self, data):
+        return json.loads(zlib.decompress(base64.b64decode(data)).decode('utf-8'))
+
+    @api.model
+    def _mirror_entities(self, company, entity, entities):
+        """Yield QBO entities and store them in the mirror, QBO_MIRROR_FLUSH_SIZE at a time
+        :param company: res.company the entities are fetched from
+        :param entity: QBO entity name
+        :param entities: iterable of QBO entity dictionaries
+        """
+        rows = []
+        for record in entities:
+            rows.append(record)
+            if len(rows) >= QBO_MIRROR_FLUSH_SIZE:
+                self._store(company, entity, rows)
+                rows = []
+            yield record
+        self._store(company, entity, rows)
+
+    @api.model
+    def _store(self, company, entity, records):
+        """Insert QBO entities in the mirror, versions already mirrored are ignored"""
+        records = [record for record in records if record and record.get('Id')]
+        if not records:
+            return
+        values = []
+        for record in records:
+            values += [company.id, company.realm_id, entity, str(record.get('Id')), str(record.get('SyncToken', '')),
+                       (record.get('MetaData') or {}).get('LastUpdatedTime'), psycopg2.Binary(self._encode(record)),
+                       self.env.uid, self.env.uid]
+        self.env.cr.execute("""
+            INSERT INTO qbo_entity_mirror (company_id, realm_id, entity, qbo_id, sync_token, last_updated_time, data,
+                                           create_uid, write_uid, create_date, write_date)
+            VALUES %s
+            ON CONFLICT (company_id, entity, qbo_id, sync_token) DO NOTHING
+        """ % ', '.join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')"] * len(records)),
+            values)
+
+    @api.model
+    def _latest_entities(self, company, entity, qbo_ids):
+        """Return the latest mirrored version of QBO entities by Id, entities missing in the mirror are left out
+        :param company: res.company the entities were fetched from
+        :param entity: QBO entity name
+        :param qbo_ids: QBO ids
+        """
+        qbo_ids = tuple(set(str(qbo_id) for qbo_id in qbo_ids if qbo_id))
+        if not qbo_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (qbo_id) qbo_id, data FROM qbo_entity_mirror
+            WHERE company_id = %s AND entity = %s AND qbo_id IN %s
+            ORDER BY qbo_id, id DESC
+        """, (company.id, entity, qbo_ids))
+        return dict((qbo_id, self._decode(data)) for qbo_id, data in self.env.cr.fetchall())
+
+    @api.model
+    @qbo_metrics.instrument('replay_mirror')
+    def replay(self, entity, company=None, mirror_ids=None):
+        """Run the import of mirrored entities again without calling QBO, the latest version of every entity is replayed
+        Entities referenced by the replayed ones, e.g. parent customers or accounts, are read from the mirror too, the
+        replay fails instead of calling QBO when one is not mirrored.
+        :param entity: QBO entity name, a key of QBO_MIRROR_REPLAY
+        :param company: res.company the entities were fetched from, company of the user by default
+        :param mirror_ids: restrict the replay to the entities of these mirror records
+        :return int: number of replayed entities
+        """
+        if entity not in QBO_MIRROR_REPLAY:
+            raise UserError(_("QBO %s entities can not be replayed.") % entity)
+        company = company or self.env['res.company']._qbo_company()
+        model_name, method, kwargs = QBO_MIRROR_REPLAY[entity]
+        query = "SELECT DISTINCT ON (qbo_id) id, qbo_id FROM qbo_entity_mirror WHERE company_id = %s AND entity = %s"
+        params = [company.id, entity]
+        if mirror_ids:
+            query += " AND qbo_id IN (SELECT qbo_id FROM qbo_entity_mirror WHERE id IN %s)"
+            params.append(tuple(mirror_ids))
+        self.env.cr.execute(query + " ORDER BY qbo_id, id DESC", params)
+        # entities are replayed in QBO Id order like the imports
+        rows = sorted(self.env.cr.fetchall(), key=lambda row: (len(row[1]), row[1]))
+        page_size = company.qbo_page_size if company.qbo_page_size > 0 else 1000
+        for start in range(0, len(rows), page_size):
+            page_ids = [row[0] for row in rows[start:start + page_size]]
+            self.env.cr.execute("SELECT id, data FROM qbo_entity_mirror WHERE id IN %s", (tuple(page_ids),))
+            data = dict(self.env.cr.fetchall())
+            entities = [self._decode(data[mirror_id]) for mirror_id in page_ids]
+            getattr(self.env[model_name].with_context(qbo_company_id=company.id, force_company=company.id, qbo_replay=True),
+                    method)(entities, **kwargs)
+            self.env.cr.commit()
+            _logger.info(_("Replayed %s QBO %s entities from the mirror" % (start + len(page_ids), entity)))
+        return len(rows)
+
+    @api.multi
+    def action_replay(self):
+        """Replay the import of the selected entities"""
+        for company in self.mapped('company_id'):
+            mirrors = self.filtered(lambda mirror: mirror.company_id == company)
+            for entity in set(mirrors.mapped('entity')):
+                self.replay(entity, company=company, mirror_ids=mirrors.filtered(lambda mirror: mirror.entity == entity).ids)
+
+
+QBOEntityMirror()
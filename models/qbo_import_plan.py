@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import traceback
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# import stages of a plan: (res.company method, label, stages it waits for, import watermark field)
+# stages without dependencies run in parallel, a stage without watermark imports everything in one call
+QBO_IMPORT_STAGES = [
+    ('import_customers', 'Customers', [], 'last_imported_customer_id'),
+    # vendors are matched to partners imported as customers, running both at once would duplicate them
+    ('import_vendors', 'Vendors', ['import_customers'], 'last_imported_vendor_id'),
+    ('import_payment_method', 'Payment Methods', [], 'last_imported_payment_method_id'),
+    ('import_payment_term_from_quickbooks', 'Payment Terms', [], False),
+    ('import_tax_agency', 'Tax Agencies', [], 'last_imported_tax_agency_id'),
+    ('import_chart_of_accounts', 'Chart of Accounts', [], 'last_acc_imported_id'),
+    ('import_product_category', 'Product Categories', [], 'last_imported_product_category_id'),
+    ('import_tax', 'Taxes', ['import_tax_agency', 'import_chart_of_accounts'], 'last_imported_tax_id'),
+    ('import_product', 'Products', ['import_product_category', 'import_chart_of_accounts', 'import_tax'], 'last_imported_product_id'),
+    # payments are reconciled with invoices exported from odoo, they only need their partners and accounts
+    ('import_payment', 'Customer Payments', ['import_customers', 'import_payment_method', 'import_chart_of_accounts'],
+     'last_imported_payment_id'),
+    ('import_bill_payment', 'Bill Payments', ['import_vendors', 'import_payment_method', 'import_chart_of_accounts'],
+     'last_imported_bill_payment_id'),
+]
+
+
+class QBOImportPlan(models.Model):
+    _name = "qbo.import.plan"
+    _description = "QBO import plan"
+    _order = "id desc"
+
+    name = fields.Char("Name", required=True, readonly=True, default=lambda self: _('QBO Import'))
+    company_id = fields.Many2one('res.company', string="Company", required=True, readonly=True,
+                                 default=lambda self: self.env['res.company']._qbo_company())
+    user_id = fields.Many2one('res.users', string="User", readonly=True, default=lambda self: self.env.uid)
+    state = fields.Selection([('draft', 'Draft'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')],
+                             string="Status", default='draft', readonly=True)
+    stage_ids = fields.One2many('qbo.import.plan.stage', 'plan_id', string="Stages", readonly=True)
+    date_start = fields.Datetime("Started On", readonly=True)
+    date_end = fields.Datetime("Finished On", readonly=True)
+    records_processed = fields.Integer("Records", compute='_compute_summary')
+    stage_done_count = fields.Integer("Finished Stages", compute='_compute_summary')
+    stage_count = fields.Integer("Stages", compute='_compute_summary')
+
+    @api.multi
+    @api.depends('stage_ids.state', 'stage_ids.records_processed')
+    def _compute_summary(self):
+        for plan in self:
+            plan.records_processed = sum(plan.stage_ids.mapped('records_processed'))
+            plan.stage_done_count = len(plan.stage_ids.filtered(lambda stage: stage.state == 'done'))
+            plan.stage_count = len(plan.stage_ids)
+
+    @api.model
+    def create(self, vals):
+        if not vals.get('stage_ids'):
+            vals['stage_ids'] = [(0, 0, {'name': method, 'label': label, 'sequence': sequence})
+                                 for sequence, (method, label, depends, watermark) in enumerate(QBO_IMPORT_STAGES)]
+        return super(QBOImportPlan, self).create(vals)
+
+    @api.multi
+    def action_start(self):
+        """Dispatch the stages without pending dependencies to cron workers"""
+        for plan in self:
+            if plan.state == 'running':
+                raise UserError(_("The import plan is already running."))
+            # one-shot jobs of a previous run are inactive now
+            plan.stage_ids.mapped('cron_id').sudo().filtered(lambda cron: not cron.active).unlink()
+            plan.stage_ids.filtered(lambda stage: stage.state != 'done').write({
+                'state': 'pending', 'error': False, 'date_start': False, 'date_end': False, 'pages': 0, 'slices': 0, 'records_processed': 0})
+            plan.write({'state': 'running', 'date_start': fields.Datetime.now(), 'date_end': False})
+            plan._dispatch_ready_stages()
+
+    @api.multi
+    def _dispatch_ready_stages(self):
+        """Queue stages whose dependencies are done, cancel stages whose dependencies failed and close finished plans"""
+        self.ensure_one()
+        # serialize stages finishing at the same time so that a stage is queued once
+        self.env.cr.execute("SELECT id FROM qbo_import_plan WHERE id = %s FOR UPDATE", (self.id,))
+        self.invalidate_cache()
+        states = dict((stage.name, stage.state) for stage in self.stage_ids)
+        depends = dict((method, stage_depends) for method, label, stage_depends, watermark in QBO_IMPORT_STAGES)
+        for stage in self.stage_ids.filtered(lambda stage: stage.state == 'pending'):
+            stage_depends = depends.get(stage.name, [])
+            if any(states.get(name) in ('failed', 'cancel') for name in stage_depends):
+                stage.write({'state': 'cancel'})
+                states[stage.name] = 'cancel'
+            elif all(states.get(name, 'done') == 'done' for name in stage_depends):
+                stage._enqueue()
+        if all(stage.state in ('done', 'failed', 'cancel') for stage in self.stage_ids):
+            self.write({
+                'state': 'done' if all(stage.state == 'done' for stage in self.stage_ids) else 'failed',
+                'date_end': fields.Datetime.now(),
+            })
+            _logger.info(_("QBO import plan %s finished: %s" % (self.id, self.state)))
+
+
+QBOImportPlan()
+
+
+class QBOImportPlanStage(models.Model):
+    _name = "qbo.import.plan.stage"
+    _description = "QBO import plan stage"
+    _order = "sequence, id"
+
+    plan_id = fields.Many2one('qbo.import.plan', string="Plan", required=True, ondelete='cascade')
+    name = fields.Char("Method", required=True, help="res.company import method run by the stage")
+    label = fields.Char("Stage")
+    sequence = fields.Integer("Sequence")
+    state = fields.Selection([('pending', 'Pending'), ('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'),
+                              ('failed', 'Failed'), ('cancel', 'Cancelled')], string="Status", default='pending', readonly=True)
+    cron_id = fields.Many2one('ir.cron', string="Job", readonly=True, ondelete='set null')
+    date_start = fields.Datetime("Started On", readonly=True)
+    date_end = fields.Datetime("Finished On", readonly=True)
+    pages = fields.Integer("Pages", readonly=True)
+    slices = fields.Integer("Slices", readonly=True, help="Cron jobs the stage ran in, a stage continues in a new job when its time slice is over.")
+    records_processed = fields.Integer("Records", readonly=True)
+    error = fields.Text("Error", readonly=True)
+
+    @api.multi
+    def _enqueue(self):
+        """Run the stage in a one-shot cron job, cron workers run queued stages in parallel with their own cursor"""
+        model = self.env['ir.model'].sudo().search([('model', '=', self._name)], limit=1)
+        for stage in self:
+            cron = self.env['ir.cron'].sudo().create({
+                'name': 'QBO import: %s (%s)' % (stage.label or stage.name, stage.plan_id.company_id.name),
+                'model_id': model.id,
+                'state': 'code',
+                'code': 'model.browse(%d)._run()' % stage.id,
+                'user_id': stage.plan_id.user_id.id or self.env.uid,
+                'interval_number': 1,
+                'interval_type': 'minutes',
+                'numbercall': 1,
+                'doall': False,
+                'nextcall': fields.Datetime.now(),
+                'active': True,
+            })
+            stage.write({'state': 'queued', 'cron_id': cron.id})
+
+    @api.multi
+    def _run(self):
+        """Import pages of the stage until it is done or its time slice is over, every page is committed
+        A stage whose slice is over is queued again in a new cron job and resumes from the committed watermark,
+        so that no job runs longer than the worker time limit.
+        """
+        self.ensure_one()
+        if self.state != 'queued':
+            return
+        company = self.plan_id.company_id
+        watermark = dict((method, stage_watermark) for method, label, depends, stage_watermark in QBO_IMPORT_STAGES).get(self.name)
+        self.write({'state': 'running', 'date_start': self.date_start or fields.Datetime.now(), 'slices': self.slices + 1})
+        self.env.cr.commit()
+        deadline = time.time() + company.qbo_slice_seconds
+        pages = self.pages
+        finished = False
+        try:
+            while True:
+                before = watermark and company[watermark]
+                getattr(company, self.name)()
+                pages += 1
+                self.write({'pages': pages, 'records_processed': self._count_records()})
+                self.env.cr.commit()
+                company.invalidate_cache()
+                if not watermark or company[watermark] == before:
+                    finished = True
+                    break
+                if company.qbo_slice_seconds > 0 and time.time() >= deadline:
+                    break
+            if finished:
+                self.write({'state': 'done', 'date_end': fields.Datetime.now()})
+            else:
+                _logger.info(_("QBO import stage %s paused after %s pages, resuming in a new job" % (self.name, pages)))
+                self._enqueue()
+        except Exception:
+            self.env.cr.rollback()
+            _logger.exception("QBO import stage %s failed", self.name)
+            self.write({'state': 'failed', 'date_end': fields.Datetime.now(), 'pages': pages, 'error': traceback.format_exc()})
+            finished = True
+        self.env.cr.commit()
+        if finished:
+            self._cleanup_crons()
+            self.plan_id._dispatch_ready_stages()
+            self.env.cr.commit()
+
+    @api.multi
+    def _cleanup_crons(self):
+        """Remove the finished one-shot jobs of the previous slices of the stages"""
+        for stage in self:
+            self.env['ir.cron'].sudo().search([
+                ('active', '=', False), ('code', '=', 'model.browse(%d)._run()' % stage.id), ('id', '!=', stage.cron_id.id),
+            ]).unlink()
+
+    @api.multi
+    def _count_records(self):
+        """Return records processed by the stage according to its sync runs"""
+        self.ensure_one()
+        runs = self.env['qbo.sync.run'].sudo().search([
+            ('company_id', '=', self.plan_id.company_id.id),
+            ('name', '=', self.name.replace('_from_quickbooks', '')),
+            ('date_start', '>=', self.date_start),
+        ])
+        return sum(runs.mapped('records_processed'))
+
+
+QBOImportPlanStage()
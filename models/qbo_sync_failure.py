@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import sys
+import traceback
+
+from odoo import api, fields, models, _
+
+from .res_company import QBO_BATCH_SIZE
+
+_logger = logging.getLogger(__name__)
+
+# retry method of the failures of each sync operation
+QBO_FAILURE_RETRY = {
+    'export_invoice': '_retry_export_invoice',
+    'export_account': '_retry_export_account',
+    'export_partner': '_retry_export_partner',
+    'export_product': '_retry_export_product',
+    'export_tax_code': '_retry_export_tax_code',
+    'export_tax_agency': '_retry_export_tax_agency',
+    'export_payment_term': '_retry_export_payment_term',
+    'export_payment_method': '_retry_export_payment_method',
+    'create_payment': '_retry_create_payment',
+}
+
+
+class QBOSyncFailure(models.Model):
+    _name = "qbo.sync.failure"
+    _description = "QBO sync failure"
+    _order = "id desc"
+
+    name = fields.Char("Operation", required=True, readonly=True, help="Sync operation which failed, e.g. export_invoice.")
+    company_id = fields.Many2one('res.company', string="Company", readonly=True)
+    res_model = fields.Char("Model", readonly=True)
+    res_id = fields.Integer("Record Id", readonly=True)
+    record_name = fields.Char("Record", readonly=True)
+    qbo_entity = fields.Char("QBO Entity", readonly=True)
+    qbo_id = fields.Char("QBO Id", readonly=True, help="Id of the imported QBO entity.")
+    state = fields.Selection([('failed', 'Failed'), ('done', 'Resolved'), ('ignored', 'Ignored')], string="Status", default='failed',
+                             readonly=True)
+    attempts = fields.Integer("Attempts", default=1, readonly=True)
+    request_attempt = fields.Integer("Request Attempt", readonly=True,
+                                     help="Export attempt of the QBO requestid of the next call, raised each time QBO rejects the record.")
+    error_class = fields.Char("Error Class", readonly=True, help="Exception class or QBO fault type.")
+    error = fields.Text("Error", readonly=True)
+    status_code = fields.Integer("HTTP Status", readonly=True)
+    payload = fields.Text("Request Payload", readonly=True, help="JSON sent to QBO or QBO entity being imported.")
+    response = fields.Text("Response Body", readonly=True)
+    date_failed = fields.Datetime("Last Failure", readonly=True)
+    date_done = fields.Datetime("Resolved On", readonly=True)
+
+    @api.model
+    def _record(self, operation, record=None, payload=None, response=None, error=None, qbo_entity=None, qbo_id=None):
+        """Store a failed record in its own transaction so that it survives a rollback of the sync, an open failure
+        of the same record is updated
+        :param operation: sync operation name
+        :param record: odoo record which failed
+        :param payload: request payload or imported entity, dictionary or JSON
+        :param response: requests.Response or QBO batch item response
+        :param error: exception raised by the record
+        :param qbo_entity: QBO entity name of an imported entity
+        :param qbo_id: QBO Id of an imported entity
+        """
+        vals = {
+            'name': operation,
+            'company_id': self.env['res.company']._qbo_company().id,
+            'qbo_entity': qbo_entity,
+            'qbo_id': qbo_id,
+            'date_failed': fields.Datetime.now(),
+            'payload': payload if payload is None or isinstance(payload, str) else json.dumps(payload, default=str),
+        }
+        if record:
+            vals.update({'res_model': record._name, 'res_id': record.id, 'record_name': record.display_name})
+        if isinstance(response, dict):
+            fault = response.get('Fault') or {}
+            vals.update({'response': json.dumps(response), 'error_class': fault.get('type'),
+                         'error': self.env['res.company']._qbo_fault_message(response)})
+        elif response is not None:
+            vals.update({'response': response.text, 'status_code': response.status_code,
+                         'error_class': 'HTTP %s' % response.status_code, 'error': response.reason})
+        if error is not None:
+            # errors built for a record skipped before its QBO call have no traceback
+            trace = traceback.format_exc() if sys.exc_info()[1] is error else ''
+            vals.update({'error_class': type(error).__name__, 'error': '%s\n\n%s' % (error, trace) if trace else '%s' % error})
+        # a rejected call is answered again with the same error when its requestid is sent again,
+        # a call which timed out or failed on QBO side keeps its requestid so that it is not processed twice
+        if isinstance(response, dict):
+            status_code = response.get('status_code') or (400 if response.get('Fault') else 200)
+        else:
+            status_code = response.status_code if response is not None else 0
+        rejected = 400 <= status_code < 500 and status_code != 429
+
+        if record:
+            domain = [('res_model', '=', record._name), ('res_id', '=', record.id)]
+        else:
+            domain = [('qbo_entity', '=', qbo_entity), ('qbo_id', '=', qbo_id)]
+        with self.pool.cursor() as cr:
+            failures = self.with_env(self.env(cr=cr)).sudo()
+            failure = failures.search([('name', '=', operation), ('state', '=', 'failed')] + domain, limit=1)
+            if failure:
+                failure.write(dict(vals, attempts=failure.attempts + 1, request_attempt=failure.request_attempt + int(rejected)))
+            else:
+                request_attempt = failures._request_attempts(operation, record)[record.id] if record else 0
+                failures.create(dict(vals, request_attempt=request_attempt + int(rejected)))
+        _logger.warning(_("QBO %s failed for %s: %s" % (operation, vals.get('record_name') or qbo_id, vals.get('error_class'))))
+
+    @api.model
+    def _resolve(self, operation, records=None, qbo_entity=None, qbo_ids=None):
+        """Mark the open failures of records synced successfully as resolved
+        :param operation: sync operation name
+        :param records: odoo records synced
+        :param qbo_entity: QBO entity name of imported entities
+        :param qbo_ids: QBO ids of imported entities
+        """
+        if records:
+            domain = [('res_model', '=', records._name), ('res_id', 'in', records.ids)]
+        elif qbo_ids:
+            domain = [('qbo_entity', '=', qbo_entity), ('qbo_id', 'in', list(qbo_ids))]
+        else:
+            return
+        if not self.sudo().search_count([('name', '=', operation), ('state', '=', 'failed')] + domain):
+            return
+        with self.pool.cursor() as cr:
+            failures = self.with_env(self.env(cr=cr)).sudo()
+            failures.search([('name', '=', operation), ('state', '=', 'failed')] + domain).write({
+                'state': 'done', 'date_done': fields.Datetime.now()})
+
+    @api.model
+    def _request_attempts(self, operation, records):
+        """Return the export attempt of the QBO requestid of records by record id
+        :param operation: sync operation name
+        :param records: exported records
+        """
+        attempts = dict.fromkeys(records.ids, 0)
+        for failure in self.sudo().search_read([('name', '=', operation), ('res_model', '=', records._name), ('res_id', 'in', records.ids)],
+                                               ['res_id', 'request_attempt']):
+            attempts[failure['res_id']] = max(attempts[failure['res_id']], failure['request_attempt'])
+        return attempts
+
+    @api.multi
+    def action_retry(self):
+        """Send the failed records again, QBO_BATCH_SIZE records of an operation at a time"""
+        failures = self.filtered(lambda failure: failure.state == 'failed')
+        for operation in set(failures.mapped('name')):
+            method = QBO_FAILURE_RETRY.get(operation)
+            if not method:
+                _logger.warning(_("QBO %s failures can not be retried" % operation))
+                continue
+            operation_failures = failures.filtered(lambda failure: failure.name == operation)
+            for start in range(0, len(operation_failures), QBO_BATCH_SIZE):
+                chunk = operation_failures[start:start + QBO_BATCH_SIZE]
+                try:
+                    # failures of the retried records are recorded again by the sync itself
+                    with self.env.cr.savepoint():
+                        getattr(self.env['res.company']._qbo_with_company(chunk), method)()
+                except Exception as e:
+                    _logger.warning(_("QBO %s retry failed: %s" % (operation, e)))
+                self.env.cr.commit()
+
+    @api.multi
+    def action_ignore(self):
+        with self.pool.cursor() as cr:
+            self.with_env(self.env(cr=cr)).sudo().filtered(lambda failure: failure.state == 'failed').write({'state': 'ignored'})
+
+    @api.multi
+    def _retry_records(self):
+        """Return existing records of the failures, failures of deleted records are ignored"""
+        records = self.env[self[0].res_model].browse(self.mapped('res_id')).exists()
+        missing = self.filtered(lambda failure: failure.res_id not in records.ids)
+        if missing:
+            missing.action_ignore()
+        return records
+
+    @api.multi
+    def _retry_export_invoice(self):
+        invoices = self._retry_records()
+        exported = invoices.filtered('qbo_invoice_id')
+        self._resolve('export_invoice', exported)
+        if invoices - exported:
+            (invoices - exported).with_context(active_ids=False).export_to_qbo()
+
+    @api.multi
+    def _retry_export_account(self):
+        accounts = self._retry_records()
+        if accounts:
+            accounts.with_context(active_ids=False).export_to_qbo()
+
+    @api.multi
+    def _retry_export_partner(self):
+        partners = self._retry_records()
+        if partners:
+            partners.export_partners_to_qbo()
+
+    @api.multi
+    def _retry_export_product(self):
+        products = self._retry_records()
+        if products:
+            products.export_product_to_qbo()
+
+    @api.multi
+    def _retry_export_tax_code(self):
+        taxes = self._retry_records()
+        exported = taxes.filtered('qbo_tax_id')
+        if taxes - exported:
+            (taxes - exported).export_tax_code_to_qbo()
+        self._resolve('export_tax_code', taxes.filtered('qbo_tax_id'))
+
+    @api.multi
+    def _retry_export_tax_agency(self):
+        agencies = self._retry_records()
+        exported = agencies.filtered('qbo_agency_id')
+        self._resolve('export_tax_agency', exported)
+        if agencies - exported:
+            (agencies - exported).with_context(agency_id=True).export_to_qbo()
+
+    @api.multi
+    def _retry_export_payment_term(self):
+        terms = self._retry_records()
+        if terms:
+            terms.with_context(active_ids=False).export_payment_term_to_quickbooks()
+
+    @api.multi
+    def _retry_export_payment_method(self):
+        methods = self._retry_records()
+        exported = methods.filtered('qbo_method_id')
+        self._resolve('export_payment_method', exported)
+        if methods - exported:
+            (methods - exported).with_context(method_id=True).export_to_qbo()
+
+    @api.multi
+    def _retry_create_payment(self):
+        for qbo_entity in set(self.mapped('qbo_entity')):
+            failures = self.filtered(lambda failure: failure.qbo_entity == qbo_entity)
+            self.env['account.payment'].create_payment([json.loads(failure.payload) for failure in failures],
+                                                       is_customer=qbo_entity == 'Payment', is_vendor=qbo_entity == 'BillPayment')
+
+
+QBOSyncFailure()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models
+
+from ..tools import qbo_json
+
+
+class QBOSyncMixin(models.AbstractModel):
+    """Sync state of records imported from QBO, re-imports skip the records whose values did not change"""
+    _name = "qbo.sync.mixin"
+    _description = "QBO sync state"
+
+    # fields written by the import, the hash of the last import is only cleared by local changes of these fields
+    _qbo_sync_fields = ()
+
+    qbo_last_updated_time = fields.Char("QBO Last Updated", copy=False, readonly=True,
+                                        help="MetaData.LastUpdatedTime of the QBO entity at the last import")
+    qbo_sync_hash = fields.Char("QBO Sync Hash", copy=False, readonly=True,
+                                help="Hash of the values written by the last import, cleared by local changes")
+
+    @api.model
+    def _qbo_sync_vals(self, entity, vals, extra=None):
+        """Return vals with the sync state of a QBO entity
+        :param entity: QBO entity dictionary
+        :param vals: values mapped from the entity
+        :param extra: other data mapped from the entity, e.g. child records values
+        :return dict: values to create or write
+        """
+        return dict(vals, qbo_last_updated_time=(entity.get('MetaData') or {}).get('LastUpdatedTime') or False,
+                    qbo_sync_hash=qbo_json.digest([vals, extra]))
+
+    @api.multi
+    def _qbo_is_synced(self, entity, sync_vals=None):
+        """Return True when the records already hold the values of a QBO entity
+        :param entity: QBO entity dictionary
+        :param sync_vals: values returned by _qbo_sync_vals, only the QBO timestamp is compared when missing
+        """
+        if not self:
+            return False
+        last_updated = (entity.get('MetaData') or {}).get('LastUpdatedTime')
+        for record in self:
+            if not record.qbo_sync_hash:
+                return False
+            if sync_vals is None:
+                if not last_updated or record.qbo_last_updated_time != last_updated:
+                    return False
+            elif record.qbo_sync_hash != sync_vals.get('qbo_sync_hash'):
+                return False
+        return True
+
+    @api.multi
+    def write(self, vals):
+        # records changed outside of the import are written again by the next import
+        if 'qbo_sync_hash' not in vals and not self.env.context.get('qbo_import') and \
+                set(vals).intersection(self._qbo_sync_fields):
+            vals = dict(vals, qbo_sync_hash=False)
+        return super(QBOSyncMixin, self).write(vals)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+
+from ..tools import qbo_memory, qbo_metrics, qbo_realm_lock
+
+_logger = logging.getLogger(__name__)
+
+
+class QBOSyncRun(models.Model):
+    _name = "qbo.sync.run"
+    _description = "QBO sync run"
+    _order = "id desc"
+
+    name = fields.Char("Stage", required=True, readonly=True, help="Import or export stage, e.g. import_customers.")
+    company_id = fields.Many2one('res.company', string="Company", readonly=True)
+    realm_id = fields.Char("Realm Id", readonly=True, help="QuickBooks company synchronized by the run.")
+    user_id = fields.Many2one('res.users', string="User", readonly=True)
+    state = fields.Selection([('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], string="Status", default='running', readonly=True)
+    date_start = fields.Datetime("Started On", readonly=True)
+    date_end = fields.Datetime("Finished On", readonly=True)
+    duration = fields.Float("Duration (s)", readonly=True)
+    qbo_seconds = fields.Float("QBO Time (s)", readonly=True, help="Time spent waiting for QBO API calls.")
+    decode_seconds = fields.Float("Decode Time (s)", readonly=True, help="Time spent decoding QBO responses.")
+    local_seconds = fields.Float("Odoo Time (s)", readonly=True, help="Time spent in ORM searches, writes and commits.")
+    request_count = fields.Integer("Requests", readonly=True)
+    retry_count = fields.Integer("Retries", readonly=True)
+    error_count = fields.Integer("Failed Requests", readonly=True)
+    records_processed = fields.Integer("Records", readonly=True)
+    sql_count = fields.Integer("SQL Queries", readonly=True)
+    peak_memory_mb = fields.Float("Peak Memory (MB)", readonly=True, help="Highest resident memory of the worker during the run.")
+    memory_releases = fields.Integer("Cache Releases", readonly=True, help="Times the ORM caches were released to bound the worker memory.")
+    latency_histogram = fields.Text("Latency Histogram", readonly=True, help="Request count per latency bucket, JSON encoded.")
+    requests_by_endpoint = fields.Text("Requests By Endpoint", readonly=True, help="JSON encoded.")
+    status_codes = fields.Text("Status Codes", readonly=True, help="JSON encoded.")
+    error = fields.Text("Error", readonly=True)
+
+    @api.model
+    def _write_run(self, run_id, vals):
+        """Create or update a run in its own transaction so that it survives a rollback of the stage
+        :return int: run id
+        """
+        with self.pool.cursor() as cr:
+            run = self.with_env(self.env(cr=cr)).sudo()
+            if run_id:
+                run.browse(run_id).write(vals)
+            else:
+                run_id = run.create(vals).id
+        return run_id
+
+    @api.model
+    @contextmanager
+    def _track_stage(self, stage, records, exclusive=False):
+        """Collect metrics of a sync stage and store them in a run
+        :param stage: stage name
+        :param records: recordset the stage is called on
+        :param exclusive: a single run of the stage at a time per company, another trigger is rejected while it runs
+        """
+        if qbo_metrics.current() is not None:
+            yield qbo_metrics.current()
+            return
+        if records._name == 'res.company' and len(records) == 1:
+            company = records
+        else:
+            company = self.env['res.company']._qbo_company()
+        lock = None
+        if exclusive:
+            lock = qbo_realm_lock.SessionLock(self.env.cr.dbname, 'qbo.run:%s:%s' % (company.id, stage))
+            if not lock.acquire():
+                self._raise_run_in_progress(stage, company)
+        try:
+            if lock is not None:
+                # start from a fresh snapshot, watermarks of the previous run may have been committed after this transaction began
+                self.env.cr.commit()
+                self.env.invalidate_all()
+                # runs left running by a dead worker do not hold the lock any more
+                self._close_interrupted_runs(stage, company)
+            run_id = self._write_run(False, {
+                'name': stage,
+                'company_id': company.id,
+                'realm_id': company.realm_id,
+                'user_id': self.env.uid,
+                'date_start': fields.Datetime.now(),
+            })
+            metrics = qbo_metrics.SyncMetrics()
+            metrics.governor = qbo_memory.MemoryGovernor(self.env, company.qbo_release_records, company.qbo_release_mb)
+            sql_start = self.env.cr.sql_log_count
+            start = time.time()
+            vals = {'state': 'done'}
+            try:
+                with qbo_metrics.activate(metrics):
+                    yield metrics
+                if lock is not None:
+                    # the next run must see the records and watermark of this one once the lock is released
+                    self.env.cr.commit()
+            except Exception as e:
+                vals = {'state': 'failed', 'error': '%s: %s' % (type(e).__name__, e)}
+                raise
+            finally:
+                duration = time.time() - start
+                vals.update({
+                    'date_end': fields.Datetime.now(),
+                    'duration': duration,
+                    'qbo_seconds': metrics.qbo_seconds,
+                    'decode_seconds': metrics.decode_seconds,
+                    'local_seconds': max(duration - metrics.qbo_seconds - metrics.decode_seconds, 0.0),
+                    'request_count': metrics.request_count,
+                    'retry_count': metrics.retry_count,
+                    'error_count': metrics.error_count,
+                    'records_processed': metrics.records_processed,
+                    'sql_count': self.env.cr.sql_log_count - sql_start,
+                    'peak_memory_mb': max(metrics.governor.peak_rss, metrics.governor.sample()),
+                    'memory_releases': metrics.governor.releases,
+                    'latency_histogram': json.dumps(metrics.latency_buckets),
+                    'requests_by_endpoint': json.dumps(metrics.requests_by_endpoint, sort_keys=True),
+                    'status_codes': json.dumps(metrics.status_codes, sort_keys=True),
+                })
+                self._write_run(run_id, vals)
+                _logger.info(_("QBO %s %s: %s records, %s requests in %.2fs, peak memory %.0f MB") % (
+                    stage, vals['state'], metrics.records_processed, metrics.request_count, duration, vals['peak_memory_mb']))
+        finally:
+            if lock is not None:
+                lock.release()
+
+    @api.model
+    def _raise_run_in_progress(self, stage, company):
+        run = self.sudo().search([('name', '=', stage), ('company_id', '=', company.id), ('state', '=', 'running')], limit=1)
+        if run:
+            raise UserError(_("QBO %s is already running for %s since %s (started by %s), wait for the run to finish.") % (
+                stage, company.name, run.date_start, run.user_id.name))
+        raise UserError(_("QBO %s is already running for %s, wait for the run to finish.") % (stage, company.name))
+
+    @api.model
+    def _close_interrupted_runs(self, stage, company):
+        """Fail the runs of a stage still marked running while nobody holds its lock"""
+        runs = self.sudo().search([('name', '=', stage), ('company_id', '=', company.id), ('state', '=', 'running')])
+        for run in runs:
+            self._write_run(run.id, {'state': 'failed', 'error': _('Interrupted'), 'date_end': fields.Datetime.now()})
+
+    @api.model
+    def _prometheus_text(self):
+        """Return finished runs aggregated per realm and stage in the Prometheus text exposition format"""
+        groups = defaultdict(lambda: {
+            'runs': 0, 'duration': 0.0, 'qbo_seconds': 0.0, 'records': 0, 'sql': 0, 'retries': 0,
+            'buckets': [0] * (len(qbo_metrics.LATENCY_BUCKETS) + 1), 'endpoints': defaultdict(int), 'statuses': defaultdict(int),
+        })
+        runs = self.search_read([('state', '!=', 'running')], ['name', 'realm_id', 'duration', 'qbo_seconds', 'records_processed', 'sql_count',
+                                                               'retry_count', 'latency_histogram', 'requests_by_endpoint', 'status_codes'])
+        for run in runs:
+            group = groups[(run['realm_id'] or '', run['name'])]
+            group['runs'] += 1
+            group['duration'] += run['duration']
+            group['qbo_seconds'] += run['qbo_seconds']
+            group['records'] += run['records_processed']
+            group['sql'] += run['sql_count']
+            group['retries'] += run['retry_count']
+            for index, count in enumerate(json.loads(run['latency_histogram'] or '[]')):
+                group['buckets'][index] += count
+            for endpoint, count in json.loads(run['requests_by_endpoint'] or '{}').items():
+                group['endpoints'][endpoint] += count
+            for status, count in json.loads(run['status_codes'] or '{}').items():
+                group['statuses'][status] += count
+
+        def labels(key, **extra):
+            values = [('realm', key[0]), ('stage', key[1])] + sorted(extra.items())
+            return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in values)
+
+        lines = []
+        counters = [
+            ('qbo_sync_runs_total', 'Finished QBO sync runs.', 'runs'),
+            ('qbo_sync_duration_seconds_total', 'Wall time of QBO sync runs.', 'duration'),
+            ('qbo_sync_records_total', 'Records processed by QBO sync runs.', 'records'),
+            ('qbo_sync_sql_queries_total', 'SQL queries executed by QBO sync runs.', 'sql'),
+            ('qbo_request_retries_total', 'Retried QBO API calls.', 'retries'),
+        ]
+        for metric, help_text, field in counters:
+            lines += ['# HELP %s %s' % (metric, help_text), '# TYPE %s counter' % metric]
+            lines += ['%s{%s} %s' % (metric, labels(key), group[field]) for key, group in sorted(groups.items())]
+        lines += ['# HELP qbo_requests_total QBO API calls per endpoint.', '# TYPE qbo_requests_total counter']
+        for key, group in sorted(groups.items()):
+            lines += ['qbo_requests_total{%s} %s' % (labels(key, endpoint=endpoint), count) for endpoint, count in sorted(group['endpoints'].items())]
+        lines += ['# HELP qbo_responses_total QBO API responses per status code.', '# TYPE qbo_responses_total counter']
+        for key, group in sorted(groups.items()):
+            lines += ['qbo_responses_total{%s} %s' % (labels(key, status=status), count) for status, count in sorted(group['statuses'].items())]
+        lines += ['# HELP qbo_request_duration_seconds Latency of QBO API calls.', '# TYPE qbo_request_duration_seconds histogram']
+        for key, group in sorted(groups.items()):
+            cumulative = 0
+            for bound, count in zip(list(qbo_metrics.LATENCY_BUCKETS) + ['+Inf'], group['buckets']):
+                cumulative += count
+                lines.append('qbo_request_duration_seconds_bucket{%s} %s' % (labels(key, le=bound), cumulative))
+            lines.append('qbo_request_duration_seconds_sum{%s} %s' % (labels(key), group['qbo_seconds']))
+            lines.append('qbo_request_duration_seconds_count{%s} %s' % (labels(key), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+QBOSyncRun()
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import base64
+import itertools
 import json
 import logging
+import time
 from datetime import datetime, timedelta
 
 import requests
@@ -9,10 +11,52 @@ import xmltodict
 from xmltodict import ParsingInterrupted
 
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+
+from ..tools import qbo_cache, qbo_http, qbo_json, qbo_metrics, qbo_realm_lock
 
 _logger = logging.getLogger(__name__)
 
+# operations per QBO batch call, limit of the batch endpoint
+QBO_BATCH_SIZE = 30
+# ids per Id IN query
+QBO_QUERY_IN_SIZE = 500
+# entities of a page matched against odoo records at once, bounds the memory of a page while it is streamed
+QBO_IMPORT_CHUNK_SIZE = 200
+# AccountSubType and default QBO name of the well-known accounts used by exports
+QBO_REFERENCE_ACCOUNT_SUBTYPES = {
+    'inventory_asset': 'Inventory',
+    'income_account': 'SalesOfProductIncome',
+    'expense_account': 'SuppliesMaterialsCogs',
+}
+QBO_REFERENCE_ACCOUNT_NAMES = {
+    'inventory_asset': 'Inventory Asset',
+    'income_account': 'Sales of Product Income',
+    'expense_account': 'Cost of Goods Sold',
+}
+# incremental exports in dependency order: (odoo model, export watermark field, sync failure operation, export method,
+# SQL condition of the exported records)
+QBO_EXPORT_MODELS = [
+    ('account.account', 'last_exported_account_date', 'export_account', 'export_to_qbo',
+     "company_id = %(company)s AND (qbo_acc_type IS NOT NULL OR qbo_acc_subtype IS NOT NULL)"),
+    # QBO tax codes can not be updated, only new group taxes are exported
+    ('account.tax', 'last_exported_tax_date', 'export_tax_code', 'export_tax_code_to_qbo',
+     "company_id = %(company)s AND amount_type = 'group' AND qbo_tax_id IS NULL"),
+    # invoice and delivery addresses are exported with their partner, contacts only once they are linked to QBO
+    ('res.partner', 'last_exported_partner_date', 'export_partner', 'export_partners_to_qbo',
+     "customer AND active AND COALESCE(type, 'contact') NOT IN ('invoice', 'delivery') "
+     "AND (parent_id IS NULL OR qbo_customer_id IS NOT NULL) AND (company_id = %(company)s OR company_id IS NULL)"),
+    ('product.template', 'last_exported_product_date', 'export_product', 'export_product_to_qbo',
+     "active AND (company_id = %(company)s OR company_id IS NULL)"),
+    ('account.invoice', 'last_exported_invoice_date', 'export_invoice', 'export_to_qbo',
+     "company_id = %(company)s AND state = 'open' AND qbo_invoice_id IS NULL AND type IN ('out_invoice', 'in_invoice')"),
+]
+# records per export call of the incremental export, a failed call only fails its records
+QBO_EXPORT_CHUNK_SIZE = 500
+# seconds the next incremental export looks back before the watermark, covers records committed by transactions which
+# were still running when the export selected the changed records, they are sent again as idempotent updates
+QBO_EXPORT_OVERLAP = 600
+
 
 class ResCompany(models.Model):
     _inherit = "res.company"
@@ -21,15 +65,379 @@ class ResCompany(models.Model):
     def convert_xmltodict(self, response):
         """Return dictionary object"""
         try:
-            # convert xml response to OrderedDict collections, return collections.OrderedDict type
-            order_dict = xmltodict.parse(response)
+            # convert xml response directly to regular dictionary objects
+            response_dict = xmltodict.parse(response, dict_constructor=dict)
         except ParsingInterrupted as e:
             _logger.error(e)
             raise e
-        # convert OrderedDict to regular dictionary object
-        response_dict = json.loads(json.dumps(order_dict))
         return response_dict
 
+    @api.model
+    def decode_qbo_response(self, response):
+        """Return dictionary object of a QBO JSON response, parsed from the raw body bytes"""
+        start = time.time()
+        try:
+            return qbo_json.decode_response(response)
+        finally:
+            metrics = qbo_metrics.current()
+            if metrics is not None:
+                metrics.add_decode_time(time.time() - start)
+
+    @api.model
+    def iter_qbo_entities(self, response, entity):
+        """Yield QBO entities of a query or read response, streamed responses are decoded incrementally
+        :param response: QBO response or list of entity dictionaries
+        :param entity: QBO entity name
+        """
+        entities = qbo_json.iter_entities(response, entity)
+        # lists are already decoded entities, e.g. replayed from the mirror
+        if not isinstance(response, (list, tuple)):
+            company = self._qbo_company()
+            if company.qbo_mirror_entities:
+                entities = self.env['qbo.entity.mirror']._mirror_entities(company, entity, entities)
+        return qbo_metrics.track_entities(entities)
+
+    @api.model
+    def iter_qbo_entity_chunks(self, response, entity, size=QBO_IMPORT_CHUNK_SIZE):
+        """Yield lists of at most size QBO entities of a response, the response keeps being decoded incrementally
+        :param response: QBO response or list of entity dictionaries
+        :param entity: QBO entity name
+        :param size: entities per list
+        """
+        entities = self.iter_qbo_entities(response, entity)
+        while True:
+            chunk = list(itertools.islice(entities, size))
+            if not chunk:
+                return
+            yield chunk
+
+    @api.model
+    def _qbo_company(self):
+        """Return the company a sync runs for: the company of the qbo_company_id context key, the user company otherwise"""
+        company_id = self.env.context.get('qbo_company_id')
+        if company_id:
+            return self.env['res.company'].browse(company_id)
+        return self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
+
+    @api.model
+    def _qbo_company_domain(self, shared=False):
+        """Return the domain of the records of the company a sync runs for, QBO ids are only unique within a realm
+        :param shared: also match records without company, e.g. partners and products shared by the companies
+        """
+        company = self._qbo_company()
+        if shared:
+            return [('company_id', 'in', [company.id, False])]
+        return [('company_id', '=', company.id)]
+
+    @api.model
+    def _qbo_with_company(self, records):
+        """Return records in the context of the company they are synced for, so that every helper called by the sync
+        uses the credentials, realm and properties of this company
+        :param records: res.company record or records of a single company
+        """
+        if records.env.context.get('qbo_company_id'):
+            return records
+        if records._name == 'res.company':
+            company = records
+        elif 'company_id' in records._fields:
+            company = records.mapped('company_id')
+        else:
+            return records
+        if len(company) != 1:
+            return records
+        return records.with_context(qbo_company_id=company.id, force_company=company.id)
+
+    @api.model
+    def _qbo_request(self, method, url, headers=None, data=None, stream=False, request_id=None):
+        """Send a QBO API call, throttled and failed calls are retried and reported to the running qbo.sync.run
+        :param request_id: QBO requestid of the call, calls with a requestid are retried on server and connection errors
+        :return: requests.Response object
+        """
+        if self.env.context.get('qbo_replay'):
+            raise UserError(_("QBO can not be called while mirrored entities are replayed: %s") % qbo_metrics.endpoint_label(method, url))
+        if request_id:
+            url = qbo_http.with_request_id(url, request_id)
+        company = self if len(self) == 1 else self._qbo_company()
+        return qbo_http.send(method, url, headers=headers, data=data, stream=stream,
+                             slot=company._qbo_realm_semaphore(qbo_realm_lock.realm_of(url)).slot)
+
+    @api.multi
+    def _qbo_realm_semaphore(self, realm_id=None):
+        """Return the semaphore limiting the QBO calls in flight of the realm across all workers
+        :param realm_id: realm of the calls, realm of the company by default
+        """
+        self.ensure_one()
+        return qbo_realm_lock.RealmSemaphore(self.env.cr.dbname, realm_id or self.realm_id, self.qbo_realm_concurrency)
+
+    @api.multi
+    def _qbo_request_ids(self, operation, records):
+        """Return the QBO requestid of the create call of each record by record id
+        The requestid depends on the database, realm, record and export attempt only, so that a call sent again after a
+        timeout can not create a duplicate in QBO. The attempt is raised each time QBO rejects the record. Updates must not
+        be sent with it, see _qbo_batch_item_request_id.
+        :param operation: sync operation name, as recorded in qbo.sync.failure
+        :param records: exported records
+        :return dict: requestid by record id
+        """
+        self.ensure_one()
+        attempts = self.env['qbo.sync.failure']._request_attempts(operation, records)
+        return dict((record.id, qbo_http.request_id(self.env.cr.dbname, self.realm_id, record._name, record.id, attempts[record.id]))
+                    for record in records)
+
+    @api.model
+    def _qbo_batch_item_request_id(self, request_id, item):
+        """Return the requestid of a batch item
+        A create keeps the requestid of its record. An update also depends on the SyncToken and payload it sends, so that
+        the update of an edited record is not answered with the cached response of its create or of a previous update.
+        :param request_id: requestid of the record, see _qbo_request_ids
+        :param item: BatchItemRequest dictionary
+        """
+        if item.get('operation') != 'update':
+            return request_id
+        payload = dict((key, value) for key, value in item.items() if key not in ('bId', 'operation'))
+        entity = list(payload.values())[0] if len(payload) == 1 else payload
+        return qbo_http.request_id(request_id, 'update', entity.get('SyncToken'), qbo_json.digest(payload))
+
+    @api.multi
+    def _qbo_batch(self, items, minorversion=None, request_ids=None):
+        """Send operations through the QBO batch endpoint, QBO_BATCH_SIZE operations per call
+        :param items: BatchItemRequest dictionaries, each with a unique bId
+        :param minorversion: minor version passed in the batch url
+        :param request_ids: requestid of the record of each item by bId, the requestid of a call is derived from those of its
+            items, updates included with their SyncToken and payload
+        :return dict: BatchItemResponse dictionaries by bId, failed calls are returned as Fault for each of their items
+        """
+        self.ensure_one()
+        url = str(self.url) + str(self.realm_id) + '/batch'
+        if minorversion:
+            url += '?minorversion=%s' % minorversion
+        headers = self.get_qbo_headers()
+        responses = {}
+        for start in range(0, len(items), QBO_BATCH_SIZE):
+            chunk = items[start:start + QBO_BATCH_SIZE]
+            request_id = request_ids and qbo_http.request_id(*[self._qbo_batch_item_request_id(request_ids[item['bId']], item)
+                                                                for item in chunk])
+            result = self._qbo_request('POST', url, headers=headers, data=json.dumps({'BatchItemRequest': chunk}), request_id=request_id)
+            if result.status_code != 200:
+                _logger.error(_("QBO batch call failed with status %s: %s" % (result.status_code, result.text)))
+                for item in chunk:
+                    responses[item['bId']] = {'bId': item['bId'], 'status_code': result.status_code, 'Fault': {
+                        'type': 'BatchError', 'Error': [{'Message': 'HTTP %s' % result.status_code, 'Detail': result.text}]}}
+                continue
+            for item in self.decode_qbo_response(result).get('BatchItemResponse', []):
+                responses[item.get('bId')] = item
+        return responses
+
+    @api.model
+    def _qbo_fault_message(self, response):
+        """Return the error messages of a QBO Fault"""
+        errors = (response.get('Fault') or {}).get('Error') or []
+        return '; '.join('%s %s' % (error.get('Message', ''), error.get('Detail', '')) for error in errors)
+
+    @api.multi
+    def _qbo_query_by_ids(self, entity, ids, qbo_fields=('Id', 'SyncToken')):
+        """Read QBO entities by Id with one Id IN query per QBO_QUERY_IN_SIZE ids
+        :param entity: QBO entity name
+        :param ids: QBO ids
+        :param qbo_fields: QBO fields to read
+        :return dict: entity dictionaries by Id
+        """
+        self.ensure_one()
+        if self.env.context.get('qbo_replay'):
+            return self.env['qbo.entity.mirror']._latest_entities(self, entity, ids)
+        ids = sorted(set(str(qbo_id) for qbo_id in ids if qbo_id))
+        url_str = self.get_import_query_url()
+        entities = {}
+        for start in range(0, len(ids), QBO_QUERY_IN_SIZE):
+            chunk = ids[start:start + QBO_QUERY_IN_SIZE]
+            query = "select %s from %s where Id in (%s) MAXRESULTS %s" % (
+                ', '.join(qbo_fields), entity, ', '.join("'%s'" % qbo_id for qbo_id in chunk), QBO_QUERY_IN_SIZE)
+            result = self._qbo_request('GET', url_str.get('url') + '/query?query=' + query, headers=url_str.get('headers'))
+            if result.status_code != 200:
+                raise ValidationError(_("QBO %s query failed: %s") % (entity, result.text))
+            for item in self.decode_qbo_response(result).get('QueryResponse', {}).get(entity, []):
+                entities[item.get('Id')] = item
+        return entities
+
+    @api.model
+    def _qbo_read_entity(self, entity, qbo_id, minorversion=False):
+        """Read a QBO entity by Id, the latest mirrored version is returned instead during a mirror replay
+        :param entity: QBO entity name, e.g. Customer
+        :param qbo_id: QBO Id
+        :param minorversion: send the minorversion of the company
+        :return: requests.Response, list of the mirrored entity dictionary during a replay
+        """
+        company = self._qbo_company()
+        if self.env.context.get('qbo_replay'):
+            entities = self.env['qbo.entity.mirror']._latest_entities(company, entity, [qbo_id])
+            if not entities:
+                raise UserError(_("QBO %s %s is not in the mirror, it can not be read while mirrored entities are replayed.")
+                                % (entity, qbo_id))
+            return list(entities.values())
+        url_str = company.get_import_query_url()
+        url = url_str.get('url') + '/%s/%s' % (entity.lower(), qbo_id)
+        if minorversion:
+            url += '?minorversion=' + url_str.get('minorversion')
+        return self._qbo_request('GET', url, headers=url_str.get('headers'))
+
+    @api.multi
+    def _load_qbo_references(self):
+        """Read well-known reference entities from QBO
+        :return dict: {'name', 'value'} reference dictionaries by key, False when missing in QBO
+        """
+        self.ensure_one()
+        url_str = self.get_import_query_url()
+        query = "select Id, Name, AccountSubType from Account where AccountSubType in (%s)" % ', '.join(
+            "'%s'" % sub_type for sub_type in QBO_REFERENCE_ACCOUNT_SUBTYPES.values())
+        result = self._qbo_request('GET', url_str.get('url') + '/query?query=' + query, headers=url_str.get('headers'))
+        if result.status_code != 200:
+            raise ValidationError(_("QBO reference accounts query failed: %s") % result.text)
+        accounts = self.decode_qbo_response(result).get('QueryResponse', {}).get('Account', [])
+        references = {}
+        for key, sub_type in QBO_REFERENCE_ACCOUNT_SUBTYPES.items():
+            candidates = [account for account in accounts if account.get('AccountSubType') == sub_type]
+            # prefer the account QBO creates by default, e.g. Inventory Asset
+            candidates.sort(key=lambda account: (account.get('Name') != QBO_REFERENCE_ACCOUNT_NAMES.get(key), int(account.get('Id'))))
+            references[key] = candidates and {'name': candidates[0].get('Name'), 'value': candidates[0].get('Id')} or False
+
+        if self.country_id.code == 'US':
+            references['tax_code'] = {'name': 'NON', 'value': 'NON'}
+        else:
+            result = self._qbo_request('GET', url_str.get('url') + "/query?query=select Id, Name, Taxable from TaxCode where Active = true",
+                                       headers=url_str.get('headers'))
+            if result.status_code != 200:
+                raise ValidationError(_("QBO reference tax codes query failed: %s") % result.text)
+            codes = [code for code in self.decode_qbo_response(result).get('QueryResponse', {}).get('TaxCode', []) if not code.get('Taxable')]
+            codes.sort(key=lambda code: int(code.get('Id')) if str(code.get('Id')).isdigit() else 0)
+            references['tax_code'] = codes and {'name': codes[0].get('Name'), 'value': codes[0].get('Id')} or False
+        return references
+
+    @api.multi
+    def get_qbo_references(self, refresh=False):
+        """Return well-known QBO reference entities of the realm, cached for qbo_reference_ttl seconds
+        :param refresh: read the references from QBO even if cached
+        :return dict: inventory_asset, income_account, expense_account and tax_code references
+        """
+        self.ensure_one()
+        key = (self.env.cr.dbname, self.realm_id)
+        references = None if refresh else qbo_cache.references.get(key)
+        if references is None:
+            references = self._load_qbo_references()
+            qbo_cache.references.set(key, references, max(self.qbo_reference_ttl, 0))
+        return references
+
+    @api.multi
+    def get_qbo_reference(self, key):
+        """Return QBO Id of a well-known reference entity, False when missing in QBO"""
+        reference = self.get_qbo_references().get(key)
+        return reference and reference.get('value') or False
+
+    @api.multi
+    def action_refresh_qbo_references(self):
+        for company in self:
+            company.get_qbo_references(refresh=True)
+
+    @api.multi
+    def action_qbo_import_plan(self):
+        """Start a full import whose independent stages run in parallel cron workers"""
+        self.ensure_one()
+        plan = self.env['qbo.import.plan'].create({'company_id': self.id})
+        plan.action_start()
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'qbo.import.plan',
+            'res_id': plan.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    @api.model_cr_context
+    def init(self):
+        """Index write_date of the models exported incrementally"""
+        super(ResCompany, self).init()
+        for model_name, watermark, operation, method, condition in QBO_EXPORT_MODELS:
+            table = self.env[model_name]._table
+            self.env.cr.execute("CREATE INDEX IF NOT EXISTS %s_write_date_index ON %s (write_date)" % (table, table))
+
+    @api.multi
+    @qbo_metrics.instrument('export_changes', exclusive=True)
+    def export_changes(self):
+        """Export the records changed since the last incremental export of each model through the batch exports
+        The records of a model are selected with one query on write_date. The watermark of the model is the time of the
+        selection minus QBO_EXPORT_OVERLAP, records changed within the overlap are sent again by the next export and
+        records whose values did not change are not written back, so that re-sends end there.
+        """
+        self.ensure_one()
+        failure = self.env['qbo.sync.failure']
+        for model_name, watermark, operation, method, condition in QBO_EXPORT_MODELS:
+            model = self.env[model_name]
+            export_date, ids = self._qbo_changed_ids(model, watermark, condition)
+            for start in range(0, len(ids), QBO_EXPORT_CHUNK_SIZE):
+                records = model.browse(ids[start:start + QBO_EXPORT_CHUNK_SIZE])
+                try:
+                    with self.env.cr.savepoint():
+                        getattr(records.with_context(active_ids=False), method)()
+                except Exception as e:
+                    _logger.warning(_("QBO incremental %s failed for %s records: %s" % (operation, len(records), e)))
+                    for record in records:
+                        failure._record(operation, record, error=e)
+            self[watermark] = export_date
+            self.env.cr.commit()
+            _logger.info(_("QBO incremental %s: %s changed records" % (operation, len(ids))))
+
+    @api.multi
+    def _qbo_changed_ids(self, model, watermark, condition):
+        """Select the records of an incremental export
+        :param model: exported model
+        :param watermark: company field holding the watermark of the model
+        :param condition: SQL condition of the exported records, see QBO_EXPORT_MODELS
+        :return tuple: next watermark, ids of the records changed since the watermark in write_date order
+        """
+        self.ensure_one()
+        # clock time before the selection, now() is the start of the transaction
+        self.env.cr.execute("SELECT date_trunc('second', clock_timestamp() at time zone 'UTC') - %s * interval '1 second'",
+                            (QBO_EXPORT_OVERLAP,))
+        export_date = self.env.cr.fetchone()[0]
+        query = "SELECT id FROM %s WHERE %s" % (model._table, condition)
+        if self[watermark]:
+            query += " AND write_date > %(since)s"
+        self.env.cr.execute(query + " ORDER BY write_date, id", {'company': self.id, 'since': self[watermark]})
+        return export_date, [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _cron_sync_all_realms(self):
+        """Start an import plan for every company with scheduled sync, the plans of the realms run concurrently in cron
+        workers, each with the credentials, tokens and call slots of its own company
+        """
+        companies = self.search([('qbo_scheduled_sync', '=', True), ('realm_id', '!=', False), ('qbo_refresh_token', '!=', False)])
+        for company in companies:
+            if self.env['qbo.import.plan'].search_count([('company_id', '=', company.id), ('state', '=', 'running')]):
+                _logger.info(_("QBO import plan of %s still running, scheduled sync skipped" % company.name))
+                continue
+            try:
+                # a realm whose tokens or plan fail does not stop the sync of the other realms
+                with self.env.cr.savepoint():
+                    company._qbo_ensure_access_token()
+                    self.env['qbo.import.plan'].create({'company_id': company.id}).action_start()
+            except Exception as e:
+                _logger.warning(_("QBO scheduled sync of %s could not start: %s" % (company.name, e)))
+            self.env.cr.commit()
+
+    @api.multi
+    def _qbo_ensure_access_token(self):
+        """Refresh the access token of the company when it expires within 10 minutes"""
+        self.ensure_one()
+        expire = self.access_token_expire_in and fields.Datetime.from_string(self.access_token_expire_in)
+        if not self.access_token or not expire or expire < datetime.now() + timedelta(minutes=10):
+            self.refresh_token()
+
+    @api.model
+    def _company_default_get(self, object=False, field=False):
+        """Records created by the sync of a company belong to this company"""
+        if self.env.context.get('qbo_company_id'):
+            return self._qbo_company()
+        return super(ResCompany, self)._company_default_get(object=object, field=field)
+
     # Company level QuickBooks Configuration fields
     client_id = fields.Char('Client Id', copy=False, help="The client ID you obtain from the developer dashboard.")
     client_secret = fields.Char('Client Secret', copy=False, help="The client secret you obtain from the developer dashboard.")
@@ -52,6 +460,47 @@ class ResCompany(models.Model):
     qbo_refresh_token = fields.Char('Refresh Token', copy=False,
                                     help="The token that must be used to access the QuickBooks API. Refresh token expires in 8726400 seconds.")
     refresh_token_expire_in = fields.Datetime('Refresh Token Expire In', copy=False, help="Refresh token expire time.")
+    qbo_projection_query = fields.Boolean('Projection Queries', default=True,
+                                          help="Request only the QBO fields mapped by the import stages instead of all fields. "
+                                               "Disable it when customized mappings need additional fields.")
+    qbo_page_size = fields.Integer('Import Page Size', default=1000, help="Maximum number of QBO entities fetched per import query, 1000 at most.")
+    qbo_stream_json = fields.Boolean('Stream Query Responses', default=False,
+                                     help="Decode import query responses incrementally so that only one entity is held in memory at a time. "
+                                          "Requires the ijson python library.")
+    qbo_max_concurrency = fields.Integer('Concurrent QBO Calls', default=4,
+                                         help="Maximum number of QBO calls sent in parallel by bulk exports. QBO accepts 10 concurrent "
+                                              "requests per realm, throttled calls are retried.")
+    qbo_reference_ttl = fields.Integer('Reference Cache TTL (s)', default=3600,
+                                       help="Seconds during which well-known QBO references (inventory asset, default income and expense "
+                                            "accounts, default tax code) are reused by exports before being read again from QBO.")
+    qbo_realm_concurrency = fields.Integer('Realm Call Slots', default=8,
+                                           help="Maximum number of QBO calls in flight for the realm across all Odoo workers and crons, "
+                                                "QBO throttles a realm above 10 concurrent requests. 0 disables the limit.")
+    qbo_release_records = fields.Integer('Release ORM Cache Every (records)', default=1000,
+                                         help="Imports empty the ORM caches of the worker after this number of records, 0 disables it.")
+    qbo_release_mb = fields.Integer('Release ORM Cache Every (MB)', default=256,
+                                    help="Imports empty the ORM caches of the worker once its memory grew by this number of "
+                                         "megabytes since the last release, 0 disables it. Keep it well below limit_memory_hard.")
+    last_exported_account_date = fields.Datetime('Last Account Export', copy=False,
+                                                 help="Accounts changed after this date are exported by the next incremental export.")
+    last_exported_tax_date = fields.Datetime('Last Tax Export', copy=False,
+                                             help="Group taxes created after this date are exported by the next incremental export.")
+    last_exported_partner_date = fields.Datetime('Last Customer Export', copy=False,
+                                                 help="Customers changed after this date are exported by the next incremental export.")
+    last_exported_product_date = fields.Datetime('Last Product Export', copy=False,
+                                                 help="Products changed after this date are exported by the next incremental export.")
+    last_exported_invoice_date = fields.Datetime('Last Invoice Export', copy=False,
+                                                 help="Open invoices and bills changed after this date are exported by the next "
+                                                      "incremental export.")
+    qbo_scheduled_sync = fields.Boolean('Scheduled Sync', default=False,
+                                        help="Import the company from its QBO realm in the scheduled sync of all realms.")
+    qbo_slice_seconds = fields.Integer('Import Job Time Slice (s)', default=60,
+                                       help="An import plan stage stops after the current page once it ran for this time and resumes in a "
+                                            "new cron job. Keep it below the worker limit_time_real minus the time of one page, 0 runs "
+                                            "every stage in a single job.")
+    qbo_mirror_entities = fields.Boolean('Mirror Imported Entities', default=False,
+                                         help="Store the compressed JSON of every entity fetched by the imports so that imports can be "
+                                              "replayed from the mirror without calling QBO. Import queries request all fields.")
 
     #     '''  Tracking Fields for Customer'''
     #     x_quickbooks_last_customer_sync = fields.Datetime('Last Synced On', copy=False,)
@@ -85,13 +534,12 @@ class ResCompany(models.Model):
 
     @api.model
     def _run_refresh_token(self, **kwag):
-        self.refresh_token()
+        self.search([('qbo_refresh_token', '!=', False)]).refresh_token()
 
     @api.multi
     def refresh_token(self):
         """Get new access token from existing refresh token"""
-        quickbook_id = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-        if quickbook_id:
+        for quickbook_id in self or self._qbo_company():
 
             client_id = quickbook_id.client_id
             client_secret = quickbook_id.client_secret
@@ -108,7 +556,7 @@ class ResCompany(models.Model):
 
             access_token = requests.post(quickbook_id.access_token_url, data=payload, headers=headers)
             if access_token:
-                parsed_token_response = json.loads(access_token.text)
+                parsed_token_response = self.decode_qbo_response(access_token)
                 if parsed_token_response:
                     quickbook_id.write({
                         'access_token': parsed_token_response.get('access_token'),
@@ -118,13 +566,23 @@ class ResCompany(models.Model):
                     })
                     _logger.info(_("Token refreshed successfully!"))
 
+    @api.model
+    def get_qbo_headers(self, content_type='application/json'):
+        """Return headers of a QBO API call, responses are always requested as JSON
+        :param content_type: content type of the request body
+        """
+        if not self.access_token:
+            raise ValidationError(_('Invalid access token'))
+        return {
+            'Authorization': 'Bearer ' + str(self.access_token),
+            'Accept': 'application/json',
+            'Content-Type': content_type,
+        }
+
     @api.model
     def get_import_query_url(self):
         if self.access_token:
-            headers = {}
-            headers['Authorization'] = 'Bearer ' + str(self.access_token)
-            headers['accept'] = 'application/json'
-            headers['Content-Type'] = 'text/plain'
+            headers = self.get_qbo_headers(content_type='text/plain')
             if self.url:
                 url = str(self.url) + str(self.realm_id)
             else:
@@ -133,14 +591,49 @@ class ResCompany(models.Model):
         else:
             raise ValidationError(_('Invalid access token'))
 
+    @api.model
+    def _get_import_select_clause(self, model_name, entity):
+        """Return projection of the QBO fields mapped by an import stage
+        :param model_name: odoo model which maps the QBO entity
+        :param entity: QBO entity name
+        :return str: comma separated QBO fields or * when all fields are required
+        """
+        qbo_fields = self.env[model_name]._get_qbo_import_fields(entity)
+        # mirrored entities are kept whole so that replays can use fields added to the mappings later
+        if not self.qbo_projection_query or self.qbo_mirror_entities or not qbo_fields:
+            return '*'
+        if 'Id' not in qbo_fields:
+            qbo_fields = ['Id'] + list(qbo_fields)
+        return ', '.join(qbo_fields)
+
     @api.multi
-    def import_customers(self):
+    def _get_import_query_data(self, model_name, entity, where=None, order_by='Id', use_minorversion=True):
+        """Query QBO entities for an import stage
+        :param model_name: odoo model which maps the QBO entity
+        :param entity: QBO entity name
+        :param where: query condition
+        :param order_by: QBO field used to order the result
+        :param use_minorversion: pass company minor version in the query url
+        :return: QBO query response
+        """
         self.ensure_one()
-        query = "select * from Customer WHERE Id > '%s' order by Id" % (self.last_imported_customer_id)
+        query = "select %s from %s" % (self._get_import_select_clause(model_name, entity), entity)
+        if where:
+            query += " WHERE %s" % where
+        if order_by:
+            query += " order by %s" % order_by
+        if self.qbo_page_size > 0:
+            query += " MAXRESULTS %s" % min(self.qbo_page_size, 1000)
         url_str = self.get_import_query_url()
         url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+            'minorversion=' + url_str.get('minorversion') + '&' if use_minorversion and url_str.get('minorversion') else '', query)
+        return self._qbo_request('GET', url, headers=url_str.get('headers'), stream=self.qbo_stream_json)
+
+    @api.multi
+    @qbo_metrics.instrument('import_customers', exclusive=True)
+    def import_customers(self):
+        self.ensure_one()
+        data = self._get_import_query_data('res.partner', 'Customer', "Id > '%s'" % (self.last_imported_customer_id))
         if data:
             partner = self.env['res.partner'].create_partner(data, is_customer=True)
             if partner:
@@ -149,13 +642,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_vendors', exclusive=True)
     def import_vendors(self):
         self.ensure_one()
-        query = "select * from vendor WHERE Id > '%s' order by Id" % (self.last_imported_vendor_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('res.partner', 'Vendor', "Id > '%s'" % (self.last_imported_vendor_id))
         if data:
             partner = self.env['res.partner'].create_partner(data, is_vendor=True)
             if partner:
@@ -164,12 +654,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_chart_of_accounts', exclusive=True)
     def import_chart_of_accounts(self):
         self.ensure_one()
-        query = "select * from Account WHERE Id > '%s' order by Id" % (self.last_acc_imported_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?query=' + query
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('account.account', 'Account', "Id > '%s'" % (self.last_acc_imported_id), use_minorversion=False)
         if data:
             acc = self.env['account.account'].create_account_account(data)
             if acc:
@@ -178,12 +666,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_tax', exclusive=True)
     def import_tax(self):
         self.ensure_one()
-        query = "select * From TaxCode WHERE Id > '%s' order by Id" % (self.last_imported_tax_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?query=' + query
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('account.tax', 'TaxCode', "Id > '%s'" % (self.last_imported_tax_id), use_minorversion=False)
         if data:
             acc_tax = self.env['account.tax'].create_account_tax(data)
             if acc_tax:
@@ -192,12 +678,11 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_tax_agency', exclusive=True)
     def import_tax_agency(self):
         self.ensure_one()
-        query = "select * From TaxAgency WHERE Id > '%s' order by Id" % (self.last_imported_tax_agency_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?query=' + query
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('account.tax.agency', 'TaxAgency', "Id > '%s'" % (self.last_imported_tax_agency_id),
+                                           use_minorversion=False)
         if data:
             agency = self.env['account.tax.agency'].create_account_tax_agency(data)
             if agency:
@@ -206,13 +691,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_product_category', exclusive=True)
     def import_product_category(self):
         self.ensure_one()
-        query = "select * from Item where Type='Category' AND Id > '%s' order by Id" % (self.last_imported_product_category_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('product.category', 'Item', "Type='Category' AND Id > '%s'" % (self.last_imported_product_category_id))
         if data:
             category = self.env['product.category'].create_product_category(data)
             if category:
@@ -221,13 +703,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_product', exclusive=True)
     def import_product(self):
         self.ensure_one()
-        query = "select * from Item where Id > '%s' order by Id" % (self.last_imported_product_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('product.template', 'Item', "Id > '%s'" % (self.last_imported_product_id))
         if data:
             product = self.env['product.template'].create_product(data)
             if product:
@@ -236,18 +715,16 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_inventory', exclusive=True)
     def import_inventory(self):
 
         self.ensure_one()
         try:
-            query = "select * from Item"
-            url_str = self.get_import_query_url()
-            url = url_str.get('url') + '/query?%squery=%s' % (
-                'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-            data = requests.request('GET', url, headers=url_str.get('headers'))
-            parsed_data = data.json()
-            for recs in parsed_data.get("QueryResponse").get('Item'):
-                product_exists = self.env['product.product'].search([('qbo_product_id', '=', recs.get('Id'))])
+            data = self._get_import_query_data('product.product', 'Item', order_by=False)
+            for recs in self.iter_qbo_entities(data, 'Item'):
+                qbo_metrics.checkpoint()
+                product_exists = self.env['product.product'].search([('qbo_product_id', '=', recs.get('Id'))] +
+                                                                    self._qbo_company_domain(shared=True))
                 if product_exists and product_exists.type == 'product':
                     if product_exists.qty_available != recs.get('QtyOnHand') and recs.get('QtyOnHand') >= 0:
                         #                         product_product_id = self.env['product.product'].search([('product_tmpl_id','=',product_exists.id)]).id
@@ -268,13 +745,10 @@ class ResCompany(models.Model):
             raise ValidationError(_('Inventory Update Failed due to %s' % str(e)))
 
     @api.multi
+    @qbo_metrics.instrument('import_payment_method', exclusive=True)
     def import_payment_method(self):
         self.ensure_one()
-        query = "select * From PaymentMethod WHERE Id > '%s' order by Id" % (self.last_imported_payment_method_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('qbo.payment.method', 'PaymentMethod', "Id > '%s'" % (self.last_imported_payment_method_id))
         if data:
             method = self.env['qbo.payment.method'].create_payment_method(data)
             if method:
@@ -283,13 +757,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_payment', exclusive=True)
     def import_payment(self):
         self.ensure_one()
-        query = "select * From Payment WHERE Id > '%s' order by Id" % (self.last_imported_payment_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('account.payment', 'Payment', "Id > '%s'" % (self.last_imported_payment_id))
         if data:
             payment = self.env['account.payment'].create_payment(data, is_customer=True)
             if payment:
@@ -298,13 +769,10 @@ class ResCompany(models.Model):
             _logger.warning(_('Empty data'))
 
     @api.multi
+    @qbo_metrics.instrument('import_bill_payment', exclusive=True)
     def import_bill_payment(self):
         self.ensure_one()
-        query = "select * From billpayment WHERE Id > '%s' order by Id" % (self.last_imported_bill_payment_id)
-        url_str = self.get_import_query_url()
-        url = url_str.get('url') + '/query?%squery=%s' % (
-            'minorversion=' + url_str.get('minorversion') + '&' if url_str.get('minorversion') else '', query)
-        data = requests.request('GET', url, headers=url_str.get('headers'))
+        data = self._get_import_query_data('account.payment', 'BillPayment', "Id > '%s'" % (self.last_imported_bill_payment_id))
         if data:
             payment = self.env['account.payment'].create_payment(data, is_vendor=True)
             if payment:
@@ -312,57 +780,63 @@ class ResCompany(models.Model):
         else:
             _logger.warning(_('Empty data'))
 
+    @api.multi
+    @qbo_metrics.instrument('import_payment_term', exclusive=True)
     def import_payment_term_from_quickbooks(self):
+        """Import all QBO terms in one query, local terms are matched by QBO Id, then by name"""
+        self.ensure_one()
+        payment_term = self.env['account.payment.term'].with_context(active_test=False)
+        data = self._get_import_query_data('account.payment.term', 'Term', "Active IN (true, false)")
+        qbo_terms = list(self.iter_qbo_entities(data, 'Term'))
+        if not qbo_terms:
+            return
 
-        payment_term = self.env['account.payment.term']
+        local_terms = payment_term.search(['|', ('x_quickbooks_id', 'in', [int(term.get('Id')) for term in qbo_terms]),
+                                           '&', ('x_quickbooks_id', 'in', [0, False]), ('name', 'in', [term.get('Name') for term in qbo_terms])])
+        by_qbo_id = dict((term.x_quickbooks_id, term) for term in local_terms if term.x_quickbooks_id)
+        by_name = dict((term.name, term) for term in local_terms if not term.x_quickbooks_id)
 
-        payment_term_line = self.env['account.payment.term.line']
+        for term in qbo_terms:
+            qbo_id = int(term.get('Id'))
+            due_days = term.get('DueDays') or 0
+            local = by_qbo_id.get(qbo_id) or by_name.pop(term.get('Name'), False)
+            if not local:
+                payment_term.create({
+                    'name': term.get('Name'),
+                    'note': term.get('Name'),
+                    'active': term.get('Active', True),
+                    'line_ids': [(0, 0, {'value': 'balance', 'days': due_days})],
+                    'x_quickbooks_id': qbo_id,
+                    'x_quickbooks_updated': True,
+                })
+                _logger.info(_("Payment term created sucessfully! Payment term Id: %s" % (qbo_id)))
+                continue
+            if local.x_quickbooks_id and not local.x_quickbooks_updated:
+                # local changes not pushed yet win over QBO
+                continue
+            vals = {'x_quickbooks_id': qbo_id, 'x_quickbooks_updated': True}
+            if local.name != term.get('Name'):
+                vals['name'] = term.get('Name')
+            if local.active != term.get('Active', True):
+                vals['active'] = term.get('Active', True)
+            balance = local.line_ids.filtered(lambda line: line.value == 'balance')[:1]
+            if balance and balance.days != due_days:
+                vals['line_ids'] = [(1, balance.id, {'days': due_days})]
+            local.write(vals)
 
-        if self.access_token:
-            headers = {}
-            headers['Authorization'] = 'Bearer ' + str(self.access_token)
-            headers['Accept'] = 'application/json'
-            headers['Content-Type'] = 'text/plain'
-            data = requests.request('GET', self.url + str(self.realm_id) + "/query?query=select * from term where Id > '{}'".format(
-                str(self.x_quickbooks_last_paymentterm_imported_id)), headers=headers)
-            if data:
-                ''' Holds quickbookIds which are inserted '''
-                recs = []
-
-                parsed_data = json.loads(str(data.text))
-                if parsed_data:
-                    if parsed_data.get('QueryResponse') and parsed_data.get('QueryResponse').get('Term'):
-                        for term in parsed_data.get('QueryResponse').get('Term'):
-                            dict = {}
-                            dict_ptl = {}
-                            exists = payment_term.search([('name', '=', term.get('Name'))])
-                            if not exists:
-                                ''' Loop and create Data '''
-                                if term.get('Active'):
-                                    dict['active'] = term.get('Active')
-                                if term.get('Name'):
-                                    dict['note'] = term.get('Name')
-                                    dict['name'] = term.get('Name')
-                                '''  Insert data in account payment term line and attach its id to payment term create'''
-                                if term.get('DueDays'):
-                                    dict_ptl['value'] = 'balance'
-                                    dict_ptl['days'] = term.get('DueDays')
-                                payment_term_create = payment_term.create(dict)
-                                if payment_term_create:
-                                    payment_term_create.x_quickbooks_id = term.get('Id')
-                                    recs.append(term.get('Id'))
-                                    #                                     self.x_quickbooks_last_paymentterm_imported_id = term.get('Id')
-                                    self.x_quickbooks_last_paymentterm_sync = fields.datetime.now()
-
-                                    dict_ptl['payment_id'] = payment_term_create.id
-                                    payment_term_line_create = payment_term_line.create(dict_ptl)
-                                    if payment_term_line_create:
-                                        _logger.info(_("Payment term line was created %s" % payment_term_line_create.id))
-
-                            else:
-                                _logger.info(_("REC Exists %s" % term.get('Name')))
-                            if recs:
-                                self.x_quickbooks_last_paymentterm_imported_id = max(recs)
+        self.x_quickbooks_last_paymentterm_imported_id = max(int(term.get('Id')) for term in qbo_terms)
+        self.x_quickbooks_last_paymentterm_sync = fields.Datetime.now()
+
+    @api.multi
+    @qbo_metrics.instrument('sync_payment_term')
+    def sync_payment_terms(self):
+        """Pull QBO terms, then push local terms created or changed since the last sync in batch requests"""
+        self.ensure_one()
+        self.import_payment_term_from_quickbooks()
+        terms = self.env['account.payment.term'].with_context(active_test=False).search(
+            ['|', ('x_quickbooks_id', 'in', [0, False]), ('x_quickbooks_updated', '=', False)])
+        if terms:
+            terms._export_terms_to_qbo(self)
 
                                 #     def createOdooParentId(self, quickbook_id):
 
@@ -1,25 +1,117 @@
 from odoo import api, fields, models, _
-import requests
 import json
 from openerp.exceptions import UserError, ValidationError
 import logging
+
+import psycopg2
+
+from ..tools import qbo_metrics
+
 _logger = logging.getLogger(__name__)
 
 
+# QBO country names which are not Odoo country names or codes
+QBO_COUNTRY_ALIASES = {
+    'usa': 'us',
+    'u.s.a.': 'us',
+    'u.s.': 'us',
+    'united states of america': 'us',
+    'uk': 'gb',
+    'great britain': 'gb',
+}
+
+
+class QboAddressIndex(object):
+    """Case insensitive index of countries and states by name and code, built once per import"""
+
+    def __init__(self, env):
+        self.env = env
+        self.default_country_id = env['res.company']._qbo_company().country_id.id
+        self.countries = {}
+        # country names are translated, index the english name and the name in the user language
+        for lang in set(['en_US', env.context.get('lang') or 'en_US']):
+            for country in env['res.country'].with_context(lang=lang).search_read([], ['name', 'code']):
+                self.countries.setdefault(self._key(country['name']), country['id'])
+                if country['code']:
+                    self.countries.setdefault(self._key(country['code']), country['id'])
+        for alias, code in QBO_COUNTRY_ALIASES.items():
+            if code in self.countries:
+                self.countries.setdefault(alias, self.countries[code])
+        self.states = {}
+        for state in env['res.country.state'].search_read([], ['name', 'code', 'country_id']):
+            self._add_state(state['country_id'][0], state['name'], state['code'], state['id'])
+        self.missing_countries = set()
+
+    @staticmethod
+    def _key(value):
+        return ' '.join(str(value).split()).lower()
+
+    def _add_state(self, country_id, name, code, state_id):
+        self.states.setdefault((country_id, self._key(name)), state_id)
+        if code:
+            self.states.setdefault((country_id, self._key(code)), state_id)
+
+    def country(self, country_name):
+        """Return id of the country named or coded country_name, False when unknown"""
+        if not country_name:
+            return False
+        key = self._key(country_name)
+        country_id = self.countries.get(key, False)
+        if not country_id and key not in self.missing_countries:
+            self.missing_countries.add(key)
+            _logger.warning(_("Country %s of QBO address not found" % country_name))
+        return country_id
+
+    def state(self, state_name, country_name):
+        """Return id of the state named or coded state_name, e.g. CA, US-CA or California
+        States missing in a known country are created like before.
+        """
+        if not state_name:
+            return False
+        country_id = self.country(country_name) if country_name else self.default_country_id
+        if not country_id:
+            return False
+        key = self._key(state_name)
+        state_id = self.states.get((country_id, key))
+        if not state_id and '-' in key:
+            # ISO 3166-2 form, country code prefix
+            state_id = self.states.get((country_id, key.split('-', 1)[1]))
+        if not state_id:
+            State = self.env['res.country.state']
+            try:
+                # a concurrent import may create the same state, only this insert is rolled back then
+                with self.env.cr.savepoint():
+                    state_id = State.create({'name': state_name, 'country_id': country_id, 'code': state_name}).id
+            except psycopg2.IntegrityError:
+                state_id = State.search([('country_id', '=', country_id), '|', ('name', '=ilike', state_name), ('code', '=ilike', state_name)],
+                                        limit=1).id
+            if state_id:
+                self._add_state(country_id, state_name, state_name, state_id)
+        return state_id or False
+
+
 class ResCountry(models.Model):
     _inherit = "res.country"
 
+    @api.model
+    def get_qbo_address_index(self):
+        """Return a QboAddressIndex of all countries and states, built once per sync stage and company"""
+        metrics = qbo_metrics.current()
+        if metrics is None:
+            return QboAddressIndex(self.env)
+        key = ('address_index', self.env['res.company']._qbo_company().id)
+        if key not in metrics.cache:
+            metrics.cache[key] = QboAddressIndex(self.env)
+        return metrics.cache[key]
+
     @api.model
     def get_country_ref(self, country_name):
         """
         This method take country name as an argument and return county id
         :param country_name: name of the country
-        :rtype int: return a recordset id
+        :rtype int: return a recordset id, False when the country is unknown
         """
-        country = self.search([('name', '=', country_name)], limit=1)
-        if not country:
-            country = self.create({'name': country_name})
-        return country.id
+        return self.get_qbo_address_index().country(country_name)
 
 ResCountry()
 
@@ -36,19 +128,73 @@ class ResCountryState(models.Model):
         :rtype int: return a recordset id
         """
         if country_name:
-            country_id = self.env['res.country'].get_country_ref(country_name)
-            state = self.search([('name', '=', state_name), ('country_id', '=', country_id)], limit=1)
-            if not state:
-                state = self.create({'name': state_name, 'country_id': country_id, 'code': state_name})
-            return state.id
+            return self.env['res.country'].get_qbo_address_index().state(state_name, country_name)
         else:
             return False
 
 ResCountryState()
 
 
+class QboPartnerIndex(object):
+    """Index of the partners matching a page of QBO customers or vendors
+    Partners are read with one search and matched by QBO customer id, QBO vendor id, email and display name.
+    """
+
+    def __init__(self, env, entities):
+        self.partners = {}
+        self.by_qbo_id = {'qbo_customer_id': {}, 'qbo_vendor_id': {}}
+        self.by_email = {}
+        self.by_name = {}
+        ids = [entity.get('Id') for entity in entities]
+        emails = [entity.get('PrimaryEmailAddr').get('Address') for entity in entities
+                  if entity.get('PrimaryEmailAddr') and entity.get('PrimaryEmailAddr').get('Address')]
+        names = [entity.get('DisplayName') for entity in entities if entity.get('DisplayName')]
+        domain = ['|', '|', ('qbo_customer_id', 'in', ids), ('qbo_vendor_id', 'in', ids)]
+        domain += ['&', ('type', 'not in', ['invoice', 'delivery']), '|', ('email', 'in', emails), ('name', 'in', names)]
+        domain += env['res.company']._qbo_company_domain(shared=True)
+        # oldest partner first so that it wins over later duplicates
+        for record in env['res.partner'].with_context(active_test=False).search_read(
+                domain, ['name', 'email', 'qbo_customer_id', 'qbo_vendor_id'], order='id'):
+            self.add(record)
+
+    @staticmethod
+    def _key(value):
+        return value and ' '.join(value.split()).lower() or False
+
+    def add(self, record):
+        """Index a partner dictionary with id, name, email, qbo_customer_id and qbo_vendor_id"""
+        partner = self.partners.setdefault(record['id'], {'id': record['id']})
+        partner.update((field_name, record[field_name]) for field_name in ('name', 'email', 'qbo_customer_id', 'qbo_vendor_id')
+                       if record.get(field_name))
+        for field_name in ('qbo_customer_id', 'qbo_vendor_id'):
+            if partner.get(field_name):
+                self.by_qbo_id[field_name].setdefault(partner[field_name], partner)
+        if partner.get('email'):
+            self.by_email.setdefault(self._key(partner['email']), partner)
+        if partner.get('name'):
+            self.by_name.setdefault(self._key(partner['name']), partner)
+
+    def match(self, entity, qbo_field):
+        """Return id of the partner of a QBO customer or vendor, False when it is new
+        :param qbo_field: qbo_customer_id for customers, qbo_vendor_id for vendors
+        """
+        partner = self.by_qbo_id[qbo_field].get(entity.get('Id'))
+        if partner:
+            return partner['id']
+        # same entity on the other side, e.g. a vendor which is also a customer
+        email = entity.get('PrimaryEmailAddr') and entity.get('PrimaryEmailAddr').get('Address')
+        for partner in (self.by_email.get(self._key(email)), self.by_name.get(self._key(entity.get('DisplayName')))):
+            if partner and not partner.get(qbo_field):
+                return partner['id']
+        return False
+
+
 class ResPartner(models.Model):
-    _inherit = "res.partner"
+    _name = "res.partner"
+    _inherit = ["res.partner", "qbo.sync.mixin"]
+    _qbo_sync_fields = ('company_type', 'is_company', 'name', 'email', 'phone', 'mobile', 'website', 'active', 'comment',
+                        'qbo_customer_id', 'customer', 'qbo_vendor_id', 'supplier', 'street', 'city', 'zip', 'state_id',
+                        'country_id', 'parent_id', 'child_ids')
 
     qbo_customer_id = fields.Char("QBO Customer Id", copy=False, help="QuickBooks database recordset id")
     qbo_vendor_id = fields.Char("QBO Vendor Id", copy=False, help="QuickBooks database recordset id")
@@ -56,50 +202,72 @@ class ResPartner(models.Model):
     x_quickbooks_updated = fields.Boolean("Updated in Quickbook ?", default=False)
 
     @api.model
-    def _prepare_partner_dict(self, partner, is_customer=False, is_vendor=False):
+    def _get_qbo_import_fields(self, entity):
+        """Return QBO fields mapped by the partner import
+        :param entity: QBO entity name, Customer or Vendor
+        :return list: QBO field names, empty list to import all fields
+        """
+        if entity == 'Vendor':
+            return ['Id', 'DisplayName', 'PrimaryEmailAddr', 'PrimaryPhone', 'Mobile', 'WebAddr', 'Active', 'BillAddr', 'MetaData']
+        return ['Id', 'DisplayName', 'Job', 'PrimaryEmailAddr', 'PrimaryPhone', 'Mobile', 'WebAddr', 'Active', 'Notes',
+                'BillAddr', 'ShipAddr', 'ParentRef', 'MetaData']
+
+    @api.model
+    def _prepare_address_dict(self, address, address_index=None):
+        """Return address values of a QBO address
+        :param address: QBO PhysicalAddress dictionary
+        :param address_index: QboAddressIndex shared by the import
+        """
+        if address_index is None:
+            address_index = self.env['res.country'].get_qbo_address_index()
+        return {
+            'street': address.get('Line1'),
+            'city': address.get('City'),
+            'zip': address.get('PostalCode'),
+            'state_id': address_index.state(address.get('CountrySubDivisionCode'), address.get('Country')),
+            # QBO omits the country of domestic addresses
+            'country_id': address_index.country(address.get('Country')) if address.get('Country') else
+            address.get('CountrySubDivisionCode') and address_index.default_country_id or False,
+        }
+
+    @api.model
+    def _prepare_partner_dict(self, partner, is_customer=False, is_vendor=False, address_index=None, parent_map=None):
         vals = {
             'company_type': 'person' if partner.get('Job') else 'company',
             'name': partner.get('DisplayName'),
-            'qbo_customer_id': partner.get('Id') if is_customer else '',
-            'qbo_vendor_id': partner.get('Id') if is_vendor else '',
-            'customer': is_customer,
-            'supplier': is_vendor,
             'email': partner.get('PrimaryEmailAddr').get('Address') if partner.get('PrimaryEmailAddr') else '',
             'phone': partner.get('PrimaryPhone').get('FreeFormNumber') if partner.get('PrimaryPhone') else '',
             'mobile': partner.get('Mobile').get('FreeFormNumber') if partner.get('Mobile') else '',
             'website': partner.get('WebAddr').get('URI') if partner.get('WebAddr') else '',
             'active': partner.get('Active'),
             'comment': partner.get('Notes'),
-
         }
+        # only the imported side is set, a partner can be customer and vendor in QBO
+        if is_customer:
+            vals.update({'qbo_customer_id': partner.get('Id'), 'customer': True})
+        if is_vendor:
+            vals.update({'qbo_vendor_id': partner.get('Id'), 'supplier': True})
 
-#         child_ids = []
-        if 'BillAddr' in partner and partner.get('BillAddr'):
-            address_vals = {
-                'street': partner.get('BillAddr').get('Line1'),
-                'city': partner.get('BillAddr').get('city'),
-                'zip': partner.get('BillAddr').get('zip'),
-                'state_id': self.env['res.country.state'].get_state_ref(partner.get('BillAddr').get('CountrySubDivisionCode'), partner.get('BillAddr').get('Country')) if partner.get('BillAddr').get('CountrySubDivisionCode') else False,
-                'country_id': self.env['res.country'].get_country_ref(partner.get('BillAddr').get('Country')) if partner.get('BillAddr').get('Country') else False,
-            }
-            vals.update(address_vals)
+        if partner.get('BillAddr'):
+            vals.update(self._prepare_address_dict(partner.get('BillAddr'), address_index))
 
         if 'ParentRef' in partner:
-            if is_customer:
+            parent_id = parent_map and parent_map.get(partner.get('ParentRef').get('value'))
+            if parent_id:
+                vals.update({'parent_id': parent_id})
+            elif is_customer:
                 vals.update({'parent_id': self.get_parent_customer_ref(partner.get('ParentRef').get('value'))})
-            if is_vendor:
+            elif is_vendor:
                 vals.update({'parent_id': self.get_parent_vendor_ref(partner.get('ParentRef').get('value'))})
 
         return vals
 
     @api.model
     def get_parent_customer_ref(self, qbo_parent_id):
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-        partner = self.search([('qbo_customer_id', '=', qbo_parent_id)], limit=1)
+        company = self.env['res.company']._qbo_company()
+        partner = self.search([('qbo_customer_id', '=', qbo_parent_id)] + company._qbo_company_domain(shared=True), limit=1)
         if not partner:
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/customer/' + qbo_parent_id
-            data = requests.request('GET', url, headers=url_str.get('headers'))
+            data = self.env['res.company']._qbo_read_entity('Customer', qbo_parent_id)
             if data:
                 partner = self.create_partner(data, is_customer=True)
         return partner.id
@@ -119,17 +287,16 @@ class ResPartner(models.Model):
 
     @api.model
     def get_parent_vendor_ref(self, qbo_parent_id):
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
-        partner = self.search([('qbo_vendor_id', '=', qbo_parent_id)], limit=1)
+        company = self.env['res.company']._qbo_company()
+        partner = self.search([('qbo_vendor_id', '=', qbo_parent_id)] + company._qbo_company_domain(shared=True), limit=1)
         if not partner:
-            url_str = company.get_import_query_url()
-            url = url_str.get('url') + '/vendor/' + qbo_parent_id
-            data = requests.request('GET', url, headers=url_str.get('headers'))
+            data = self.env['res.company']._qbo_read_entity('Vendor', qbo_parent_id)
             if data:
                 partner = self.create_partner(data, is_vendor=True)
         return partner.id
 
     @api.model
+    @qbo_metrics.instrument('create_partner')
     def create_partner(self, data, is_customer=False, is_vendor=False):
         """Create partner object in odoo
         :param data: partner object response return by QBO
@@ -137,58 +304,97 @@ class ResPartner(models.Model):
         :param is_vendor: True if partener is a supplier/vendor
         :return int: last import QBO customer or vendor Id
         """
-        res = json.loads(str(data.text))
         brw_partner = False
         if is_customer:
-            if 'QueryResponse' in res:
-                partners = res.get('QueryResponse').get('Customer', [])
-            else:
-                partners = [res.get('Customer')] or []
+            entity, qbo_field = 'Customer', 'qbo_customer_id'
         elif is_vendor:
-            if 'QueryResponse' in res:
-                partners = res.get('QueryResponse').get('Vendor', [])
-            else:
-                partners = [res.get('Vendor')] or []
+            entity, qbo_field = 'Vendor', 'qbo_vendor_id'
         else:
-            partners = []
+            return brw_partner
+        address_index = self.env['res.country'].get_qbo_address_index()
+        last_partner = False
+        # partners are matched one chunk of the page at a time, the page keeps being decoded incrementally
+        for partners in self.env['res.company'].iter_qbo_entity_chunks(data, entity):
+            last_qbo_id = partners[-1].get('Id')
+
+            # parents are created before their children, missing parents are fetched with the chunk
+            parents, parent_map = self._fetch_qbo_parents(partners, entity, qbo_field)
+            partners = self._sort_qbo_parents_first(parents + partners)
+            partner_index = QboPartnerIndex(self.env, partners)
+            for partner in partners:
+                vals = self._prepare_partner_dict(partner, is_customer=is_customer, is_vendor=is_vendor, address_index=address_index,
+                                                  parent_map=parent_map)
+                # billing and shipping addresses are hashed with the partner, they are created again when it changes
+                addresses = [(address_type, self._prepare_address_dict(partner.get(qbo_address), address_index))
+                             for qbo_address, address_type in (('BillAddr', 'invoice'), ('ShipAddr', 'delivery'))
+                             if partner.get(qbo_address)]
+                vals = self._qbo_sync_vals(partner, vals, addresses)
+                partner_id = partner_index.match(partner, qbo_field)
+                brw_partner = self.browse(partner_id)
+                synced = brw_partner._qbo_is_synced(partner, vals)
+                if not partner_id:
+                    brw_partner = self.with_context(qbo_import=True).create(dict(vals, customer=is_customer, supplier=is_vendor))
+                elif not synced:
+                    brw_partner.write(vals)
+                partner_index.add(dict(vals, id=brw_partner.id))
+
+                if not synced:
+                    # Create partner billing and shipping addresses
+                    for address_type, address_vals in addresses:
+                        address_vals.update({'type': address_type, 'parent_id': brw_partner.id})
+                        self.with_context(qbo_import=True).create(address_vals)
+
+                parent_map[partner.get('Id')] = brw_partner.id
+                if partner.get('Id') == last_qbo_id:
+                    last_partner = brw_partner
+                if synced:
+                    _logger.info(_("Partner unchanged, skipped! Partner Id: %s" % (brw_partner.id)))
+                else:
+                    _logger.info(_("Partner created sucessfully! Partner Id: %s" % (brw_partner.id)))
+                qbo_metrics.checkpoint()
+        # partner of the last entity of the page, import watermarks rely on it
+        return last_partner or brw_partner
 
-        for partner in partners:
-            vals = self._prepare_partner_dict(partner, is_customer=is_customer, is_vendor=is_vendor)
-            brw_partner = self.search([('qbo_customer_id', '=', partner.get('Id'))], limit=1)
-            if not brw_partner:
-                brw_partner = self.create(vals)
-            else:
-                brw_partner.write(vals)
-
-#             child_ids = []
-            if 'BillAddr' in partner and partner.get('BillAddr'):
-                address_vals = {
-                    'street': partner.get('BillAddr').get('Line1'),
-                    'city': partner.get('BillAddr').get('city'),
-                    'zip': partner.get('BillAddr').get('zip'),
-                    'state_id': self.env['res.country.state'].get_state_ref(partner.get('BillAddr').get('CountrySubDivisionCode'), partner.get('BillAddr').get('Country')) if partner.get('BillAddr').get('CountrySubDivisionCode') else False,
-                    'country_id': self.env['res.country'].get_country_ref(partner.get('BillAddr').get('Country')) if partner.get('BillAddr').get('Country') else False,
-                    'type': 'invoice',
-                    'parent_id': brw_partner.id
-                }
-                # Create partner billing address
-                bill_addr = self.create(address_vals)
-
-            if 'ShipAddr' in partner and partner.get('ShipAddr'):
-                address_vals = {
-                    'street': partner.get('ShipAddr').get('Line1'),
-                    'city': partner.get('ShipAddr').get('city'),
-                    'zip': partner.get('ShipAddr').get('zip'),
-                    'state_id': self.env['res.country.state'].get_state_ref(partner.get('ShipAddr').get('CountrySubDivisionCode'), partner.get('ShipAddr').get('Country')) if partner.get('ShipAddr').get('CountrySubDivisionCode') else False,
-                    'country_id': self.env['res.country'].get_country_ref(partner.get('ShipAddr').get('Country')) if partner.get('ShipAddr').get('Country') else False,
-                    'type': 'delivery',
-                    'parent_id': brw_partner.id
-                }
-                # Create partner billing address
-                ship_addr = self.create(address_vals)
-
-            _logger.info(_("Partner created sucessfully! Partner Id: %s" % (brw_partner.id)))
-        return brw_partner
+    @api.model
+    def _fetch_qbo_parents(self, partners, entity, qbo_field):
+        """Resolve ParentRefs of a page of QBO partners
+        Parents already imported are read with one search per hierarchy level, the other ones are fetched with one
+        Id IN query per level.
+        :return tuple: list of fetched parent entities, dictionary of odoo partner ids by QBO id
+        """
+        company = self.env['res.company']._qbo_company()
+        qbo_fields = [name.strip() for name in company._get_import_select_clause('res.partner', entity).split(',')]
+        known = set(partner.get('Id') for partner in partners)
+        parent_map = {}
+        parents = []
+        pending = partners
+        while pending:
+            refs = set(partner.get('ParentRef').get('value') for partner in pending if partner.get('ParentRef')) - known - set(parent_map)
+            if not refs:
+                break
+            for record in self.with_context(active_test=False).search_read([(qbo_field, 'in', list(refs))] + company._qbo_company_domain(shared=True),
+                                                                           [qbo_field]):
+                parent_map[record[qbo_field]] = record['id']
+            missing = refs - set(parent_map)
+            pending = list(company._qbo_query_by_ids(entity, missing, qbo_fields=qbo_fields).values()) if missing else []
+            known.update(partner.get('Id') for partner in pending)
+            parents.extend(pending)
+        return parents, parent_map
+
+    @api.model
+    def _sort_qbo_parents_first(self, partners):
+        """Return QBO partners sorted by hierarchy depth, the QBO order is kept within a level"""
+        by_id = dict((partner.get('Id'), partner) for partner in partners)
+
+        def depth(partner):
+            level = 0
+            seen = set()
+            while partner.get('ParentRef') and partner.get('ParentRef').get('value') in by_id and partner.get('Id') not in seen:
+                seen.add(partner.get('Id'))
+                partner = by_id[partner.get('ParentRef').get('value')]
+                level += 1
+            return level
+        return sorted(partners, key=depth)
 
 ResPartner()
 
@@ -205,7 +411,7 @@ class Respartnercustomization(models.Model):
         ''' Check first if qbo_customer_id exists in quickbooks or not'''
         if self.x_quickbooks_exported or self.qbo_customer_id:
             ''' Hit request ot quickbooks and check response '''
-            company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
+            company = self.env['res.company']._qbo_company()
 
             ''' GET ACCESS TOKEN '''
 
@@ -224,9 +430,9 @@ class Respartnercustomization(models.Model):
 
                 sql_query = "select Id,SyncToken from customer Where Id = '{}'".format(str(self.qbo_customer_id))
 
-                result = requests.request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
+                result = self.env['res.company']._qbo_request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
                 if result.status_code == 200:
-                    parsed_result = result.json()
+                    parsed_result = self.env['res.company'].decode_qbo_response(result)
 
                     if parsed_result.get('QueryResponse') and parsed_result.get('QueryResponse').get('Customer'):
                         customer_id_retrieved = parsed_result.get('QueryResponse').get('Customer')[0].get('Id')
@@ -243,7 +449,7 @@ class Respartnercustomization(models.Model):
 
     def sendDataToQuickbooksForUpdate(self, dict):
 
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
+        company = self.env['res.company']._qbo_company()
 
         ''' GET ACCESS TOKEN '''
 
@@ -261,9 +467,9 @@ class Respartnercustomization(models.Model):
             headers['Content-Type'] = 'application/json'
             headers['Accept'] = 'application/json'
 
-            result = requests.request('POST', company.url + str(realmId) + "/customer?operation=update", headers=headers, data=parsed_dict)
+            result = self.env['res.company']._qbo_request('POST', company.url + str(realmId) + "/customer?operation=update", headers=headers, data=parsed_dict)
             if result.status_code == 200:
-                parsed_result = result.json()
+                parsed_result = self.env['res.company'].decode_qbo_response(result)
                 if parsed_result.get('Customer').get('Id'):
                     self.x_quickbooks_updated = True
                     return parsed_result.get('Customer').get('Id')
@@ -273,6 +479,101 @@ class Respartnercustomization(models.Model):
                 raise UserError("Error Occured While Updating" + result.text)
                 return False
 
+    @api.multi
+    def _prepare_qbo_customer_vals(self):
+        """Return QBO Customer payload of the partner, without parent reference"""
+        self.ensure_one()
+        vals = {}
+        if self.mobile:
+            vals['Mobile'] = {'FreeFormNumber': str(self.mobile)}
+        if self.website:
+            vals['WebAddr'] = {'URI': str(self.website)}
+        if self.comment:
+            vals['Notes'] = self.comment
+        if self.name:
+            vals['GivenName'] = str(self.name)
+            vals['DisplayName'] = str(self.display_name)
+        if self.title:
+            vals['Title'] = self.title.name
+        if self.email:
+            vals['PrimaryEmailAddr'] = {'Address': str(self.email)}
+        if self.phone:
+            vals['PrimaryPhone'] = {'FreeFormNumber': str(self.phone)}
+        if self.type == 'invoice' or self.type == 'contact':
+            vals['BillAddr'] = {'Line1': self.street, 'Line2': (self.street2 or ""), 'City': (self.city or ""),
+                                'Country': self.country_id.name, 'CountrySubDivisionCode': self.state_id.name, 'PostalCode': self.zip}
+        if self.type == 'delivery':
+            vals['ShipAddr'] = {'Line1': self.street, 'Line2': self.street2, 'City': self.city,
+                                'Country': self.country_id.name, 'CountrySubDivisionCode': self.state_id.name, 'PostalCode': self.zip}
+        return vals
+
+    @api.multi
+    @qbo_metrics.instrument('export_partner')
+    def export_partners_to_qbo(self):
+        """Export customers to QBO through batch requests, parents are sent in an earlier batch than their children
+        :return res.partner: exported partners
+        """
+        company = self.env['res.company']._qbo_company()
+        failure = self.env['qbo.sync.failure']
+        partners = self
+        # parents missing in QBO are exported with their children
+        parents = partners.mapped('parent_id')
+        while parents:
+            missing = parents.filtered(lambda parent: not parent.qbo_customer_id) - partners
+            partners |= missing
+            parents = missing.mapped('parent_id')
+        exported = self.browse()
+        pending = partners
+        while pending:
+            # partners whose parent is exported or not exported by this call
+            level = pending.filtered(lambda partner: not partner.parent_id or partner.parent_id not in pending)
+            if not level:
+                break
+            pending -= level
+            payloads = {}
+            for partner in level:
+                vals = partner._prepare_qbo_customer_vals()
+                if partner.parent_id:
+                    if not partner.parent_id.qbo_customer_id:
+                        failure._record('export_partner', partner, payload=vals,
+                                        error=UserError(_("Parent %s is not exported to QBO.") % partner.parent_id.name))
+                        continue
+                    vals.update({'ParentRef': {'value': str(partner.parent_id.qbo_customer_id)}, 'Job': True})
+                payloads[partner.id] = vals
+            updated = level.filtered(lambda partner: partner.qbo_customer_id and partner.id in payloads)
+            customers = company._qbo_query_by_ids('Customer', updated.mapped('qbo_customer_id')) if updated else {}
+            batch_items = []
+            for partner in level.filtered(lambda partner: partner.id in payloads):
+                vals = payloads[partner.id]
+                if partner.qbo_customer_id:
+                    customer = customers.get(partner.qbo_customer_id)
+                    if not customer:
+                        error = UserError(_("Partner %s not found in QBO with Id %s") % (partner.name, partner.qbo_customer_id))
+                        failure._record('export_partner', partner, payload=vals, error=error)
+                        continue
+                    vals.update({'Id': partner.qbo_customer_id, 'SyncToken': customer.get('SyncToken'), 'sparse': True})
+                    operation = 'update'
+                else:
+                    operation = 'create'
+                batch_items.append({'bId': str(partner.id), 'operation': operation, 'Customer': vals})
+
+            request_ids = dict((str(partner_id), request_id) for partner_id, request_id in
+                               company._qbo_request_ids('export_partner', level).items())
+            responses = company._qbo_batch(batch_items, request_ids=request_ids)
+            for bid, response in responses.items():
+                partner = self.browse(int(bid))
+                qbo_id = response.get('Customer', {}).get('Id')
+                if qbo_id:
+                    if partner.qbo_customer_id != qbo_id or not partner.x_quickbooks_exported:
+                        partner.write({'qbo_customer_id': qbo_id, 'x_quickbooks_exported': True})
+                    exported |= partner
+                    _logger.info(_("%s exported successfully to QBO" % (partner.name)))
+                else:
+                    _logger.error(_("%s export failed: %s" % (partner.name, company._qbo_fault_message(response))))
+                    failure._record('export_partner', partner, payload=payloads[partner.id], response=response)
+        failure._resolve('export_partner', exported)
+        return exported
+
     def prepareDictStructure(self, obj=False, record_type=False, customer_id_retrieved=False, is_update=False, sync_token=False):
         data_object = None
 
@@ -282,51 +583,8 @@ class Respartnercustomization(models.Model):
             data_object = self
 
         ''' This Function Exports Record to Quickbooks '''
-        dict = {}
-        dict_phone = {}
-        dict_email = {}
-        dict_mobile = {}
-        dict_billAddr = {}
-        dict_shipAddr = {}
+        dict = data_object._prepare_qbo_customer_vals()
         dict_parent_ref = {}
-        dict_job = {}
-
-        if data_object.mobile:
-            dict['Mobile'] = {'FreeFormNumber': str(data_object.mobile)}
-
-        if data_object.website:
-            dict['WebAddr'] = {'URI': str(data_object.website)}
-
-        if data_object.comment:
-            dict["Notes"] = data_object.comment
-#
-        if data_object.name:
-            dict["GivenName"] = str(data_object.name)
-            dict['DisplayName'] = str(data_object.display_name)
-
-        if data_object.title:
-            dict["Title"] = data_object.title.name
-
-        if data_object.email:
-            dict_email["PrimaryEmailAddr"] = {'Address': str(data_object.email)}
-
-        if data_object.phone:
-            dict_phone["PrimaryPhone"] = {'FreeFormNumber': str(data_object.phone)}
-
-        if data_object.type == 'invoice' or data_object.type == 'contact':
-            dict_billAddr['BillAddr'] = {'Line1': data_object.street, 'Line2': (data_object.street2 or ""), 'City': (data_object.city or ""),
-                                         'Country': data_object.country_id.name, 'CountrySubDivisionCode': data_object.state_id.name,
-                                         'PostalCode': data_object.zip}
-
-        if self.type == 'delivery':
-            dict_shipAddr['ShipAddr'] = {'Line1': data_object.street, 'Line2': data_object.street2, 'City': data_object.city,
-                                         'Country': data_object.country_id.name, 'CountrySubDivisionCode': data_object.state_id.name,
-                                         'PostalCode': data_object.zip}
-
-        dict.update(dict_email)
-        dict.update(dict_phone)
-        dict.update(dict_billAddr)
-        dict.update(dict_shipAddr)
 
         if customer_id_retrieved and record_type and record_type == "indv_company":
             dict_parent_ref['ParentRef'] = {'value': str(customer_id_retrieved)}
@@ -344,7 +602,8 @@ class Respartnercustomization(models.Model):
                 dict['SyncToken'] = str(sync_token)
             result = self.sendDataToQuickbooksForUpdate(dict)
         else:
-            result = self.sendDataToQuickbook(dict)
+            # the parent company is sent by its own record so that its requestid differs from the contact's
+            result = data_object.sendDataToQuickbook(dict)
 
         if result:
             if is_update:
@@ -374,7 +633,7 @@ class Respartnercustomization(models.Model):
     def checkPartnerInQuickbooks(self, odoo_partner_object):
         ''' Check This Name in Quickbooks '''
         customer_id_retrieved = None
-        company = self.env['res.users'].search([('id', '=', self.env.uid)], limit=1).company_id
+        company = self.env['res.company']._qbo_company()
 
         if company:
 
@@ -395,9 +654,9 @@ class Respartnercustomization(models.Model):
                 sql_query = "select Id from customer Where DisplayName = '{}'".format(str(odoo_partner_object.name))
 #                 print ("SQL QUERY IS ",sql_query)
 
-                result = requests.request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
+                result = self.env['res.company']._qbo_request('GET', company.url + str(realmId) + "/query?query=" + sql_query, headers=headers)
                 if result.status_code == 200:
-                    parsed_result = result.json()
+                    parsed_result = self.env['res.company'].decode_qbo_response(result)
 
                     if parsed_result.get('QueryResponse') and parsed_result.get('QueryResponse').get('Customer'):
                         customer_id_retrieved = parsed_result.get('QueryResponse').get('Customer')[0].get('Id')
@@ -428,7 +687,7 @@ class Respartnercustomization(models.Model):
 
     def sendDataToQuickbook(self, dict):
 
-        company = self.env['res.users'].search([('id', '=', self._uid)], limit=1).company_id
+        company = self.env['res.company']._qbo_company()
 
         ''' GET ACCESS TOKEN '''
 
@@ -446,22 +705,27 @@ class Respartnercustomization(models.Model):
             headers['Content-Type'] = 'application/json'
             headers['Accept'] = 'application/json'
 
-            result = requests.request('POST', company.url + str(realmId) + "/customer", headers=headers, data=parsed_dict)
+            result = self.env['res.company']._qbo_request('POST', company.url + str(realmId) + "/customer", headers=headers, data=parsed_dict,
+                                                          request_id=company._qbo_request_ids('export_partner', self)[self.id])
             if result.status_code == 200:
-                parsed_result = result.json()
+                parsed_result = self.env['res.company'].decode_qbo_response(result)
                 if parsed_result.get('Customer').get('Id'):
                     if self.parent_id:
                         self.parent_id.x_quickbooks_exported = True
                     if not self.parent_id:
                         self.x_quickbooks_exported = True
+                    self.env['qbo.sync.failure']._resolve('export_partner', self)
                     return parsed_result.get('Customer').get('Id')
                 else:
                     return False
             else:
+                # kept as sync failure, the export is retried from the failure list
+                self.env['qbo.sync.failure']._record('export_partner', self, payload=dict, response=result)
                 raise UserError("Error Occured While Exporting" + result.text)
                 return False
 
     @api.model
+    @qbo_metrics.instrument('export_partner')
     def exportPartner(self):
 
         if len(self) > 1:
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from . import test_qbo_request_id
+from . import test_qbo_multi_company
+from . import test_qbo_export_changes
+from . import test_qbo_sync_mixin
+from . import test_qbo_sync_failure
+from . import test_qbo_import_plan
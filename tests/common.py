@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from odoo import api
+from odoo.tests import common
+
+
+class QboCursorCase(common.TransactionCase):
+    """Sync stages commit, and write their runs and failures through cursors of their own. The tests of those stages run
+    on the test cursor of the registry, which serves every cursor of the stage and is rolled back after the test.
+    """
+
+    def setUp(self):
+        super(QboCursorCase, self).setUp()
+        self.registry.enter_test_mode()
+        self.addCleanup(self.registry.leave_test_mode)
+        cr, env = self.cr, self.env
+        self.cr = self.registry.cursor()
+        self.env = api.Environment(self.cr, self.uid, {})
+
+        @self.addCleanup
+        def restore():
+            self.env.reset()
+            self.cr.release()
+            self.cr, self.env = cr, env
+
+        self.company = self.env.user.company_id
+        self.company.write({'realm_id': '123145', 'url': 'https://qbo.test/v3/company/', 'access_token': 'token'})
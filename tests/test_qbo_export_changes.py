@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from unittest import mock
+
+from odoo import fields
+
+from ..models.res_company import QBO_EXPORT_MODELS, QBO_EXPORT_OVERLAP
+from .common import QboCursorCase
+
+
+class TestQboExportChanges(QboCursorCase):
+
+    def _export_changes(self):
+        """Run export_changes with the batch exports replaced, return the exported ids by model"""
+        exported = {}
+
+        def exporter(model_name):
+            def export(records):
+                exported.setdefault(model_name, []).extend(records.ids)
+            return export
+
+        patches = [mock.patch.object(type(self.env[model_name]), method, autospec=True, side_effect=exporter(model_name))
+                   for model_name, watermark, operation, method, condition in QBO_EXPORT_MODELS]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.company.export_changes()
+        return exported
+
+    def test_address_children_of_imported_customer_not_exported(self):
+        customer = {
+            'Id': '501', 'DisplayName': 'Imported Customer', 'Active': True,
+            'MetaData': {'LastUpdatedTime': '2018-01-02T10:00:00-08:00'},
+            'BillAddr': {'Line1': '1 Main Street', 'City': 'Mountain View'},
+            'ShipAddr': {'Line1': '2 Dock Road', 'City': 'Mountain View'},
+        }
+        partner = self.env['res.partner'].create_partner([customer], is_customer=True)
+        addresses = partner.child_ids.filtered(lambda child: child.type in ('invoice', 'delivery'))
+        self.assertEqual(len(addresses), 2)
+
+        self.company.last_exported_partner_date = False
+        exported = self._export_changes().get('res.partner', [])
+        self.assertIn(partner.id, exported)
+        self.assertFalse(set(addresses.ids) & set(exported))
+
+    def test_changed_records_selected_per_model(self):
+        customer = self.env['res.partner'].create({'name': 'Changed Customer', 'customer': True})
+        vendor = self.env['res.partner'].create({'name': 'Changed Vendor', 'customer': False, 'supplier': True})
+        other_company = self.env['res.company'].create({'name': 'Other Realm'})
+        other_customer = self.env['res.partner'].create({'name': 'Other Customer', 'customer': True, 'company_id': other_company.id})
+        self.company.write({'last_exported_partner_date': False, 'last_exported_product_date': False})
+        product = self.env['product.template'].create({'name': 'Changed Product'})
+
+        exported = self._export_changes()
+        self.assertIn(customer.id, exported['res.partner'])
+        self.assertNotIn(vendor.id, exported['res.partner'])
+        self.assertNotIn(other_customer.id, exported['res.partner'])
+        self.assertIn(product.id, exported['product.template'])
+        self.assertNotIn(customer.id, exported.get('product.template', []))
+
+    def test_watermark_of_each_model(self):
+        customer = self.env['res.partner'].create({'name': 'Changed Customer', 'customer': True})
+        self.company.last_exported_partner_date = False
+        start = datetime.utcnow()
+        self.assertIn(customer.id, self._export_changes()['res.partner'])
+
+        # the watermark is the selection time minus the overlap
+        self.company.invalidate_cache()
+        watermark = fields.Datetime.from_string(self.company.last_exported_partner_date)
+        self.assertLessEqual(watermark, datetime.utcnow() - timedelta(seconds=QBO_EXPORT_OVERLAP))
+        self.assertGreaterEqual(watermark, start - timedelta(seconds=QBO_EXPORT_OVERLAP + 1))
+        # records changed within the overlap are selected again
+        self.assertIn(customer.id, self._export_changes().get('res.partner', []))
+
+        # records not changed since the watermark are left out
+        self.company.last_exported_partner_date = fields.Datetime.to_string(datetime.utcnow() + timedelta(hours=1))
+        self.assertNotIn(customer.id, self._export_changes().get('res.partner', []))
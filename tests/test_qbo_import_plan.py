@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import itertools
+from unittest import mock
+
+from ..models import qbo_import_plan
+from .common import QboCursorCase
+
+
+class TestQboImportPlan(QboCursorCase):
+
+    def setUp(self):
+        super(TestQboImportPlan, self).setUp()
+        self.company.write({'qbo_slice_seconds': 60, 'last_imported_customer_id': '0'})
+        self.plan = self.env['qbo.import.plan'].create({'company_id': self.company.id})
+        self.stage = self.plan.stage_ids.filtered(lambda stage: stage.name == 'import_customers')
+        self.stage._enqueue()
+        self.cron = self.stage.cron_id
+
+    def _run(self, pages_left, seconds_per_page):
+        """Run the customer stage, each page advances the watermark until pages_left pages were imported
+        :param seconds_per_page: clock time spent by each page
+        """
+        def import_customers(company):
+            if int(company.last_imported_customer_id) < pages_left:
+                company.last_imported_customer_id = str(int(company.last_imported_customer_id) + 1)
+
+        clock = mock.Mock(time=mock.Mock(side_effect=itertools.count(0, seconds_per_page)))
+        with mock.patch.object(type(self.env['res.company']), 'import_customers', autospec=True, side_effect=import_customers), \
+                mock.patch.object(qbo_import_plan, 'time', clock):
+            self.stage._run()
+        self.env.invalidate_all()
+
+    def test_stage_enqueued_again_when_slice_is_over(self):
+        self._run(pages_left=10, seconds_per_page=61)
+        self.assertEqual(self.stage.state, 'queued')
+        self.assertEqual(self.stage.pages, 1)
+        self.assertEqual(self.stage.slices, 1)
+        self.assertNotEqual(self.stage.cron_id, self.cron)
+        self.assertEqual(self.stage.cron_id.code, 'model.browse(%d)._run()' % self.stage.id)
+        self.assertEqual(self.company.last_imported_customer_id, '1')
+
+        # the next job resumes from the committed watermark
+        self._run(pages_left=10, seconds_per_page=61)
+        self.assertEqual(self.stage.state, 'queued')
+        self.assertEqual(self.stage.pages, 2)
+        self.assertEqual(self.stage.slices, 2)
+        self.assertEqual(self.company.last_imported_customer_id, '2')
+
+    def test_stage_done_within_its_slice(self):
+        self._run(pages_left=3, seconds_per_page=1)
+        self.assertEqual(self.stage.state, 'done')
+        # the last page returned nothing new
+        self.assertEqual(self.stage.pages, 4)
+        self.assertEqual(self.stage.slices, 1)
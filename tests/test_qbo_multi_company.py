@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import common
+
+from ..models.res_partner import QboPartnerIndex
+
+
+class TestQboMultiCompany(common.TransactionCase):
+    """Two realms using the same QBO ids must not match the records of each other"""
+
+    def setUp(self):
+        super(TestQboMultiCompany, self).setUp()
+        self.company_a = self.env.user.company_id
+        self.company_b = self.env['res.company'].create({'name': 'Realm B', 'realm_id': '222'})
+        self.company_a.realm_id = '111'
+        account_type = self.env.ref('account.data_account_type_revenue')
+        self.account_a = self.env['account.account'].create({
+            'name': 'Sales A', 'code': 'QBOA1', 'user_type_id': account_type.id, 'company_id': self.company_a.id, 'qbo_id': '7'})
+        self.account_b = self.env['account.account'].create({
+            'name': 'Sales B', 'code': 'QBOB1', 'user_type_id': account_type.id, 'company_id': self.company_b.id, 'qbo_id': '7'})
+        self.partner_a = self.env['res.partner'].create({
+            'name': 'Customer A', 'email': 'a@example.com', 'customer': True, 'company_id': self.company_a.id, 'qbo_customer_id': '7'})
+        self.tax_a = self.env['account.tax'].create({
+            'name': 'QBO Tax', 'amount': 5, 'type_tax_use': 'sale', 'company_id': self.company_a.id, 'qbo_tax_id': '7'})
+        self.tax_b = self.env['account.tax'].create({
+            'name': 'QBO Tax', 'amount': 5, 'type_tax_use': 'sale', 'company_id': self.company_b.id, 'qbo_tax_id': '7'})
+
+    def _env_of(self, company):
+        return self.env(context=dict(self.env.context, qbo_company_id=company.id, force_company=company.id))
+
+    def test_account_ref_of_the_sync_company(self):
+        self.assertEqual(self._env_of(self.company_a)['account.account'].get_account_ref('7'), self.account_a.id)
+        self.assertEqual(self._env_of(self.company_b)['account.account'].get_account_ref('7'), self.account_b.id)
+
+    def test_tax_ref_of_the_sync_company(self):
+        self.assertEqual(self._env_of(self.company_a)['account.tax'].get_account_tax_ref('7', 'QBO Tax'), self.tax_a.id)
+        self.assertEqual(self._env_of(self.company_b)['account.tax'].get_account_tax_ref('7', 'QBO Tax'), self.tax_b.id)
+
+    def test_partner_of_other_realm_not_matched(self):
+        customer = {'Id': '7', 'DisplayName': 'Customer A', 'PrimaryEmailAddr': {'Address': 'a@example.com'}}
+        self.assertEqual(QboPartnerIndex(self._env_of(self.company_a), [customer]).match(customer, 'qbo_customer_id'), self.partner_a.id)
+        self.assertFalse(QboPartnerIndex(self._env_of(self.company_b), [customer]).match(customer, 'qbo_customer_id'))
+
+    def test_records_created_by_sync_belong_to_its_company(self):
+        partner = self._env_of(self.company_b)['res.partner'].create({'name': 'Customer B'})
+        self.assertEqual(partner.company_id, self.company_b)
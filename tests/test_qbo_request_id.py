@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from odoo.tests import common
+
+
+class FakeResponse(object):
+    status_code = 200
+    text = ''
+
+
+class TestQboRequestId(common.TransactionCase):
+
+    def setUp(self):
+        super(TestQboRequestId, self).setUp()
+        self.company = self.env.user.company_id
+        self.company.write({'realm_id': '123145', 'url': 'https://qbo.test/v3/company/', 'access_token': 'token'})
+        self.account = self.env['account.account'].search([('company_id', '=', self.company.id)], limit=1)
+
+    def _send_batch(self, item):
+        """Send one batch item and return the requestid of the call"""
+        company_class = type(self.env['res.company'])
+        with mock.patch.object(company_class, '_qbo_request', autospec=True, return_value=FakeResponse()) as request, \
+                mock.patch.object(company_class, 'decode_qbo_response', autospec=True, return_value={'BatchItemResponse': []}):
+            request_ids = dict((str(record_id), request_id) for record_id, request_id in
+                               self.company._qbo_request_ids('export_account', self.account).items())
+            self.company._qbo_batch([item], request_ids=request_ids)
+        return request.call_args[1]['request_id']
+
+    def test_update_of_edited_record_has_new_request_id(self):
+        bid = str(self.account.id)
+        create_id = self._send_batch({'bId': bid, 'operation': 'create', 'Account': {'Name': 'Sales'}})
+        # the record was created with SyncToken 0, then edited and exported again twice
+        first_update_id = self._send_batch({'bId': bid, 'operation': 'update', 'Account': {
+            'Id': '42', 'SyncToken': '0', 'sparse': True, 'Name': 'Sales Income'}})
+        second_update_id = self._send_batch({'bId': bid, 'operation': 'update', 'Account': {
+            'Id': '42', 'SyncToken': '1', 'sparse': True, 'Name': 'Product Sales'}})
+        self.assertNotEqual(create_id, first_update_id)
+        self.assertNotEqual(first_update_id, second_update_id)
+
+    def test_resent_call_keeps_request_id(self):
+        item = {'bId': str(self.account.id), 'operation': 'update', 'Account': {'Id': '42', 'SyncToken': '3', 'Name': 'Sales'}}
+        self.assertEqual(self._send_batch(dict(item)), self._send_batch(dict(item)))
+        create = {'bId': str(self.account.id), 'operation': 'create', 'Account': {'Name': 'Sales'}}
+        self.assertEqual(self._send_batch(dict(create)), self._send_batch(dict(create)))
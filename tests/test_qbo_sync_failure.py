@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from .common import QboCursorCase
+
+FAULT = {'Fault': {'type': 'ValidationFault', 'Error': [{'Message': 'Duplicate Name Exists Error',
+                                                          'Detail': 'The name supplied already exists.'}]}}
+
+
+class TestQboSyncFailure(QboCursorCase):
+
+    def setUp(self):
+        super(TestQboSyncFailure, self).setUp()
+        self.partner = self.env['res.partner'].create({'name': 'Failing Customer', 'customer': True})
+
+    def _export(self, response):
+        """Export the partner with every batch item answered with response"""
+        def batch(company, items, minorversion=None, request_ids=None):
+            return dict((item['bId'], response) for item in items)
+        with mock.patch.object(type(self.env['res.company']), '_qbo_batch', autospec=True, side_effect=batch):
+            self.partner.export_partners_to_qbo()
+        self.env.invalidate_all()
+
+    def _failure(self):
+        return self.env['qbo.sync.failure'].search([
+            ('name', '=', 'export_partner'), ('res_model', '=', 'res.partner'), ('res_id', '=', self.partner.id)])
+
+    def test_rejected_record_recorded(self):
+        self._export(FAULT)
+        failure = self._failure()
+        self.assertEqual(len(failure), 1)
+        self.assertEqual(failure.state, 'failed')
+        self.assertEqual(failure.error_class, 'ValidationFault')
+        self.assertIn('Duplicate Name Exists Error', failure.error)
+        self.assertIn('Failing Customer', failure.payload)
+        # a rejected call is sent with the next requestid
+        self.assertEqual(failure.request_attempt, 1)
+        self.assertFalse(self.partner.qbo_customer_id)
+
+        # the same open failure is updated by the next rejection
+        self._export(FAULT)
+        self.assertEqual(self._failure(), failure)
+        self.assertEqual(failure.attempts, 2)
+        self.assertEqual(failure.request_attempt, 2)
+
+    def test_failure_resolved_by_successful_export(self):
+        self._export(FAULT)
+        failure = self._failure()
+        self._export({'Customer': {'Id': '900'}})
+        self.assertEqual(self.partner.qbo_customer_id, '900')
+        self.assertEqual(failure.state, 'done')
+        self.assertTrue(failure.date_done)
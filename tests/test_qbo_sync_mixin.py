@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from .common import QboCursorCase
+
+
+class TestQboSyncMixin(QboCursorCase):
+
+    def setUp(self):
+        super(TestQboSyncMixin, self).setUp()
+        self.customer = {
+            'Id': '601', 'DisplayName': 'Synced Customer', 'Active': True,
+            'PrimaryPhone': {'FreeFormNumber': '(555) 555-0601'},
+            'MetaData': {'LastUpdatedTime': '2018-01-02T10:00:00-08:00'},
+            'BillAddr': {'Line1': '1 Main Street', 'City': 'Mountain View'},
+        }
+        self.partner = self.env['res.partner'].create_partner([self.customer], is_customer=True)
+
+    def _import(self):
+        """Import the customer again, return the partners written by the import"""
+        partner_class = type(self.env['res.partner'])
+        with mock.patch.object(partner_class, 'write', autospec=True, side_effect=partner_class.write) as write:
+            self.env['res.partner'].create_partner([dict(self.customer)], is_customer=True)
+        self.env.invalidate_all()
+        return set(record.id for call in write.call_args_list for record in call[0][0])
+
+    def test_unchanged_entity_skipped(self):
+        self.assertTrue(self.partner.qbo_sync_hash)
+        addresses = self.partner.child_ids
+        self.assertNotIn(self.partner.id, self._import())
+        self.assertEqual(self.partner.child_ids, addresses)
+
+    def test_local_edit_clears_hash(self):
+        sync_hash = self.partner.qbo_sync_hash
+        # fields the import does not write keep the hash
+        self.partner.write({'ref': 'LOCAL'})
+        self.assertEqual(self.partner.qbo_sync_hash, sync_hash)
+        self.partner.write({'phone': '(555) 555-9999'})
+        self.assertFalse(self.partner.qbo_sync_hash)
+
+        # the next import writes the QBO values back
+        self.assertIn(self.partner.id, self._import())
+        self.assertEqual(self.partner.phone, '(555) 555-0601')
+        self.assertEqual(self.partner.qbo_sync_hash, sync_hash)
+
+    def test_changed_entity_written(self):
+        self.customer['DisplayName'] = 'Renamed Customer'
+        self.customer['MetaData'] = {'LastUpdatedTime': '2018-01-03T10:00:00-08:00'}
+        self.assertIn(self.partner.id, self._import())
+        self.assertEqual(self.partner.name, 'Renamed Customer')
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from . import qbo_json
+from . import qbo_metrics
+from . import qbo_http
+from . import qbo_cache
+from . import qbo_realm_lock
+from . import qbo_memory
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Process wide cache of QBO reference entities.
+
+Entries are keyed by database and realm and expire after their TTL, so that
+every worker reloads the references of a realm at most once per TTL.
+"""
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe dictionary whose entries expire"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        """Return the value of key, None when missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+# well-known reference entities by (dbname, realm id)
+references = TTLCache()
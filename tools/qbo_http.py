@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Transport of QBO API calls: timeouts, retries and metrics."""
+import logging
+import time
+import uuid
+
+import requests
+
+from . import qbo_metrics
+
+_logger = logging.getLogger(__name__)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+DEFAULT_TIMEOUT = (10, 300)
+# namespace of the requestid of QBO calls
+REQUEST_ID_NAMESPACE = uuid.UUID('6f1c2b0e-4d59-5a8e-9a4b-3c7e0d2f8a61')
+
+
+def request_id(*key):
+    """Return the deterministic requestid of a QBO call
+    QBO answers a call repeating a requestid with the response of the first call instead of processing it again.
+    :param key: parts identifying the call, e.g. database, realm, model, record id and attempt
+    :return str: uuid
+    """
+    return str(uuid.uuid5(REQUEST_ID_NAMESPACE, '/'.join(str(part) for part in key)))
+
+
+def with_request_id(url, qbo_request_id):
+    """Return url with the requestid query parameter"""
+    return url + ('&' if '?' in url else '?') + 'requestid=' + qbo_request_id
+
+
+def send(method, url, headers=None, data=None, stream=False, metrics=None, max_retries=3, idempotent=None, timeout=DEFAULT_TIMEOUT,
+         slot=None):
+    """Send a QBO API call, retrying throttled and failed calls with exponential backoff
+    :param metrics: SyncMetrics collector, the active collector of the thread by default
+    :param idempotent: retry the call on server and connection errors, GET calls and calls with a requestid by default
+    :param slot: context manager factory held during each attempt, e.g. RealmSemaphore.slot, not held during backoff
+    :return: requests.Response object
+    """
+    if metrics is None:
+        metrics = qbo_metrics.current()
+    if idempotent is None:
+        idempotent = method.upper() == 'GET' or 'requestid=' in url
+    attempt = 0
+    start = time.time()
+    while True:
+        response = None
+        try:
+            if slot is not None:
+                with slot():
+                    response = requests.request(method, url, headers=headers, data=data, stream=stream, timeout=timeout)
+            else:
+                response = requests.request(method, url, headers=headers, data=data, stream=stream, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not idempotent or attempt >= max_retries:
+                if metrics is not None:
+                    metrics.add_request(qbo_metrics.endpoint_label(method, url), 0, time.time() - start, retries=attempt)
+                raise
+            _logger.warning("QBO call %s %s failed (%s), retrying", method, url.split('?', 1)[0], e)
+        else:
+            # a throttled call is rejected before processing and can always be sent again
+            retry = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS)
+            if not retry or attempt >= max_retries:
+                if metrics is not None:
+                    metrics.add_request(qbo_metrics.endpoint_label(method, url), response.status_code, time.time() - start, retries=attempt)
+                return response
+            _logger.warning("QBO call %s %s answered %s, retrying", method, url.split('?', 1)[0], response.status_code)
+            response.close()
+        delay = 2 ** attempt
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = int(response.headers['Retry-After'])
+        attempt += 1
+        time.sleep(delay)
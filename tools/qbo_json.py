@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Decoding of QuickBooks Online JSON responses.
+
+Responses are parsed straight from the raw body bytes, orjson or ujson are
+used when installed and the standard library json module otherwise. Streamed
+responses are decoded incrementally with ijson when it is installed so that
+the entities of a large QueryResponse page are yielded one at a time.
+"""
+import hashlib
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+elif ujson is not None:
+    BACKEND = 'ujson'
+else:
+    BACKEND = 'json'
+
+
+def loads(content):
+    """Return python object of a QBO JSON document
+    :param content: JSON document as bytes or str
+    :return: decoded object, empty dict for an empty document
+    """
+    if not content:
+        return {}
+    if orjson is not None:
+        return orjson.loads(content)
+    if ujson is not None:
+        return ujson.loads(content)
+    if isinstance(content, bytes):
+        # json.loads accepts bytes from python 3.6 only
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def digest(value):
+    """Return a stable hash of a python object, dictionaries are hashed whatever their key order
+    :param value: JSON serializable object, other values are hashed by their string
+    :return str: hexadecimal sha1 digest
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def decode_response(response):
+    """Return python object of a QBO http response body
+    :param response: requests.Response object
+    """
+    return loads(response.content)
+
+
+def _iter_stream(fp, entity):
+    """Yield entities of a streamed QBO response body
+    :param fp: file like object of the response body
+    :param entity: QBO entity name
+    """
+    prefixes = ('QueryResponse.%s.item' % entity, entity)
+    builder = None
+    depth = 0
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if builder is None:
+            if event != 'start_map' or prefix not in prefixes:
+                continue
+            builder = ObjectBuilder()
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if not depth:
+                yield builder.value
+                builder = None
+
+
+def iter_entities(response, entity):
+    """Yield entities of a QBO query or read response
+    A response requested with stream=True is decoded incrementally when ijson
+    is installed, keeping a single entity in memory at a time.
+    :param response: requests.Response object or list of entity dictionaries
+    :param entity: QBO entity name
+    """
+    if isinstance(response, (list, tuple)):
+        for record in response:
+            yield record
+        return
+    if ijson is not None and not response._content_consumed:
+        response.raw.decode_content = True
+        try:
+            for record in _iter_stream(response.raw, entity):
+                yield record
+        finally:
+            response.close()
+        return
+    res = decode_response(response)
+    if 'QueryResponse' in res:
+        records = res.get('QueryResponse').get(entity, [])
+    else:
+        records = [res.get(entity)] if res.get(entity) else []
+    for record in records:
+        yield record
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Memory governor of long running QBO imports.
+
+Imports report every processed record to the governor of their sync stage.
+Every N records, or once the worker RSS grew by M megabytes, the governor
+flushes pending recomputations and empties the ORM caches of the thread, so
+that a large import does not grow the worker until limit_memory_hard.
+"""
+import gc
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MEGABYTE = 1024.0 * 1024.0
+
+
+def rss_mb():
+    """Return the resident memory of the process in megabytes, 0 when psutil is missing"""
+    if psutil is None:
+        return 0.0
+    process = psutil.Process(os.getpid())
+    memory_info = process.memory_info if hasattr(process, 'memory_info') else process.get_memory_info
+    return memory_info().rss / MEGABYTE
+
+
+class MemoryGovernor(object):
+    """Release ORM memory of a sync stage every few records or megabytes"""
+
+    def __init__(self, env, records=0, megabytes=0):
+        self.env = env
+        self.records = max(int(records or 0), 0)
+        self.megabytes = max(float(megabytes or 0), 0.0)
+        self.processed = 0
+        self.since_release = 0
+        self.releases = 0
+        self.baseline_rss = rss_mb()
+        self.peak_rss = self.baseline_rss
+
+    def sample(self):
+        """Return the current RSS in megabytes and keep the peak"""
+        rss = rss_mb()
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def checkpoint(self, count=1):
+        """Count processed records, release memory when a limit is reached
+        :return bool: True when the caches were released
+        """
+        self.processed += count
+        self.since_release += count
+        rss = self.sample()
+        due = (self.records and self.since_release >= self.records) or \
+            (self.megabytes and rss and rss - self.baseline_rss >= self.megabytes)
+        if not due:
+            return False
+        self.release()
+        return True
+
+    def release(self):
+        """Flush pending recomputations and empty the record caches of the thread"""
+        env = self.env
+        env['res.company'].recompute()
+        env.invalidate_all()
+        gc.collect()
+        self.releases += 1
+        self.since_release = 0
+        self.baseline_rss = self.sample()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Collection of QBO sync metrics.
+
+A SyncMetrics collector is activated for the duration of a sync stage, QBO
+calls and entity decoding report to the active collector of the thread.
+"""
+import functools
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+
+
+class SyncMetrics(object):
+    """Thread safe counters of one sync stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.error_count = 0
+        self.records_processed = 0
+        self.qbo_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.requests_by_endpoint = defaultdict(int)
+        self.status_codes = defaultdict(int)
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        # qbo_memory.MemoryGovernor of the stage, set by the run tracking the stage
+        self.governor = None
+        # objects built once and shared by the calls of the stage, e.g. the address index of the partner imports
+        self.cache = {}
+
+    def add_request(self, endpoint, status, seconds, retries=0):
+        with self.lock:
+            self.request_count += 1
+            self.retry_count += retries
+            self.qbo_seconds += seconds
+            self.requests_by_endpoint[endpoint] += 1
+            self.status_codes[str(status)] += 1
+            if not status or status >= 400:
+                self.error_count += 1
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    self.latency_buckets[index] += 1
+                    break
+            else:
+                self.latency_buckets[-1] += 1
+
+    def add_decode_time(self, seconds):
+        with self.lock:
+            self.decode_seconds += seconds
+
+    def add_records(self, count=1):
+        with self.lock:
+            self.records_processed += count
+
+
+def current():
+    """Return the collector active in this thread, None outside a sync stage"""
+    return getattr(_local, 'metrics', None)
+
+
+@contextmanager
+def activate(metrics):
+    """Make metrics the active collector of this thread"""
+    previous = current()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+def add_records(count=1):
+    metrics = current()
+    if metrics is not None:
+        metrics.add_records(count)
+
+
+def checkpoint(count=1):
+    """Report records processed by an import to the memory governor of the active stage
+    :return bool: True when the ORM caches were released
+    """
+    metrics = current()
+    if metrics is None or metrics.governor is None:
+        return False
+    return metrics.governor.checkpoint(count)
+
+
+def track_entities(entities):
+    """Yield entities, reporting decode time and processed records to the active collector"""
+    metrics = current()
+    iterator = iter(entities)
+    while True:
+        start = time.time()
+        try:
+            entity = next(iterator)
+        except StopIteration:
+            if metrics is not None:
+                metrics.add_decode_time(time.time() - start)
+            return
+        if metrics is not None:
+            metrics.add_decode_time(time.time() - start)
+            metrics.add_records(1)
+        yield entity
+
+
+def endpoint_label(method, url):
+    """Return a low cardinality label of a QBO call, e.g. 'GET query Customer' or 'POST invoice'"""
+    path = url.split('?', 1)[0]
+    match = re.search(r'/v3/company/[^/]+/([^/]+)', path)
+    resource = match.group(1).lower() if match else path.rstrip('/').rsplit('/', 1)[-1]
+    if resource == 'query':
+        entity = re.search(r'from\s+(\w+)', url, re.I)
+        return '%s query %s' % (method, entity.group(1).lower() if entity else '')
+    return '%s %s' % (method, resource)
+
+
+def instrument(stage, exclusive=False):
+    """Decorator tracking a model method as sync stage in qbo.sync.run
+    Stages called from another stage report to the run of the outer stage. The stage runs in the context of the
+    company of its records.
+    :param exclusive: reject a run of the stage while another one runs for the same company
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            # helpers called by the stage resolve the company of the records, not the company of the user
+            self = self.env['res.company']._qbo_with_company(self)
+            with self.env['qbo.sync.run']._track_stage(stage, self, exclusive=exclusive):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
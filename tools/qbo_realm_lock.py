@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Locks of QBO syncs shared by every worker of a database.
+
+A call holds one of the slots of its realm while it waits for QBO, an import
+stage holds the run lock of its company while it runs. Both are PostgreSQL
+session advisory locks taken on a pooled connection of their own, so they
+are shared by all Odoo processes, survive the commits of the sync and are
+released by PostgreSQL when a worker dies in the middle of a sync.
+"""
+import logging
+import random
+import re
+import time
+import zlib
+from contextlib import contextmanager
+
+from odoo import sql_db
+
+_logger = logging.getLogger(__name__)
+
+# seconds a call waits for a free slot before being sent anyway
+DEFAULT_WAIT = 300
+REALM_URL = re.compile(r'/company/(\d+)')
+
+
+def realm_of(url):
+    """Return the realm id of a QBO API url, None for other urls"""
+    match = REALM_URL.search(url or '')
+    return match and match.group(1)
+
+
+def lock_key(name):
+    """Return the advisory lock key of a name as signed 32 bits integer"""
+    key = zlib.crc32(name.encode('utf-8'))
+    return key - (1 << 32) if key >= (1 << 31) else key
+
+
+def realm_key(realm_id):
+    """Return the first advisory lock key of the slots of a realm"""
+    return lock_key('qbo.realm:%s' % realm_id)
+
+
+class RealmSemaphore(object):
+    """Counting semaphore of the QBO calls of a realm across processes"""
+
+    def __init__(self, dbname, realm_id, slots, wait=DEFAULT_WAIT):
+        self.dbname = dbname
+        self.realm_id = realm_id
+        self.slots = max(int(slots or 0), 0)
+        self.wait = wait
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot of the realm during the block, the block runs without slot when no slot is freed in time"""
+        if not self.slots or not self.realm_id:
+            yield
+            return
+        key = realm_key(self.realm_id)
+        cr = sql_db.db_connect(self.dbname).cursor()
+        held = None
+        try:
+            cr.autocommit(True)
+            deadline = time.time() + self.wait
+            delay = 0.05
+            while held is None:
+                # start at a random slot so that waiting calls do not all poll the same locks
+                first = random.randrange(self.slots)
+                for index in range(self.slots):
+                    candidate = (first + index) % self.slots
+                    cr.execute("SELECT pg_try_advisory_lock(%s, %s)", (key, candidate))
+                    if cr.fetchone()[0]:
+                        held = candidate
+                        break
+                if held is None:
+                    if time.time() >= deadline:
+                        _logger.warning("No free QBO call slot for realm %s after %ss, sending the call anyway", self.realm_id, self.wait)
+                        break
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+            yield
+        finally:
+            try:
+                if held is not None:
+                    cr.execute("SELECT pg_advisory_unlock(%s, %s)", (key, held))
+            finally:
+                cr.close()
+
+
+class SessionLock(object):
+    """Exclusive advisory lock held by a connection of its own until released"""
+
+    def __init__(self, dbname, name):
+        self.dbname = dbname
+        self.key = lock_key(name)
+        self.cr = None
+
+    def acquire(self):
+        """Take the lock without waiting
+        :return bool: False when the lock is held by another connection
+        """
+        cr = sql_db.db_connect(self.dbname).cursor()
+        try:
+            cr.autocommit(True)
+            cr.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+            locked = cr.fetchone()[0]
+        except Exception:
+            cr.close()
+            raise
+        if not locked:
+            cr.close()
+            return False
+        self.cr = cr
+        return True
+
+    def release(self):
+        if self.cr is None:
+            return
+        try:
+            self.cr.execute("SELECT pg_advisory_unlock(%s)", (self.key,))
+        finally:
+            self.cr.close()
+            self.cr = None